@@ -1,19 +1,80 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, get_flashed_messages
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, flash, get_flashed_messages, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 import openpyxl
 import pandas as pd
+import numpy as np
+import hashlib
+import csv
+import json
+import queue
+import heapq
 from functools import wraps
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 import logging
+import re
+import click
 from markupsafe import Markup
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
+import secrets
+import asyncio
+import inspect
+import tempfile
+
+def _login_redirect():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    if 'tenant' not in session:
+        # Sessions from before multi-store routing carry no tenant yet.
+        session['tenant'] = tenant_for_user(session['user'])
+    return None
+
+
+# Flask only runs async views with asgiref installed (flask[async]). Without
+# it the report views are wrapped as plain sync views that drive their own
+# event loop, so they keep working, just without Flask's async support.
+try:
+    import asgiref  # noqa: F401
+    ASYNC_VIEWS = True
+except ImportError:
+    ASYNC_VIEWS = False
+
 
 def login_required(f):
+    # Async report views need an async wrapper, or Flask would be handed the
+    # bare coroutine as the response.
+    if inspect.iscoroutinefunction(f) and not ASYNC_VIEWS:
+        @wraps(f)
+        def decorated_sync(*args, **kwargs):
+            response = _login_redirect()
+            if response is not None:
+                return response
+            return asyncio.run(f(*args, **kwargs))
+        return decorated_sync
+
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            response = _login_redirect()
+            if response is not None:
+                return response
+            return await f(*args, **kwargs)
+        return decorated_coroutine
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user' not in session:
-            return redirect(url_for('login'))
+        response = _login_redirect()
+        if response is not None:
+            return response
         return f(*args, **kwargs)
     return decorated_function
 
@@ -27,10 +88,18 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 
+# Each store (tenant) keeps its own workbooks in TENANTS_DIR/<tenant>; the
+# default tenant is the original single-store layout next to sia.py.
 DATA_DIR = basedir
-INVENTORY_FILE = os.path.join(DATA_DIR, 'databasesia.xlsx')
-JOURNAL_FILE = os.path.join(DATA_DIR, 'jurnal.xlsx')
-SALDO_FILE = os.path.join(DATA_DIR, 'daftarsaldo.xlsx')
+TENANTS_DIR = os.environ.get('SIA_TENANTS_DIR', os.path.join(basedir, 'toko'))
+DEFAULT_TENANT = 'default'
+TENANT_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+TENANT_CACHE_MAX_ENTRIES = int(os.environ.get('SIA_TENANT_CACHE_MAX_ENTRIES', '256'))
+TENANT_IDLE_SECONDS = int(os.environ.get('SIA_TENANT_IDLE_SECONDS', '1800'))
+INVENTORY_FILENAME = 'databasesia.xlsx'
+JOURNAL_FILENAME = 'jurnal.xlsx'
+SALDO_FILENAME = 'daftarsaldo.xlsx'
+CHART_OF_ACCOUNTS_FILENAME = 'daftar_akun.csv'
 
 MONTH_NAME_TO_NUM = {
     'Januari': '01',
@@ -47,6 +116,8 @@ MONTH_NAME_TO_NUM = {
     'Desember': '12',
 }
 
+MONTH_NUM_TO_NAME = {int(num): name for name, num in MONTH_NAME_TO_NUM.items()}
+
 
 def _is_future_period(tahun_str, bulan_name):
     """Return True if the selected tahun/bulan is in the future compared to today.
@@ -86,37 +157,807 @@ def _normalize_excel_date(value):
         return str(value)
 
 
-def journal_row_exists(ws, tanggal, keterangan, akun, debit, kredit):
-    """Check whether a journal row already exists to prevent duplicates."""
+# Set up logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+class Tenant:
+    """One store: its data files, its own bounded cache namespace and write locks.
+
+    The parsed-workbook cache is an LRU of at most TENANT_CACHE_MAX_ENTRIES
+    entries. Every entry remembers the mtime/size of the files it was built
+    from, so a save (ours or an external Excel edit) makes the next access
+    reparse instead of serving stale data. Aggregates of locked periods live in
+    `immutable` without a file signature, under the same LRU limit.
+    """
+
+    def __init__(self, name, data_dir):
+        self.name = name
+        self.data_dir = data_dir
+        self.inventory_file = os.path.join(data_dir, INVENTORY_FILENAME)
+        self.journal_file = os.path.join(data_dir, JOURNAL_FILENAME)
+        self.saldo_file = os.path.join(data_dir, SALDO_FILENAME)
+        self.cache_lock = threading.RLock()
+        self.cache = OrderedDict()
+        self.immutable = OrderedDict()
+        self.journal_write_lock = threading.RLock()
+        self.saldo_write_lock = threading.RLock()
+        self.compaction_running = threading.Event()
+        self._cost_engine = None
+        self.activity = RecentActivity()
+        self.events = EventBroker()
+        self.low_stock = LowStockIndex()
+        self.stock = StockReservations()
+        self.idempotency = IdempotencyStore()
+        # path -> signature of the app's own last save, skipped by the file watcher
+        self.own_writes = {}
+        self.last_used = time.monotonic()
+
+    @property
+    def chart_of_accounts_file(self):
+        # Stores share the main chart of accounts unless they ship their own.
+        own = os.path.join(self.data_dir, CHART_OF_ACCOUNTS_FILENAME)
+        return own if os.path.exists(own) else os.path.join(DATA_DIR, CHART_OF_ACCOUNTS_FILENAME)
+
+    @property
+    def cost_engine(self):
+        with self.cache_lock:
+            if self._cost_engine is None:
+                self._cost_engine = CostEngine(COSTING_METHOD)
+            return self._cost_engine
+
+    def cache_get(self, key):
+        with self.cache_lock:
+            hit = self.cache.get(key)
+            if hit is not None:
+                self.cache.move_to_end(key)
+            return hit
+
+    def cache_put(self, key, value):
+        with self.cache_lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > TENANT_CACHE_MAX_ENTRIES:
+                self.cache.popitem(last=False)
+
+    def immutable_get(self, key, default=None):
+        with self.cache_lock:
+            if key not in self.immutable:
+                return default
+            self.immutable.move_to_end(key)
+            return self.immutable[key]
+
+    def immutable_put(self, key, value):
+        with self.cache_lock:
+            self.immutable[key] = value
+            self.immutable.move_to_end(key)
+            while len(self.immutable) > TENANT_CACHE_MAX_ENTRIES:
+                self.immutable.popitem(last=False)
+
+    def evict(self):
+        """Drop every cached structure; the next request rebuilds from the files."""
+        with self.cache_lock:
+            self.cache.clear()
+            self.immutable.clear()
+            self.low_stock = LowStockIndex()
+            # Keep the cost engine while a posting is in flight.
+            if self.journal_write_lock.acquire(blocking=False):
+                try:
+                    self._cost_engine = None
+                finally:
+                    self.journal_write_lock.release()
+        logger.info(f"Evicted caches of idle tenant '{self.name}'")
+
+
+_tenants = {}
+_tenants_lock = threading.Lock()
+_tenant_local = threading.local()
+_last_tenant_sweep = [0.0]
+
+
+def _reset_tenants_after_fork():
+    # Report pool workers are forked; a lock held by another thread at fork
+    # time would never be released in the child, so start from fresh tenants.
+    global _tenants_lock
+    _tenants_lock = threading.Lock()
+    _tenants.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_tenants_after_fork)
+
+
+def _tenant_data_dir(name):
+    if name == DEFAULT_TENANT:
+        return DATA_DIR
+    return os.path.join(TENANTS_DIR, name)
+
+
+def get_tenant(name):
+    """Return the Tenant for name, creating it (and its data directory) on first use."""
+    if not name or not TENANT_NAME_RE.fullmatch(name):
+        raise ValueError(f"Invalid tenant name: {name!r}")
+    with _tenants_lock:
+        tenant = _tenants.get(name)
+        if tenant is None:
+            data_dir = _tenant_data_dir(name)
+            os.makedirs(data_dir, exist_ok=True)
+            tenant = _tenants[name] = Tenant(name, data_dir)
+    _sweep_idle_tenants()
+    return tenant
+
+
+def _sweep_idle_tenants():
+    now = time.monotonic()
+    with _tenants_lock:
+        if now - _last_tenant_sweep[0] < 60:
+            return
+        _last_tenant_sweep[0] = now
+        idle = [tenant for tenant in _tenants.values()
+                if now - tenant.last_used > TENANT_IDLE_SECONDS and (tenant.cache or tenant.immutable)]
+    for tenant in idle:
+        tenant.evict()
+
+
+def current_tenant():
+    """The tenant bound to this thread (tenant_context) or request (session), else the default store."""
+    tenant = getattr(_tenant_local, 'tenant', None)
+    if tenant is None:
+        name = session.get('tenant') if has_request_context() else None
+        tenant = get_tenant(name or DEFAULT_TENANT)
+    tenant.last_used = time.monotonic()
+    return tenant
+
+
+@contextmanager
+def tenant_context(tenant):
+    """Bind tenant (a Tenant or a name) to the current thread, e.g. for CLI commands and workers."""
+    if not isinstance(tenant, Tenant):
+        tenant = get_tenant(tenant)
+    previous = getattr(_tenant_local, 'tenant', None)
+    _tenant_local.tenant = tenant
     try:
-        target_date = tanggal
-        if isinstance(tanggal, datetime):
-            target_date = tanggal.strftime('%Y-%m-%d')
-    except Exception:
-        target_date = str(tanggal)
+        yield tenant
+    finally:
+        _tenant_local.tenant = previous
 
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if not row or len(row) < 5:
-            continue
-        existing_date = _normalize_excel_date(row[0])
-        if existing_date != target_date:
-            continue
-        existing_keterangan = (row[1] or '').strip()
-        existing_akun = (row[2] or '').strip()
-        if existing_keterangan != (keterangan or '').strip():
-            continue
-        if existing_akun != (akun or '').strip():
-            continue
 
-        existing_debit = float(row[3] or 0.0)
-        existing_kredit = float(row[4] or 0.0)
-        if abs(existing_debit - float(debit or 0.0)) < 0.01 and abs(existing_kredit - float(kredit or 0.0)) < 0.01:
-            return True
-    return False
+def _file_signature(path):
+    """Return (mtime_ns, size) of path, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+
+def save_workbook(wb, path):
+    """Save wb to path and remember the resulting signature as the app's own write."""
+    wb.save(path)
+    current_tenant().own_writes[path] = _file_signature(path)
+
+
+def _cached(key, paths, loader):
+    """Return loader() result, reusing the cached value while paths are unchanged.
+
+    Cached values are shared between requests and must be treated as read-only.
+    """
+    tenant = current_tenant()
+    signature = tuple(_file_signature(path) for path in paths)
+    hit = tenant.cache_get(key)
+    if hit is not None and hit[0] == signature:
+        return hit[1]
+    value = loader()
+    tenant.cache_put(key, (signature, value))
+    return value
+
+
+# Columnar sidecars: each normalized table parsed from an xlsx file is also
+# stored next to it as a hidden .npz (one typed array per column), stamped with
+# the source's mtime/size and SHA-256. A fresh sidecar loads in milliseconds
+# instead of re-parsing zipped XML; any external edit changes the stamp and the
+# table is re-parsed and the sidecar rewritten.
+SIDECAR_VERSION = 5
+
+
+def _sidecar_path(path, table):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.{table}.cache.npz')
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _to_columns(records, schema):
+    columns = {}
+    for name, kind in schema.items():
+        values = [record.get(name) for record in records]
+        if kind == 'int':
+            columns[name] = np.array([int(v or 0) for v in values], dtype=np.int64)
+        elif kind == 'float':
+            columns[name] = np.array([float(v or 0) for v in values], dtype=np.float64)
+        elif kind == 'bool':
+            columns[name] = np.array([bool(v) for v in values], dtype=np.bool_)
+        elif kind == 'date':
+            columns[name] = np.array([v.isoformat() if v else '' for v in values], dtype=np.str_)
+        else:
+            columns[name] = np.array(['' if v is None else str(v) for v in values], dtype=np.str_)
+    return columns
+
+
+def _from_columns(data, schema):
+    decoded = {}
+    for name, kind in schema.items():
+        column = data[name]
+        if kind == 'date':
+            decoded[name] = [datetime.strptime(v, '%Y-%m-%d').date() if v else None for v in column.tolist()]
+        elif kind == 'optstr':
+            decoded[name] = [v or None for v in column.tolist()]
+        else:
+            decoded[name] = column.tolist()
+    count = len(next(iter(decoded.values()))) if decoded else 0
+    return [{name: decoded[name][i] for name in schema} for i in range(count)]
+
+
+def _write_sidecar(sidecar, records, schema, signature, sha256):
+    arrays = _to_columns(records, schema)
+    arrays['__meta__'] = np.array([SIDECAR_VERSION, signature[0], signature[1]], dtype=np.int64)
+    arrays['__sha256__'] = np.array([sha256])
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as fh:
+            np.savez(fh, **arrays)
+        os.replace(tmp_path, sidecar)
+    except OSError as e:
+        logger.warning(f"Could not write sidecar cache {sidecar}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _sidecar_table(path, table, schema, parse):
+    """Return parse() records for path, served from its columnar sidecar when fresh."""
+    signature = _file_signature(path)
+    if signature is None:
+        return parse()
+    sidecar = _sidecar_path(path, table)
+    sha256 = None
+    try:
+        with np.load(sidecar, allow_pickle=False) as data:
+            version, mtime_ns, size = data['__meta__'].tolist()
+            if version == SIDECAR_VERSION and set(schema) <= set(data.files):
+                if (mtime_ns, size) == signature:
+                    return _from_columns(data, schema)
+                # Touched but maybe not changed (copied, re-saved unchanged): compare content.
+                if size == signature[1]:
+                    sha256 = _file_sha256(path)
+                    if sha256 == str(data['__sha256__'][0]):
+                        records = _from_columns(data, schema)
+                        _write_sidecar(sidecar, records, schema, signature, sha256)
+                        return records
+    except (OSError, KeyError, ValueError):
+        pass
+
+    # Hash before parsing so a concurrent edit can only make the stamp look stale, never fresh.
+    sha256 = sha256 or _file_sha256(path)
+    records = parse()
+    _write_sidecar(sidecar, records, schema, signature, sha256)
+    return records
+
+
+# Chart of accounts. Every report classifies accounts through this registry
+# (type, normal side, report section, contra flag) instead of testing code
+# prefixes and names per row. Codes missing from daftar_akun.csv are classified
+# once from their leading digit and memoized.
+ACCOUNT_TYPES_BY_PREFIX = {
+    '1': ('Aset', 'Debit', 'posisi_keuangan', 'Aset Lancar'),
+    '2': ('Kewajiban', 'Kredit', 'posisi_keuangan', 'Kewajiban'),
+    '3': ('Ekuitas', 'Kredit', 'posisi_keuangan', 'Modal Awal'),
+    '4': ('Pendapatan', 'Kredit', 'laba_rugi', 'Pendapatan'),
+    '5': ('HPP', 'Debit', 'laba_rugi', 'Harga Pokok Penjualan'),
+    '6': ('Beban', 'Debit', 'laba_rugi', 'Beban'),
+}
+NOMINAL_ACCOUNT_TYPES = ('Pendapatan', 'HPP', 'Beban')
+
+
+class ChartOfAccounts:
+    """Account code -> precomputed classification, with O(1) lookups."""
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self._by_code = {}
+        for account in accounts:
+            self._by_code[account['kode']] = account
+            for alias in account['alias']:
+                self._by_code.setdefault(alias, account)
+        self._derived = {}
+
+    @staticmethod
+    def _make(kode, nama, tipe, saldo_normal, laporan, seksi, kontra, alias=()):
+        return {
+            'kode': kode,
+            'nama': nama,
+            'tipe': tipe,
+            'saldo_normal': saldo_normal,
+            'laporan': laporan,
+            'seksi': seksi,
+            'kontra': kontra,
+            'nominal': tipe in NOMINAL_ACCOUNT_TYPES or laporan == 'penutup',
+            'alias': tuple(alias),
+        }
+
+    def get(self, no_akun, nama_akun=''):
+        account = self._by_code.get(no_akun)
+        if account is not None:
+            return account
+        key = (no_akun, nama_akun)
+        account = self._derived.get(key)
+        if account is None:
+            account = self._derive(no_akun, nama_akun)
+            self._derived[key] = account
+        return account
+
+    def _derive(self, no_akun, nama_akun):
+        nama_lower = (nama_akun or '').lower()
+        tipe, saldo_normal, laporan, seksi = ACCOUNT_TYPES_BY_PREFIX.get(
+            no_akun[:1], (None, 'Debit', None, None))
+        kontra = 'retur' in nama_lower or 'akumulasi penyusutan' in nama_lower
+        if kontra and tipe == 'Pendapatan':
+            seksi = 'Retur Penjualan'
+        if 'akumulasi penyusutan' in nama_lower:
+            seksi = 'Aset Tetap'
+        if 'laba bersih' in nama_lower:
+            tipe, laporan, seksi = 'Ekuitas', 'posisi_keuangan', 'Laba Bersih'
+        if kontra:
+            saldo_normal = 'Kredit' if saldo_normal == 'Debit' else 'Debit'
+        if tipe is None:
+            logger.warning(f"Account {no_akun} ({nama_akun}) is not in {current_tenant().chart_of_accounts_file} and cannot be classified")
+        return self._make(no_akun, nama_akun or no_akun, tipe, saldo_normal, laporan, seksi, kontra)
+
+    def options(self):
+        """'kode - nama' strings for accounts users may post to."""
+        return [f"{a['kode']} - {a['nama']}" for a in self.accounts if a['laporan'] != 'penutup']
+
+
+def _read_chart_of_accounts():
+    tenant = current_tenant()
+    accounts = []
+    try:
+        with open(tenant.chart_of_accounts_file, newline='', encoding='utf-8') as fh:
+            for row in csv.DictReader(fh):
+                kode = (row.get('kode') or '').strip()
+                if not kode:
+                    continue
+                accounts.append(ChartOfAccounts._make(
+                    kode,
+                    (row.get('nama') or kode).strip(),
+                    (row.get('tipe') or '').strip() or None,
+                    (row.get('saldo_normal') or 'Debit').strip(),
+                    (row.get('laporan') or '').strip() or None,
+                    (row.get('seksi') or '').strip() or None,
+                    (row.get('kontra') or '').strip() in ('1', 'true', 'ya'),
+                    [alias.strip() for alias in (row.get('alias') or '').split(';') if alias.strip()],
+                ))
+    except FileNotFoundError:
+        logger.error(f"Chart of accounts file not found: {tenant.chart_of_accounts_file}")
+    except Exception as e:
+        logger.error(f"Error loading chart of accounts from {tenant.chart_of_accounts_file}: {e}")
+    return ChartOfAccounts(accounts)
+
+
+def chart_of_accounts():
+    return _cached('chart_of_accounts', [current_tenant().chart_of_accounts_file], _read_chart_of_accounts)
+
+
+# Journal sheet layout. Every line carries a permanent ID (column F) so links
+# stay valid when other rows move, and deletes only stamp column G; readers skip
+# stamped rows and compact_journal() removes them physically later. Column H
+# holds the voucher that groups all lines of one posting.
+JOURNAL_HEADERS = ['Tanggal', 'Keterangan', 'Akun', 'Debit', 'Kredit', 'ID', 'Dihapus', 'Voucher']
+JOURNAL_COL_ID = 6
+JOURNAL_COL_DELETED = 7
+JOURNAL_COL_VOUCHER = 8
+
+# Stock movements caused by a voucher live next to the journal lines in the same
+# workbook, so a posting and its movements are saved together.
+STOCK_MOVEMENT_SHEET = 'Mutasi Stok'
+JOURNAL_SCHEMA = {
+    'row_index': 'int', 'entry_id': 'str', 'voucher': 'optstr', 'tanggal': 'date',
+    'keterangan': 'optstr', 'akun': 'str', 'no_akun': 'str', 'nama_akun': 'str',
+    'debit': 'int', 'kredit': 'int',
+}
+STOCK_MOVEMENT_SCHEMA = {
+    'row_index': 'int', 'tanggal': 'str', 'voucher': 'str', 'item_code': 'str', 'item_name': 'str',
+    'qty': 'int', 'unit_cost': 'float', 'balance_qty': 'int', 'balance_cost': 'float',
+}
+INVENTORY_SCHEMA = {
+    'item_code': 'str', 'name': 'str', 'stock': 'int', 'cost_price': 'int', 'avg_cost': 'float',
+    'selling_price': 'int', 'gross_profit': 'int', 'is_stock': 'bool', 'cost_price_stock': 'int',
+    'selling_price_stock': 'int', 'selling_price_total': 'int', 'cost_price_total': 'int',
+    'reorder_point': 'int', 'sheet_row': 'int',
+}
+OPENING_BALANCE_SCHEMA = {'no_akun': 'str', 'nama_akun': 'str', 'side': 'str', 'debit': 'int', 'kredit': 'int'}
+
+STOCK_MOVEMENT_HEADERS = ['Tanggal', 'Voucher', 'Kode Barang', 'Nama Barang', 'Qty', 'Dibatalkan',
+                          'Harga Satuan', 'Saldo Qty', 'Saldo Harga Rata-rata']
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get('SIA_JOURNAL_COMPACT_THRESHOLD', '50'))
+
+
+# Closed fiscal years are moved out of jurnal.xlsx into jurnal_<tahun>.xlsx so
+# postings only rewrite the small file for the open year and reports for a
+# past year parse only that year's archive.
+JOURNAL_ARCHIVE_RE = re.compile(r'jurnal_(\d{4})\.xlsx')
+
+
+def _journal_archive_path(tahun):
+    return os.path.join(current_tenant().data_dir, f'jurnal_{tahun}.xlsx')
+
+
+def archived_journal_years():
+    try:
+        names = os.listdir(current_tenant().data_dir)
+    except OSError:
+        return []
+    return sorted(match.group(1) for match in map(JOURNAL_ARCHIVE_RE.fullmatch, names) if match)
+
+
+def journal_paths():
+    """Every journal file, archives first (oldest year first) and the hot file last."""
+    return [_journal_archive_path(year) for year in archived_journal_years()] + [current_tenant().journal_file]
+
+
+def journal_file_for(tahun):
+    """Resolve the journal file holding tahun: its archive if archived, else the hot file."""
+    if tahun and str(tahun) in archived_journal_years():
+        return _journal_archive_path(tahun)
+    return current_tenant().journal_file
+
+
+def _new_entry_ids(count):
+    """Return count time-ordered journal IDs (fixed-width hex, so they also sort by age)."""
+    base = time.time_ns()
+    suffix = secrets.token_hex(2)
+    return [f"{base + offset:016x}{suffix}" for offset in range(count)]
+
+
+def _is_tombstoned(row):
+    return len(row) >= JOURNAL_COL_DELETED and bool(row[JOURNAL_COL_DELETED - 1])
+
+
+def _ensure_journal_layout(ws):
+    """Write missing headers and backfill IDs for legacy rows. Returns True if ws changed."""
+    changed = False
+    for col, header in enumerate(JOURNAL_HEADERS, start=1):
+        if ws.cell(row=1, column=col).value in (None, ''):
+            ws.cell(row=1, column=col, value=header)
+            changed = True
+
+    missing = [
+        row_idx for row_idx in range(2, ws.max_row + 1)
+        if ws.cell(row=row_idx, column=3).value and not ws.cell(row=row_idx, column=JOURNAL_COL_ID).value
+    ]
+    for row_idx, entry_id in zip(missing, _new_entry_ids(len(missing))):
+        ws.cell(row=row_idx, column=JOURNAL_COL_ID, value=entry_id)
+    if missing:
+        logger.info(f"Assigned permanent IDs to {len(missing)} legacy journal rows")
+    return changed or bool(missing)
+
+
+def _open_journal_workbook(path=None):
+    """Open (creating if needed) the journal workbook with its layout ensured.
+
+    Callers must hold the tenant's journal_write_lock and save the workbook themselves.
+    """
+    tenant = current_tenant()
+    path = path or tenant.journal_file
+    tenant.activity.begin(path)
+    if os.path.exists(path):
+        wb = openpyxl.load_workbook(path)
+    else:
+        wb = openpyxl.Workbook()
+        wb.active.title = 'Journal'
+    if 'Journal' in wb.sheetnames:
+        ws = wb['Journal']
+    else:
+        ws = wb.create_sheet('Journal')
+    _ensure_journal_layout(ws)
+    return wb, ws
+
+
+def _new_voucher_id():
+    return f"V{datetime.now():%Y%m%d}-{secrets.token_hex(3).upper()}"
+
+
+def _append_journal_row(ws, tanggal, keterangan, akun, debit, kredit, entry_id=None, voucher_id=None):
+    """Append one journal line (debit/kredit in int sen) and return its permanent ID."""
+    entry_id = entry_id or _new_entry_ids(1)[0]
+    ws.append([tanggal, keterangan, akun, from_sen(debit), from_sen(kredit), entry_id, None, voucher_id])
+    current_tenant().activity.stage_posting({
+        'entry_id': entry_id,
+        'voucher': voucher_id,
+        'tanggal': _normalize_excel_date(tanggal),
+        'keterangan': keterangan or '',
+        'akun': akun,
+        'debit': debit,
+        'kredit': kredit,
+    })
+    return entry_id
+
+
+def _stock_movement_sheet(wb):
+    if STOCK_MOVEMENT_SHEET not in wb.sheetnames:
+        wb.create_sheet(STOCK_MOVEMENT_SHEET)
+    ws = wb[STOCK_MOVEMENT_SHEET]
+    for col, header in enumerate(STOCK_MOVEMENT_HEADERS, start=1):
+        if ws.cell(row=1, column=col).value in (None, ''):
+            ws.cell(row=1, column=col, value=header)
+    return ws
+
+
+def _append_stock_movement(wb, tanggal, voucher_id, item_code, item_name, qty, unit_cost, position):
+    """Record a signed stock movement (negative = keluar) belonging to voucher_id.
+
+    position is the cost engine state after the movement, stored so the stock
+    card can be rendered without replaying history.
+    """
+    _stock_movement_sheet(wb).append([
+        tanggal, voucher_id, item_code, item_name, qty, None,
+        unit_cost, position['qty'], position['avg_cost'],
+    ])
+    current_tenant().activity.stage_movement({
+        'voucher': voucher_id,
+        'tanggal': _normalize_excel_date(tanggal),
+        'item_code': item_code,
+        'item_name': item_name,
+        'qty': qty,
+    })
+
+
+# The dashboard shows the latest postings and stock movements from two ring
+# buffers. Writers stage what they append and commit it after the save; any
+# other change to jurnal.xlsx (voids, compaction, another worker, Excel) moves
+# its signature away from the one the buffers reflect, and the next read
+# rebuilds them from the tail of the journal.
+RECENT_ACTIVITY_SIZE = 20
+
+
+class RecentActivity:
+    def __init__(self, size=RECENT_ACTIVITY_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.postings = deque(maxlen=size)
+        self.movements = deque(maxlen=size)
+        self.signature = None
+        # Staged by the writer holding the tenant's journal_write_lock.
+        self._base = None
+        self._pending_postings = []
+        self._pending_movements = []
+
+    def begin(self, path):
+        """Start a write to path: drop anything staged by a write that never saved."""
+        self._base = _file_signature(path)
+        self._pending_postings = []
+        self._pending_movements = []
+
+    def stage_posting(self, posting):
+        self._pending_postings.append(posting)
+
+    def stage_movement(self, movement):
+        self._pending_movements.append(movement)
+
+    def commit(self, path):
+        """Publish the staged rows once path (the hot journal) has been saved; returns them."""
+        postings, movements = self._pending_postings, self._pending_movements
+        with self.lock:
+            fresh = self.signature is not None and self.signature == self._base
+            self.postings.extend(postings)
+            self.movements.extend(movements)
+            self.signature = _file_signature(path) if fresh else None
+        self._pending_postings = []
+        self._pending_movements = []
+        return postings, movements
+
+    def _rebuild(self, path, signature):
+        self.postings = deque(({
+            'entry_id': entry['entry_id'],
+            'voucher': entry['voucher'],
+            'tanggal': entry['tanggal'].strftime('%Y-%m-%d') if entry['tanggal'] else '',
+            'keterangan': entry['keterangan'] or '',
+            'akun': entry['akun'],
+            'debit': entry['debit'],
+            'kredit': entry['kredit'],
+        } for entry in _load_journal_file(path)[-self.size:]), maxlen=self.size)
+        movements = _cached(('stock_movements', path), [path], lambda: _sidecar_table(
+            path, 'movements', STOCK_MOVEMENT_SCHEMA, lambda: _read_stock_movements(path)))
+        self.movements = deque(({
+            'voucher': movement['voucher'],
+            'tanggal': movement['tanggal'],
+            'item_code': movement['item_code'],
+            'item_name': movement['item_name'],
+            'qty': movement['qty'],
+        } for movement in movements[-self.size:]), maxlen=self.size)
+        self.signature = signature
+
+    def snapshot(self):
+        """(postings, movements), oldest first, rebuilt first if jurnal.xlsx changed behind our back."""
+        path = current_tenant().journal_file
+        signature = _file_signature(path)
+        with self.lock:
+            if signature is None or signature != self.signature:
+                self._rebuild(path, signature)
+            return list(self.postings), list(self.movements)
+
+
+# Open dashboard/inventory pages subscribe to /stream (Server-Sent Events) and
+# patch themselves from the deltas published when a write commits, instead of
+# reloading and reparsing the workbooks.
+SSE_QUEUE_SIZE = 100
+SSE_KEEPALIVE_SECONDS = 15
+
+
+class EventBroker:
+    """Fan-out of committed changes to the open /stream connections of one tenant."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.sequence = 0
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def is_subscribed(self, subscriber):
+        with self.lock:
+            return subscriber in self.subscribers
+
+    def has_subscribers(self):
+        return bool(self.subscribers)
+
+    def publish(self, event, data):
+        with self.lock:
+            self.sequence += 1
+            message = (self.sequence, event, data)
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    # A client that stopped reading is dropped; it reloads on reconnect.
+                    self.subscribers.discard(subscriber)
+
+
+def _journal_committed(tenant, path):
+    """Publish the rows a write just saved to the dashboard buffers and the event stream."""
+    postings, movements = tenant.activity.commit(path)
+    if not tenant.events.has_subscribers():
+        return
+    if postings:
+        tenant.events.publish('journal', {'lines': money_json(postings, ('debit', 'kredit'))})
+    if movements:
+        tenant.events.publish('stock_movement', {'movements': movements})
+    tenant.events.publish('totals', money_json(inventory_totals(load_inventory()),
+                                               ('total_inventory_value', 'total_gross_profit')))
+
+
+def migrate_journal_ids():
+    """Backfill IDs for rows written before the ID column existed."""
+    tenant = current_tenant()
+    if not os.path.exists(tenant.journal_file):
+        return
+    with tenant.journal_write_lock:
+        wb = openpyxl.load_workbook(tenant.journal_file)
+        if 'Journal' in wb.sheetnames and _ensure_journal_layout(wb['Journal']):
+            save_workbook(wb, tenant.journal_file)
+
+
+def _count_tombstones(ws):
+    return sum(
+        1 for (value,) in ws.iter_rows(min_row=2, min_col=JOURNAL_COL_DELETED,
+                                       max_col=JOURNAL_COL_DELETED, values_only=True)
+        if value
+    )
+
+
+def compact_journal():
+    """Physically remove tombstoned journal rows. Returns the number removed."""
+    tenant = current_tenant()
+    with tenant.journal_write_lock:
+        if not os.path.exists(tenant.journal_file):
+            return 0
+        wb, ws = _open_journal_workbook()
+        rows = list(ws.iter_rows(min_row=2, values_only=True))
+        kept = [row for row in rows if not _is_tombstoned(row)]
+        removed = len(rows) - len(kept)
+        if removed:
+            ws.delete_rows(2, ws.max_row)
+            for row in kept:
+                ws.append(list(row))
+            save_workbook(wb, tenant.journal_file)
+        logger.info(f"Journal compaction removed {removed} tombstoned rows")
+        return removed
+
+
+def _run_compaction(tenant):
+    try:
+        with tenant_context(tenant):
+            compact_journal()
+    except Exception as e:
+        logger.error(f"Journal compaction failed for tenant '{tenant.name}': {e}")
+    finally:
+        tenant.compaction_running.clear()
+
+
+def _maybe_schedule_compaction(tombstones):
+    tenant = current_tenant()
+    if tombstones < JOURNAL_COMPACT_THRESHOLD or tenant.compaction_running.is_set():
+        return
+    tenant.compaction_running.set()
+    threading.Thread(target=_run_compaction, args=(tenant,), name='sia-journal-compaction', daemon=True).start()
+
+
+def _move_rows(src_ws, dst_ws, predicate):
+    """Move data rows matching predicate from src_ws to the end of dst_ws. Returns the count."""
+    rows = list(src_ws.iter_rows(min_row=2, values_only=True))
+    moved = [row for row in rows if row and predicate(row)]
+    if not moved:
+        return 0
+    kept = [row for row in rows if not (row and predicate(row))]
+    src_ws.delete_rows(2, src_ws.max_row)
+    for row in kept:
+        src_ws.append(list(row))
+    for row in moved:
+        dst_ws.append(list(row))
+    return len(moved)
+
+
+def archive_journal_year(tahun):
+    """Move a closed year's journal lines and stock movements from jurnal.xlsx to its archive.
+
+    The year must be closed (Desember locked) and must not be the current year.
+    Returns (lines_moved, movements_moved).
+    """
+    tenant = current_tenant()
+    tahun = str(tahun)
+    if int(tahun) >= datetime.today().year:
+        raise ValueError(f"Tahun {tahun} masih berjalan dan tidak dapat diarsipkan.")
+    if f"{tahun}-12" not in _locked_periods():
+        raise ValueError(f"Tahun {tahun} belum ditutup (Desember {tahun} belum dikunci).")
+
+    def in_year(row):
+        period = _date_period(row[0])
+        return bool(period) and period[:4] == tahun
+
+    archive_path = _journal_archive_path(tahun)
+    with tenant.journal_write_lock:
+        hot_wb, hot_ws = _open_journal_workbook()
+        archive_wb, archive_ws = _open_journal_workbook(archive_path)
+        lines_moved = _move_rows(hot_ws, archive_ws, in_year)
+        movements_moved = _move_rows(_stock_movement_sheet(hot_wb), _stock_movement_sheet(archive_wb), in_year)
+        # Archive first: if saving the hot file fails the rows exist twice, never zero times.
+        save_workbook(archive_wb, archive_path)
+        save_workbook(hot_wb, tenant.journal_file)
+    logger.info(f"Archived {lines_moved} journal lines and {movements_moved} stock movements of {tahun} to {archive_path}")
+    return lines_moved, movements_moved
+
+
+@app.cli.command('arsip-jurnal')
+@click.argument('tahun')
+@click.option('--toko', default=DEFAULT_TENANT, help='Tenant (toko) yang jurnalnya diarsipkan.')
+def arsip_jurnal_command(tahun, toko):
+    """Pindahkan jurnal tahun buku yang sudah ditutup ke jurnal_<tahun>.xlsx."""
+    with tenant_context(toko):
+        lines_moved, movements_moved = archive_journal_year(tahun)
+    click.echo(f"{lines_moved} baris jurnal dan {movements_moved} mutasi stok tahun {tahun} diarsipkan.")
 
 # User model
 class User(db.Model):
@@ -124,6 +965,46 @@ class User(db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     hashed_password = db.Column(db.String(200), nullable=False)
 
+# Maps a user to the store (tenant) whose data directory they work in.
+# Users without an assignment work in the default store.
+class TenantAssignment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    tenant = db.Column(db.String(64), nullable=False)
+
+# Databases created before tenants existed lack the assignment table;
+# create missing tables at startup, not only via `python sia.py`/set-toko.
+with app.app_context():
+    try:
+        db.create_all()
+    except SQLAlchemyError as e:
+        logger.error(f"Cannot create database tables: {e}")
+
+def tenant_for_user(username):
+    try:
+        assignment = TenantAssignment.query.filter_by(username=username).first()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(f"Cannot read tenant assignment for {username}, using default store: {e}")
+        return DEFAULT_TENANT
+    return assignment.tenant if assignment else DEFAULT_TENANT
+
+@app.cli.command('set-toko')
+@click.argument('username')
+@click.argument('toko')
+def set_toko_command(username, toko):
+    """Hubungkan user ke toko (tenant) dengan direktori data sendiri."""
+    get_tenant(toko)
+    db.create_all()
+    assignment = TenantAssignment.query.filter_by(username=username).first()
+    if assignment is None:
+        assignment = TenantAssignment(username=username, tenant=toko)
+        db.session.add(assignment)
+    else:
+        assignment.tenant = toko
+    db.session.commit()
+    click.echo(f"User {username} sekarang memakai data toko '{toko}'.")
+
 def safe_float(value):
     """Convert value to float safely"""
     try:
@@ -133,6 +1014,52 @@ def safe_float(value):
     except (ValueError, TypeError):
         return 0.0
 
+def to_sen(value):
+    """Convert a Rupiah amount to int sen (1/100 Rupiah), rounding half up. Invalid input gives 0.
+
+    Money is kept as int sen everywhere so totals are exact and balance checks
+    need no epsilon; only display and the numbers written back to workbooks
+    are converted back to Rupiah.
+    """
+    if value is None or value == '':
+        return 0
+    try:
+        return int((Decimal(str(value)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError, TypeError):
+        return 0
+
+
+def from_sen(sen):
+    """Rupiah value of an int sen amount for workbooks and JSON: an int when whole, else 2 decimals."""
+    sen = int(sen or 0)
+    if sen % 100 == 0:
+        return sen // 100
+    return float(Decimal(sen) / 100)
+
+
+def money_json(value, keys):
+    """Copy of value (dicts/lists) with the int sen amounts under keys turned into Rupiah for JSON."""
+    if isinstance(value, dict):
+        converted = {}
+        for key, item in value.items():
+            if key not in keys:
+                converted[key] = money_json(item, keys)
+            elif isinstance(item, list):
+                converted[key] = [from_sen(amount) for amount in item]
+            else:
+                converted[key] = from_sen(item)
+        return converted
+    if isinstance(value, list):
+        return [money_json(item, keys) for item in value]
+    return value
+
+
+def _whole_rupiah(sen):
+    """int sen rounded half up (away from zero) to whole Rupiah, for display."""
+    sen = int(sen or 0)
+    rupiah = (abs(sen) + 50) // 100
+    return -rupiah if sen < 0 else rupiah
+
 def safe_int(value):
     """Convert value to int safely"""
     try:
@@ -148,37 +1075,34 @@ def parse_amount(value):
 
     Accepts strings like "1000000", "1.000.000", or "1,000,000.50".
     Dots are treated as thousand separators, comma as decimal separator.
-    Returns float amount in Rupiah.
+    Returns the amount in int sen.
     """
     if value is None:
-        return 0.0
+        return 0
     s = str(value).strip()
     if not s:
-        return 0.0
+        return 0
     # First remove thousand separators, then normalize decimal separator
     s = s.replace('.', '')
     s = s.replace(',', '.')
-    try:
-        return float(s)
-    except (ValueError, TypeError):
-        return 0.0
+    return to_sen(s)
 
 def format_rupiah(amount):
-    """Format number to Rupiah currency format"""
+    """Format an int sen amount to Rupiah currency format"""
     try:
         if amount == 0 or amount is None:
             return "Rp 0"
-        formatted = f"Rp {float(amount):,.0f}".replace(',', '.')
+        formatted = f"Rp {_whole_rupiah(amount):,}".replace(',', '.')
         return formatted
     except (ValueError, TypeError):
         return "Rp 0"
 
 def format_rupiah_for_report(amount):
-    """Format khusus untuk laporan keuangan"""
+    """Format khusus untuk laporan keuangan (amount in int sen)"""
     try:
         if amount is None or amount == 0:
             return "Rp 0"
-        result = f"Rp {int(amount):,}".replace(',', '.')
+        result = f"Rp {_whole_rupiah(amount):,}".replace(',', '.')
         return result
     except Exception:
         return "Rp 0"
@@ -189,16 +1113,91 @@ def safe_currency_filter(value):
     try:
         if value is None:
             return ""
-        val = float(value)
-        return f"Rp {val:,.0f}".replace(",", ".")
+        return f"Rp {_whole_rupiah(value):,}".replace(",", ".")
     except (ValueError, TypeError):
         return ""
 
+@app.template_filter('rupiah')
+def rupiah_filter(value):
+    """Render an int sen amount for reports; negatives as '-Rp 1.000'."""
+    amount = int(value or 0)
+    if amount < 0:
+        return '-' + format_rupiah_for_report(-amount)
+    return format_rupiah_for_report(amount)
+
+def _normalize_product_name(name):
+    return ' '.join(str(name or '').lower().split())
+
+
+class InventoryRepository:
+    """Lookup indexes over one load_inventory() result.
+
+    Hash indexes resolve item_code and normalized name in O(1). Typeahead
+    queries of one or two characters bisect a sorted list of word prefixes;
+    longer ones intersect trigram posting sets of "name code".
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.by_code = {}
+        self.by_name = {}
+        words = []
+        self.trigrams = {}
+        for pos, item in enumerate(items):
+            self.by_code.setdefault(item['item_code'], item)
+            name = _normalize_product_name(item['name'])
+            self.by_name.setdefault(name, item)
+            text = f"{name} {item['item_code'].lower()}"
+            for word in text.split():
+                words.append((word, pos))
+            for i in range(len(text) - 2):
+                self.trigrams.setdefault(text[i:i + 3], set()).add(pos)
+        words.sort()
+        self.words = words
+
+    def get(self, item_code):
+        return self.by_code.get(str(item_code or '').strip().upper())
+
+    def find_by_name(self, name):
+        return self.by_name.get(_normalize_product_name(name))
+
+    def search(self, q, limit=20):
+        q = _normalize_product_name(q)
+        if not q:
+            return self.items[:limit]
+        if len(q) < 3:
+            start = bisect_left(self.words, (q, -1))
+            positions = set()
+            for word, pos in self.words[start:]:
+                if not word.startswith(q):
+                    break
+                positions.add(pos)
+        else:
+            postings = [self.trigrams.get(q[i:i + 3], set()) for i in range(len(q) - 2)]
+            positions = set.intersection(*sorted(postings, key=len))
+            positions = {pos for pos in positions
+                         if q in f"{_normalize_product_name(self.items[pos]['name'])} {self.items[pos]['item_code'].lower()}"}
+        # Names starting with the query first, then alphabetical.
+        ranked = sorted(positions, key=lambda pos: (not _normalize_product_name(self.items[pos]['name']).startswith(q),
+                                                    _normalize_product_name(self.items[pos]['name'])))
+        return [self.items[pos] for pos in ranked[:limit]]
+
+
+def inventory_repository():
+    return _cached('inventory_repository', [current_tenant().inventory_file], lambda: InventoryRepository(load_inventory()))
+
+
 def load_inventory():
     """Membaca data inventory dari file Excel dengan struktur yang benar"""
+    tenant = current_tenant()
+    return _cached('inventory', [tenant.inventory_file],
+                   lambda: _sidecar_table(tenant.inventory_file, 'inventory', INVENTORY_SCHEMA, _read_inventory))
+
+
+def _read_inventory():
     try:
         # Baca file Excel
-        excel_file = INVENTORY_FILE
+        excel_file = current_tenant().inventory_file
         df = pd.read_excel(excel_file, sheet_name='Inventory')
 
         inventory_data = []
@@ -224,39 +1223,32 @@ def load_inventory():
                 assigned_codes.add(item_code)
 
             stock = int(row['Stock Remaining']) if not pd.isna(row['Stock Remaining']) else 0
-            cost_price_unit = float(row['Price']) if not pd.isna(row['Price']) else 0.0
+            cost_price_unit = to_sen(row['Price']) if not pd.isna(row['Price']) else 0
 
             # Ambil harga jual per unit dari kolom yang benar
-            selling_price_unit = 0.0
+            selling_price_unit = 0
             try:
                 if 'Harga Jual' in df.columns and not pd.isna(row['Harga Jual']):
-                    selling_price_unit = float(row['Harga Jual'])
+                    selling_price_unit = to_sen(row['Harga Jual'])
                 elif 'Unnamed: 8' in df.columns and not pd.isna(row['Unnamed: 8']):
                     # Di file saat ini, kolom terakhir (Unnamed: 8) berisi harga jual per unit
-                    selling_price_unit = float(row['Unnamed: 8'])
+                    selling_price_unit = to_sen(row['Unnamed: 8'])
             except Exception as e:
                 logger.warning(f"Error parsing selling price for row {index}: {e}")
-                selling_price_unit = 0.0
-
-            cost_total = cost_price_unit * stock
-            selling_total = selling_price_unit * stock
-            gross_profit_total = selling_total - cost_total
-            is_stock_flag = stock > 0
-
-            item_data = {
-                'item_code': item_code,
-                'name': str(row.iloc[1]) if not pd.isna(row.iloc[1]) else 'Unknown Product',
-                'stock': stock,
-                'cost_price': cost_price_unit,
-                'selling_price': selling_price_unit,
-                'gross_profit': gross_profit_total,
-                'is_stock': is_stock_flag,
-                'cost_price_stock': cost_total,
-                'selling_price_stock': selling_total,
-                'selling_price_total': selling_total,
-                'cost_price_total': cost_total
-            }
-            inventory_data.append(item_data)
+                selling_price_unit = 0
+
+            avg_cost_unit = cost_price_unit / 100
+            if INVENTORY_AVG_COST_HEADER in df.columns and not pd.isna(row[INVENTORY_AVG_COST_HEADER]):
+                avg_cost_unit = float(row[INVENTORY_AVG_COST_HEADER])
+
+            reorder_point = LOW_STOCK_THRESHOLD
+            if INVENTORY_REORDER_HEADER in df.columns and not pd.isna(row[INVENTORY_REORDER_HEADER]):
+                reorder_point = safe_int(row[INVENTORY_REORDER_HEADER])
+
+            name = str(row.iloc[1]) if not pd.isna(row.iloc[1]) else 'Unknown Product'
+            # Header is row 1, so DataFrame index i is sheet row i + 2.
+            inventory_data.append(_inventory_record(item_code, name, stock, cost_price_unit, selling_price_unit,
+                                                    avg_cost_unit, reorder_point, index + 2))
 
         logger.debug(f"Loaded {len(inventory_data)} inventory items from Excel")
         return inventory_data
@@ -265,15 +1257,68 @@ def load_inventory():
         logger.error(f"Excel file 'databasesia.xlsx' not found: {fnfe}")
         # Fallback data
         fallback = [
-            {'item_code': 'ITEM-001', 'name': 'Madu Multiflora', 'stock': 34, 'cost_price': 84000, 'selling_price': 105000, 'gross_profit': (105000-84000)*34, 'is_stock': False},
-            {'item_code': 'ITEM-002', 'name': 'Madu Klengkeng', 'stock': 19, 'cost_price': 100000, 'selling_price': 125000, 'gross_profit': (125000-100000)*19, 'is_stock': False},
-            {'item_code': 'ITEM-003', 'name': 'Kapuk Randu', 'stock': 22, 'cost_price': 96000, 'selling_price': 120000, 'gross_profit': (120000-96000)*22, 'is_stock': False},
+            _inventory_record('ITEM-001', 'Madu Multiflora', 34, 8400000, 10500000, 84000.0, LOW_STOCK_THRESHOLD, None),
+            _inventory_record('ITEM-002', 'Madu Klengkeng', 19, 10000000, 12500000, 100000.0, LOW_STOCK_THRESHOLD, None),
+            _inventory_record('ITEM-003', 'Kapuk Randu', 22, 9600000, 12000000, 96000.0, LOW_STOCK_THRESHOLD, None),
         ]
         return fallback
     except Exception as e:
         logger.error(f"Error reading Excel file: {e}")
         return []
 
+def _inventory_record(item_code, name, stock, cost_price_unit, selling_price_unit, avg_cost_unit, reorder_point, sheet_row):
+    cost_total = cost_price_unit * stock
+    selling_total = selling_price_unit * stock
+    return {
+        'item_code': item_code,
+        'name': name,
+        'stock': stock,
+        'cost_price': cost_price_unit,
+        'avg_cost': avg_cost_unit,
+        'selling_price': selling_price_unit,
+        'gross_profit': selling_total - cost_total,
+        'is_stock': stock > 0,
+        'cost_price_stock': cost_total,
+        'selling_price_stock': selling_total,
+        'selling_price_total': selling_total,
+        'cost_price_total': cost_total,
+        'reorder_point': reorder_point,
+        'sheet_row': sheet_row,
+    }
+
+
+def _inventory_record_from_cells(header, row, sheet_row):
+    """Inventory record from one raw Inventory sheet row, mirroring _read_inventory; None for rows it would not key by code."""
+    def cell(name):
+        if name not in header:
+            return None
+        index = header.index(name)
+        return row[index] if index < len(row) else None
+
+    raw_item_code = row[0] if row else None
+    if raw_item_code is None or str(raw_item_code).strip() == '' or str(raw_item_code).strip().lower() == 'no item':
+        return None
+    stock_cell = cell('Stock Remaining')
+    price_cell = cell('Price')
+    cost_price_unit = to_sen(price_cell) if price_cell is not None else 0
+    selling_cell = cell('Harga Jual')
+    if selling_cell is None and 'Harga Jual' not in header and len(header) > 8 and header[8] is None and len(row) > 8:
+        # pandas reads the unnamed ninth column as 'Unnamed: 8'.
+        selling_cell = row[8]
+    avg_cell = cell(INVENTORY_AVG_COST_HEADER)
+    reorder_cell = cell(INVENTORY_REORDER_HEADER)
+    return _inventory_record(
+        str(raw_item_code).strip().upper(),
+        str(row[1]) if len(row) > 1 and row[1] is not None else 'Unknown Product',
+        int(float(stock_cell)) if stock_cell is not None else 0,
+        cost_price_unit,
+        to_sen(selling_cell) if selling_cell is not None else 0,
+        float(avg_cell) if avg_cell is not None else cost_price_unit / 100,
+        safe_int(reorder_cell) if reorder_cell is not None else LOW_STOCK_THRESHOLD,
+        sheet_row,
+    )
+
+
 # Routes
 @app.route('/')
 def home():
@@ -291,55 +1336,105 @@ def inventory():
     logger.debug(f"Inventory data loaded with {len(inventory_data)} items.")
     return render_template('inventory.html', inventory_data=inventory_data, total_cost_price_stock=total_cost_price_stock)
 
+LOW_STOCK_THRESHOLD = 10
+
+
+def inventory_totals(inventory_data):
+    """Dashboard headline figures for an inventory list."""
+    return {
+        'total_inventory_value': sum(item['cost_price'] * item['stock'] for item in inventory_data),
+        'total_products': len(inventory_data),
+        'total_gross_profit': sum((item['selling_price'] - item['cost_price']) * item['stock'] for item in inventory_data),
+        'low_stock_count': sum(1 for item in inventory_data
+                               if item['stock'] < item.get('reorder_point', LOW_STOCK_THRESHOLD)),
+    }
+
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     """Route untuk dashboard dengan data real dari Excel"""
     inventory_data = load_inventory()
-    
-    total_inventory_value = sum(item['cost_price'] * item['stock'] for item in inventory_data)
-    total_products = len(inventory_data)
-    total_gross_profit = sum((item['selling_price'] - item['cost_price']) * item['stock'] for item in inventory_data)
-    
-    low_stock_items = [item for item in inventory_data if item['stock'] < 10]
-    low_stock_count = len(low_stock_items)
+    totals = inventory_totals(inventory_data)
+    low_stock_items = current_tenant().low_stock.top()
     
     try:
-        wb = openpyxl.load_workbook(JOURNAL_FILE)
-        ws = wb['Journal']
-        journal_entries = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if row[0] and len(row) >= 5:
-                journal_entries.append({
-                    'tanggal': row[0].strftime('%Y-%m-%d') if hasattr(row[0], 'strftime') else str(row[0]),
-                    'keterangan': row[1] if row[1] else '',
-                    'akun': row[2] if row[2] else '',
-                    'debit': float(row[3]) if row[3] else 0,
-                    'kredit': float(row[4]) if row[4] else 0
-                })
-        journal_entries = journal_entries[-5:]
+        postings, movements = current_tenant().activity.snapshot()
     except Exception as e:
-        logger.warning(f"Error loading journal entries: {e}")
-        journal_entries = [
-            {'tanggal': '2024-01-15', 'keterangan': 'Penjualan Madu Multiflora', 'akun': 'Penjualan', 'debit': 105000, 'kredit': 0},
-            {'tanggal': '2024-01-15', 'keterangan': 'Penjualan Madu Multiflora', 'akun': 'Kas', 'debit': 0, 'kredit': 105000},
-            {'tanggal': '2024-01-14', 'keterangan': 'Pembelian Botol', 'akun': 'Persediaan', 'debit': 3450000, 'kredit': 0},
-        ]
-    
+        logger.warning(f"Error loading recent activity: {e}")
+        postings, movements = [], []
+
+    journal_entries = postings[-5:]
     recent_activities = [
-        {'tanggal': '2024-01-15', 'produk': 'Madu Multiflora', 'jenis': 'Penambahan', 'qty': 50, 'keterangan': 'Restock dari supplier'},
-        {'tanggal': '2024-01-14', 'produk': 'Madu Klengkeng', 'jenis': 'Pengurangan', 'qty': 7, 'keterangan': 'Penjualan'},
-        {'tanggal': '2024-01-13', 'produk': 'Madu Hutan', 'jenis': 'Penambahan', 'qty': 20, 'keterangan': 'Restock'}
+        {
+            'tanggal': movement['tanggal'],
+            'produk': movement['item_name'],
+            'jenis': 'Penambahan' if movement['qty'] > 0 else 'Pengurangan',
+            'qty': abs(movement['qty']),
+            'keterangan': f"{'Pembelian' if movement['qty'] > 0 else 'Penjualan'} ({movement['voucher']})",
+        }
+        for movement in reversed(movements[-5:])
     ]
     
     return render_template('dashboard.html', 
                          journal_entries=journal_entries,
                          recent_activities=recent_activities,
-                         total_inventory_value=total_inventory_value,
-                         total_products=total_products,
-                         total_gross_profit=total_gross_profit,
+                         total_inventory_value=totals['total_inventory_value'],
+                         total_products=totals['total_products'],
+                         total_gross_profit=totals['total_gross_profit'],
                          low_stock_items=low_stock_items,
-                         low_stock_count=low_stock_count)
+                         low_stock_count=totals['low_stock_count'])
+
+
+@app.route('/api/products')
+@login_required
+def api_products():
+    """Typeahead for the transaction form: ?q= matches name or item code."""
+    limit = min(safe_int(request.args.get('limit', 20)) or 20, 100)
+    items = inventory_repository().search(request.args.get('q', ''), limit)
+    return jsonify({'items': [{
+        'item_code': item['item_code'],
+        'name': item['name'],
+        'stock': item['stock'],
+        'selling_price': from_sen(item['selling_price']),
+        'avg_cost': item['avg_cost'],
+    } for item in items]})
+
+
+@app.route('/api/low_stock')
+@login_required
+def api_low_stock():
+    """Items below their reorder point, most urgent (fewest days of cover) first."""
+    limit = safe_int(request.args.get('limit', 20)) or None
+    return jsonify({'items': current_tenant().low_stock.top(limit)})
+
+
+@app.route('/stream')
+@login_required
+def stream():
+    """Server-Sent Events: journal lines, stock changes, low-stock alerts and totals as they commit, and external workbook edits."""
+    broker = current_tenant().events
+    subscriber = broker.subscribe()
+
+    def generate():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    sequence, event, data = subscriber.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    if not broker.is_subscribed(subscriber):
+                        # Dropped for falling behind: tell the page to reload once.
+                        yield "event: reset\ndata: {}\n\n"
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {sequence}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -372,15 +1467,168 @@ def login():
         user = User.query.filter_by(username=username).first()
         if user and check_password_hash(user.hashed_password, password):
             session['user'] = username
+            session['tenant'] = tenant_for_user(username)
             return redirect(url_for('stock_card'))
         else:
             return render_template('login.html', error='Invalid credentials')
     return render_template('login.html')
 
+# Postings made before the 'Mutasi Stok' log existed only left journal lines
+# on the inventory account. For that history the stock card falls back to the
+# old replay: those lines are matched to a product by name in the keterangan
+# and converted to quantities at the product's Price.
+LEGACY_STOCK_ACCOUNTS = ('1-1300', 'persediaan barang dagang', 'persediaan madu')
+
+
+def _movements_by_item():
+    """Live stock movements grouped per item code, in posting order, legacy journal history first."""
+    def build():
+        index = {}
+        for movement in sorted(load_stock_movements(), key=lambda m: (m['tanggal'], m['row_index'])):
+            index.setdefault(movement['item_code'], []).append(movement)
+        logged_vouchers = {movement['voucher'] for movement in load_stock_movements()}
+        for item in load_inventory():
+            logged = index.get(item['item_code'], [])
+            legacy = _legacy_stock_movements(item, logged, logged_vouchers)
+            if legacy:
+                index[item['item_code']] = legacy + logged
+        return {code: {'movements': items, 'periods': [m['tanggal'][:7] for m in items]}
+                for code, items in index.items()}
+    return _cached('movements_by_item', journal_paths() + [current_tenant().inventory_file], build)
+
+
+def _legacy_stock_movements(item, logged, logged_vouchers):
+    """Pre-log movements of item replayed from inventory-account journal lines.
+
+    Balances are anchored backwards: the position just before the first logged
+    movement (or the saved stock when the item has no log) is the balance after
+    the last legacy line.
+    """
+    cost_price = item.get('cost_price') or 0
+    name = (item.get('name') or '').lower()
+    if not cost_price or not name:
+        return []
+    cutoff = logged[0]['tanggal'] if logged else None
+    legacy = []
+    for entry in load_journal_entries():
+        if entry['tanggal'] is None or (entry['voucher'] and entry['voucher'] in logged_vouchers):
+            continue
+        tanggal = entry['tanggal'].isoformat()
+        if cutoff and tanggal > cutoff:
+            continue
+        akun = (entry['akun'] or '').lower()
+        if not any(account in akun for account in LEGACY_STOCK_ACCOUNTS):
+            continue
+        if name not in (entry['keterangan'] or '').lower():
+            continue
+        amount = (entry['debit'] or 0) - (entry['kredit'] or 0)
+        if not amount:
+            continue
+        qty = amount / cost_price
+        legacy.append({
+            'row_index': entry['row_index'],
+            'tanggal': tanggal,
+            'voucher': entry['voucher'] or '',
+            'keterangan': entry['keterangan'],
+            'item_code': item['item_code'],
+            'item_name': item['name'],
+            'qty': int(qty) if float(qty).is_integer() else qty,
+            'unit_cost': cost_price / 100,
+            'balance_cost': cost_price / 100,
+        })
+    legacy.sort(key=lambda m: (m['tanggal'], m['row_index']))
+
+    balance = _position_before(logged[0])[0] if logged else safe_int(item.get('stock', 0))
+    for movement in reversed(legacy):
+        movement['balance_qty'] = balance
+        balance -= movement['qty']
+    return legacy
+
+
+def _position_before(movement):
+    """Cost position (qty, avg cost) immediately before a recorded movement."""
+    pre_qty = movement['balance_qty'] - movement['qty']
+    if movement['qty'] < 0 or pre_qty <= 0:
+        return pre_qty, movement['balance_cost'] if pre_qty > 0 else 0.0
+    pre_value = movement['balance_qty'] * movement['balance_cost'] - movement['qty'] * movement['unit_cost']
+    return pre_qty, pre_value / pre_qty
+
+
+def build_stock_card(item_code, period):
+    """Stock card rows for item_code in period 'YYYY-MM', from the movement log (and legacy journal history)."""
+    tahun, month_code = period.split('-')
+    return _period_cached(('stock_card', item_code, period), tahun, MONTH_NUM_TO_NAME[int(month_code)],
+                          journal_paths() + [current_tenant().inventory_file], lambda: _compute_stock_card(item_code, period))
+
+
+STOCK_CARD_MONEY_FIELDS = ('in_price', 'in_total', 'out_price', 'out_total', 'balance_price', 'balance_total')
+
+
+def _compute_stock_card(item_code, period):
+    rows = []
+    for line in _stock_card_lines(item_code, period):
+        row = dict(line)
+        for field in STOCK_CARD_MONEY_FIELDS:
+            row[field] = format_rupiah(row[field]) if row[field] is not None else ''
+        rows.append(row)
+    return rows
+
+
+def _stock_card_lines(item_code, period):
+    """Yield the stock card of item_code for 'YYYY-MM' with numeric quantities and int sen amounts."""
+    indexed = _movements_by_item().get(item_code, {'movements': [], 'periods': []})
+    movements = indexed['movements']
+    start = bisect_left(indexed['periods'], period)
+    end = bisect_right(indexed['periods'], period)
+
+    if start < len(movements):
+        balance_qty, balance_price = _position_before(movements[start])
+    elif movements:
+        balance_qty, balance_price = movements[-1]['balance_qty'], movements[-1]['balance_cost']
+    else:
+        position = current_tenant().cost_engine.position(item_code)
+        balance_qty, balance_price = position['qty'], position['avg_cost']
+
+    yield {
+        'date': 'Saldo Awal',
+        'description': 'Saldo awal persediaan',
+        'in_qty': balance_qty,
+        'in_price': to_sen(balance_price),
+        'in_total': to_sen(balance_qty * balance_price),
+        'out_qty': None,
+        'out_price': None,
+        'out_total': None,
+        'balance_qty': balance_qty,
+        'balance_price': to_sen(balance_price),
+        'balance_total': to_sen(balance_qty * balance_price)
+    }
+
+    vouchers = _voucher_index()
+    for movement in movements[start:end]:
+        lines = vouchers.get(movement['voucher'], {}).get('lines') or [{}]
+        qty = abs(movement['qty'])
+        total = qty * movement['unit_cost']
+        is_in = movement['qty'] > 0
+        yield {
+            'date': movement['tanggal'],
+            'description': movement.get('keterangan') or lines[0].get('keterangan') or movement['voucher'],
+            'in_qty': qty if is_in else None,
+            'in_price': to_sen(movement['unit_cost']) if is_in else None,
+            'in_total': to_sen(total) if is_in else None,
+            'out_qty': None if is_in else qty,
+            'out_price': None if is_in else to_sen(movement['unit_cost']),
+            'out_total': None if is_in else to_sen(total),
+            'balance_qty': movement['balance_qty'],
+            'balance_price': to_sen(movement['balance_cost']),
+            'balance_total': to_sen(movement['balance_qty'] * movement['balance_cost'])
+        }
+
+
 @app.route('/stock_card')
 @login_required
 def stock_card():
     inventory_data = load_inventory()
+    repository = inventory_repository()
     selected_product = request.args.get('product')
     tahun = request.args.get('tahun', '2025')
     bulan = request.args.get('bulan', 'November')
@@ -388,146 +1636,11 @@ def stock_card():
     item_code = ''
 
     try:
-        if selected_product and tahun == '2025' and bulan == 'November':
-
-            # ─────────────────────────────────────────────────────────────
-            # Ambil harga modal & saldo awal dari inventory
-            # ─────────────────────────────────────────────────────────────
-            cost_price = 0
-            initial_qty = 0
-
-            for item in inventory_data:
-                if item['name'] == selected_product:
-                    cost_price = item['cost_price']
-                    initial_qty = safe_int(item.get('stock', 0) or 0)
-                    item_code = item['item_code']
-                    break
-
-            # ─────────────────────────────────────────────────────────────
-            # Load jurnal
-            # ─────────────────────────────────────────────────────────────
-            try:
-                wb = openpyxl.load_workbook(JOURNAL_FILE)
-                ws = wb['Journal']
-                journal_entries = []
-                for row in ws.iter_rows(min_row=2, values_only=True):
-                    if row[0] and len(row) >= 5:
-                        journal_entries.append({
-                            'tanggal': row[0],
-                            'keterangan': row[1],
-                            'akun': row[2],
-                            'debit': row[3] if row[3] else 0,
-                            'kredit': row[4] if row[4] else 0
-                        })
-            except:
-                journal_entries = []
-
-            # ─────────────────────────────────────────────────────────────
-            # Saldo awal
-            # ─────────────────────────────────────────────────────────────
-            balance_qty = initial_qty
-            balance_price = cost_price
-            balance_total = balance_qty * balance_price
-
-            stock_card_data.append({
-                'date': 'Saldo Awal',
-                'description': 'Saldo awal persediaan',
-                'in_qty': initial_qty,
-                'in_price': format_rupiah(cost_price),
-                'in_total': format_rupiah(initial_qty * cost_price),
-                'out_qty': None,
-                'out_price': None,
-                'out_total': None,
-                'balance_qty': balance_qty,
-                'balance_price': format_rupiah(balance_price),
-                'balance_total': format_rupiah(balance_total)
-            })
-
-            # Daftar akun persediaan yang valid
-            valid_inventory_accounts = [
-                "1-1300",
-                "Persediaan Barang Dagang",
-                "Persediaan Madu"
-            ]
-
-            # ─────────────────────────────────────────────────────────────
-            # Proses jurnal
-            # ─────────────────────────────────────────────────────────────
-            for entry in journal_entries:
-
-                # Filter berdasarkan tahun & bulan
-                entry_date = str(entry['tanggal']).split('-')
-                if len(entry_date) < 2:
-                    continue
-                entry_year = entry_date[0]
-                entry_month = entry_date[1]
-
-                month_names = {
-                    '01': 'Januari', '02': 'Februari', '03': 'Maret', '04': 'April', '05': 'Mei', '06': 'Juni',
-                    '07': 'Juli', '08': 'Agustus', '09': 'September', '10': 'Oktober', '11': 'November', '12': 'Desember'
-                }
-
-                if entry_year != tahun or month_names.get(entry_month, '') != bulan:
-                    continue
-
-                # ─────────────────────────────────────────────────────────────
-                # Filter: hanya akun persediaan yang boleh mempengaruhi stok
-                # ─────────────────────────────────────────────────────────────
-                akun = entry['akun'].lower()
-
-                is_inventory_related = any(
-                    valid.lower() in akun
-                    for valid in valid_inventory_accounts
-                )
-
-                if not is_inventory_related:
-                    continue
-
-                # Add filter: check if the journal entry keterangan contains selected product name (case-insensitive)
-                if selected_product and selected_product.lower() not in (entry['keterangan'] or '').lower():
-                    continue
-
-                # ─────────────────────────────────────────────────────────────
-                # Hitung transaksi in/out
-                # ─────────────────────────────────────────────────────────────
-                in_qty = out_qty = None
-                in_price = out_price = None
-                in_total = out_total = None
-
-                # Debit = masuk (pembelian)
-                if entry['debit'] > 0:
-                    in_total = entry['debit']
-                    in_price = cost_price
-                    in_qty = in_total / cost_price if cost_price > 0 else 0
-
-                    balance_qty += in_qty
-                    balance_total += in_total
-                    balance_price = balance_total / balance_qty if balance_qty > 0 else 0
-
-                # Kredit = keluar (penjualan/COGS)
-                elif entry['kredit'] > 0:
-                    out_total = entry['kredit']
-                    out_price = cost_price
-                    out_qty = out_total / cost_price if cost_price > 0 else 0
-
-                    balance_qty -= out_qty
-                    balance_total -= out_total
-                    balance_price = balance_total / balance_qty if balance_qty > 0 else 0
-
-                stock_card_data.append({
-                    'date': entry['tanggal'],
-                    'description': entry['keterangan'],
-                    'in_qty': in_qty,
-                    'in_price': format_rupiah(in_price) if in_price else '',
-                    'in_total': format_rupiah(in_total) if in_total else '',
-                    'out_qty': out_qty,
-                    'out_price': format_rupiah(out_price) if out_price else '',
-                    'out_total': format_rupiah(out_total) if out_total else '',
-                    'balance_qty': balance_qty,
-                    'balance_price': format_rupiah(balance_price),
-                    'balance_total': format_rupiah(balance_total)
-                })
-
+        item = repository.find_by_name(selected_product)
+        month_code = MONTH_NAME_TO_NUM.get(bulan)
+        if item and month_code:
+            item_code = item['item_code']
+            stock_card_data = build_stock_card(item_code, f"{tahun}-{month_code}")
     except Exception as e:
         logger.error(f"Error in stock_card route: {e}")
         stock_card_data = []
@@ -542,56 +1655,331 @@ def stock_card():
         item_code=item_code
     )
 
+
+JOURNAL_PAGE_SIZE = 50
+JOURNAL_MAX_PAGE_SIZE = 500
+
+
+def _journal_sort_index():
+    """Journal entries sorted by (date, entry id) plus per-account positions into that order."""
+    def build():
+        ordered = sorted(
+            load_journal_entries(),
+            key=lambda e: (e['tanggal'].isoformat() if e['tanggal'] else '', e['entry_id']),
+        )
+        keys = [(e['tanggal'].isoformat() if e['tanggal'] else '', e['entry_id']) for e in ordered]
+        by_account = {}
+        for pos, entry in enumerate(ordered):
+            by_account.setdefault(entry['no_akun'], []).append(pos)
+        return {'entries': ordered, 'keys': keys, 'by_account': by_account}
+    return _cached('journal_sort_index', journal_paths(), build)
+
+
+def _decode_cursor(cursor):
+    if not cursor or '|' not in cursor:
+        return None
+    date_part, entry_id = cursor.split('|', 1)
+    return (date_part, entry_id)
+
+
+def _encode_cursor(entry):
+    return f"{entry['tanggal'].isoformat() if entry['tanggal'] else ''}|{entry['entry_id']}"
+
+
+def query_journal(dari=None, sampai=None, akun=None, q=None, after=None, before=None, limit=JOURNAL_PAGE_SIZE):
+    """Return one keyset page of journal entries ordered by (tanggal, entry id).
+
+    dari/sampai are inclusive YYYY-MM-DD bounds, akun matches the account code,
+    q is a case-insensitive keterangan substring. `after`/`before` are cursors
+    from a previous page. Returns (entries, next_cursor, prev_cursor).
+    """
+    index = _journal_sort_index()
+    keys = index['keys']
+    lo = bisect_left(keys, (dari, '')) if dari else 0
+    hi = bisect_right(keys, (sampai, '\uffff')) if sampai else len(keys)
+    after_key = _decode_cursor(after)
+    before_key = _decode_cursor(before)
+    if after_key:
+        lo = max(lo, bisect_right(keys, after_key))
+    if before_key:
+        hi = min(hi, bisect_left(keys, before_key))
+
+    if akun:
+        no_akun, _ = _parse_account_code_name(akun)
+        positions = index['by_account'].get(no_akun, [])
+        candidates = positions[bisect_left(positions, lo):bisect_left(positions, hi)]
+    else:
+        candidates = range(lo, hi)
+    if before_key:
+        candidates = reversed(candidates)
+
+    needle = (q or '').strip().lower()
+    page = []
+    has_more = False
+    for pos in candidates:
+        entry = index['entries'][pos]
+        if needle and needle not in (entry['keterangan'] or '').lower():
+            continue
+        if len(page) == limit:
+            has_more = True
+            break
+        page.append(entry)
+    if before_key:
+        page.reverse()
+
+    if not page:
+        return page, None, None
+    forward_more = has_more if not before_key else True
+    backward_more = has_more if before_key else bool(after_key)
+    next_cursor = _encode_cursor(page[-1]) if forward_more else None
+    prev_cursor = _encode_cursor(page[0]) if backward_more else None
+    return page, next_cursor, prev_cursor
+
+
 @app.route('/journal')
 @login_required
 def journal():
+    filters = {
+        'dari': request.args.get('dari', '').strip() or None,
+        'sampai': request.args.get('sampai', '').strip() or None,
+        'akun': request.args.get('akun', '').strip() or None,
+        'q': request.args.get('q', '').strip() or None,
+    }
+    limit = min(max(safe_int(request.args.get('limit')) or JOURNAL_PAGE_SIZE, 1), JOURNAL_MAX_PAGE_SIZE)
+    next_cursor = prev_cursor = None
     try:
-        wb = openpyxl.load_workbook(JOURNAL_FILE)
-        ws = wb['Journal']
-        journal_entries = []
-        for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-            if row[0] and len(row) >= 5:
-                entry = {
-                    'row_id': idx,
-                    'tanggal': row[0],
-                    'keterangan': row[1],
-                    'akun': row[2],
-                    'debit': row[3] if row[3] else 0,
-                    'kredit': row[4] if row[4] else 0
-                }
-                journal_entries.append(entry)
-                logger.debug(f"Loaded journal entry: {entry}")
-        logger.info(f"Loaded {len(journal_entries)} journal entries for journal route")
-    except FileNotFoundError:
-        logger.warning("jurnal.xlsx file not found for journal route, using sample data.")
+        page, next_cursor, prev_cursor = query_journal(
+            after=request.args.get('after'), before=request.args.get('before'), limit=limit, **filters)
         journal_entries = [
-            {'row_id': 2, 'tanggal': '2025-11-01', 'keterangan': 'Penjualan Madu', 'akun': 'Kas', 'debit': 1000000, 'kredit': 0},
-            {'row_id': 3, 'tanggal': '2025-11-01', 'keterangan': 'Penjualan Madu', 'akun': 'Penjualan', 'debit': 0, 'kredit': 1000000},
+            {
+                'entry_id': entry['entry_id'],
+                'voucher': entry['voucher'],
+                'tanggal': entry['tanggal'],
+                'keterangan': entry['keterangan'],
+                'akun': entry['akun'],
+                'debit': entry['debit'],
+                'kredit': entry['kredit'],
+            }
+            for entry in page
         ]
     except Exception as e:
         logger.error(f"Error loading jurnal.xlsx for journal route: {e}")
         journal_entries = []
 
     messages = get_flashed_messages()
-    return render_template('journal.html', journal_entries=journal_entries, messages=messages)
+    # The void forms post this key back to /void_transaksi.
+    return render_template('journal.html', journal_entries=journal_entries, messages=messages,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor, limit=limit,
+                           idempotency_key=secrets.token_urlsafe(16), **filters)
+
+
+def _journal_id_index():
+    """Map permanent entry ID -> journal entry, rebuilt only when jurnal.xlsx changes."""
+    return _cached('journal_id_index', journal_paths(),
+                   lambda: {entry['entry_id']: entry for entry in load_journal_entries()})
+
+
+def _find_journal_row(ws, entry_id):
+    """Return the sheet row holding entry_id, trusting the cached index when it still matches."""
+    entry = _journal_id_index().get(entry_id)
+    row_idx = entry['row_index'] if entry else None
+    if row_idx and ws.cell(row=row_idx, column=JOURNAL_COL_ID).value == entry_id:
+        return row_idx
+    for candidate in range(2, ws.max_row + 1):
+        if ws.cell(row=candidate, column=JOURNAL_COL_ID).value == entry_id:
+            return candidate
+    return None
+
+
+def load_stock_movements():
+    """Return live (not voided) stock movements recorded against vouchers, across all journal files."""
+    paths = journal_paths()
+    return _cached('stock_movements', paths, lambda: [
+        movement for path in paths
+        for movement in _cached(('stock_movements', path), [path], lambda path=path: _sidecar_table(
+            path, 'movements', STOCK_MOVEMENT_SCHEMA, lambda: _read_stock_movements(path)))
+    ])
+
+
+def _read_stock_movements(path):
+    movements = []
+    if not os.path.exists(path):
+        return movements
+    try:
+        wb = openpyxl.load_workbook(path)
+        if STOCK_MOVEMENT_SHEET not in wb.sheetnames:
+            return movements
+        ws = wb[STOCK_MOVEMENT_SHEET]
+        for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
+            if not row or len(row) < 5 or not row[1] or (len(row) > 5 and row[5]):
+                continue
+            movements.append({
+                'row_index': idx,
+                'tanggal': _normalize_excel_date(row[0]),
+                'voucher': str(row[1]),
+                'item_code': str(row[2] or '').strip().upper(),
+                'item_name': str(row[3] or '').strip(),
+                'qty': safe_int(row[4]),
+                'unit_cost': safe_float(row[6]) if len(row) > 6 else 0.0,
+                'balance_qty': safe_int(row[7]) if len(row) > 7 else 0,
+                'balance_cost': safe_float(row[8]) if len(row) > 8 else 0.0,
+            })
+    except Exception as e:
+        logger.error(f"Error loading stock movements from {path}: {e}")
+    return movements
+
+
+def _voucher_index():
+    """Map voucher ID -> {'lines': [...], 'movements': [...]} for the live journal."""
+    def build():
+        index = {}
+        for entry in load_journal_entries():
+            if entry['voucher']:
+                index.setdefault(entry['voucher'], {'lines': [], 'movements': []})['lines'].append(entry)
+        for movement in load_stock_movements():
+            index.setdefault(movement['voucher'], {'lines': [], 'movements': []})['movements'].append(movement)
+        return index
+    return _cached('voucher_index', journal_paths(), build)
+
+
+def _shift_later_positions(ws, voided):
+    """Take voided movements out of the stored positions of every later live movement of the same item.
+
+    The stock card reads those positions instead of replaying history, so they
+    must end where the cost engine ends after reversing the voided movements.
+    """
+    for movement in voided:
+        key = (movement['tanggal'], movement['row_index'])
+        for row_id, row in enumerate(ws.iter_rows(min_row=2, max_col=9, values_only=True), start=2):
+            if not row[1] or row[5] or str(row[2] or '').strip().upper() != movement['item_code']:
+                continue
+            if (_normalize_excel_date(row[0]), row_id) <= key:
+                continue
+            balance_qty, balance_cost = safe_int(row[7]), safe_float(row[8])
+            value = balance_qty * balance_cost - movement['qty'] * movement['unit_cost']
+            balance_qty -= movement['qty']
+            ws.cell(row=row_id, column=8, value=balance_qty)
+            ws.cell(row=row_id, column=9, value=value / balance_qty if balance_qty > 0 else balance_cost)
+
+
+def void_voucher(voucher_id):
+    """Tombstone every line of a voucher and reverse exactly the stock it moved.
+
+    Returns (lines_voided, movements_reversed).
+    """
+    tenant = current_tenant()
+    group = _voucher_index().get(voucher_id)
+    if not group:
+        return 0, 0
+    stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with tenant.journal_write_lock:
+        for line in group['lines']:
+            ensure_period_open(line['tanggal'])
+        wb, ws = _open_journal_workbook()
+        lines_voided = 0
+        for line in group['lines']:
+            row_id = _find_journal_row(ws, line['entry_id'])
+            if row_id is None or ws.cell(row=row_id, column=JOURNAL_COL_DELETED).value:
+                continue
+            ws.cell(row=row_id, column=JOURNAL_COL_DELETED, value=stamp)
+            lines_voided += 1
+
+        reversed_movements = []
+        movement_ws = _stock_movement_sheet(wb)
+        for movement in group['movements']:
+            row_id = movement['row_index']
+            if movement_ws.cell(row=row_id, column=2).value != voucher_id or movement_ws.cell(row=row_id, column=6).value:
+                continue
+            movement_ws.cell(row=row_id, column=6, value=stamp)
+            reversed_movements.append(movement)
+
+        _shift_later_positions(movement_ws, reversed_movements)
+
+        tombstones = _count_tombstones(ws)
+        save_workbook(wb, tenant.journal_file)
+        tenant.events.publish('void', {
+            'voucher': voucher_id,
+            'entry_ids': [line['entry_id'] for line in group['lines']],
+        })
+
+        for movement in reversed_movements:
+            position = tenant.cost_engine.reverse(movement['item_code'], movement['qty'], movement['unit_cost'])
+            if not update_inventory_stock(movement['item_name'], -movement['qty'], avg_cost=position['avg_cost']):
+                logger.error(f"Failed to reverse stock for {movement['item_name']} in voucher {voucher_id}")
+
+    logger.info(f"Voided voucher {voucher_id}: {lines_voided} lines, {len(reversed_movements)} stock movements")
+    _maybe_schedule_compaction(tombstones)
+    return lines_voided, len(reversed_movements)
 
-@app.route('/delete_journal/<int:row_id>', methods=['GET'])
+
+@app.route('/void_transaksi/<voucher_id>', methods=['POST'])
 @login_required
-def delete_journal(row_id):
+def void_transaksi(voucher_id):
+    """Void a whole voucher. POST only, so prefetchers and crawlers cannot trigger it."""
+    tenant = current_tenant()
+    # The journal page hands out one key per render; scope it to the voucher
+    # so several voids from the same page stay independent.
+    idempotency_key = _request_idempotency_key()
+    claim_key = f"void:{voucher_id}:{idempotency_key}" if idempotency_key else None
+    if claim_key:
+        state, _ = tenant.idempotency.claim(claim_key)
+        if state == 'done':
+            flash(f"Transaksi {voucher_id} sudah dibatalkan sebelumnya.")
+            return redirect(url_for('journal'))
+        if state == 'pending':
+            flash(f"Pembatalan transaksi {voucher_id} sedang diproses.")
+            return redirect(url_for('journal'))
+    voided = False
     try:
-        jurnal_path = JOURNAL_FILE
-        wb = openpyxl.load_workbook(jurnal_path)
-        ws = wb['Journal']
-        if row_id <= 1 or row_id > ws.max_row:
+        lines_voided, _ = void_voucher(voucher_id)
+        voided = True
+        if lines_voided:
+            flash(f"Transaksi {voucher_id} berhasil dibatalkan.")
+        else:
+            flash(f"Transaksi {voucher_id} tidak ditemukan.")
+    except PeriodLockedError as e:
+        flash(str(e))
+    except Exception as e:
+        logger.error(f"Error voiding voucher {voucher_id}: {e}")
+        flash(f"Gagal membatalkan transaksi {voucher_id}.")
+    finally:
+        if claim_key:
+            if voided:
+                tenant.idempotency.complete(claim_key, voucher_id)
+            else:
+                tenant.idempotency.forget(claim_key)
+    return redirect(url_for('journal'))
+
+
+@app.route('/delete_journal/<entry_id>', methods=['GET'])
+@login_required
+def delete_journal(entry_id):
+    tenant = current_tenant()
+    try:
+        # Lines posted with a voucher are removed together with their siblings
+        # and the exact stock movements they caused.
+        entry = _journal_id_index().get(entry_id)
+        if entry:
+            ensure_period_open(entry['tanggal'])
+        voucher_id = entry['voucher'] if entry else None
+        if voucher_id:
+            void_voucher(voucher_id)
             return redirect(url_for('journal'))
 
-        # Before deleting, check if this journal entry affects stock
-        # Identify item and quantity from the journal entry row to add back stock
-        row = ws[row_id]
-        if row and len(row) >= 5:
-            tanggal = row[0].value
+        with tenant.journal_write_lock:
+            wb, ws = _open_journal_workbook()
+            row_id = _find_journal_row(ws, entry_id)
+            if row_id is None:
+                logger.warning(f"Journal entry {entry_id} not found or already deleted")
+                return redirect(url_for('journal'))
+            if ws.cell(row=row_id, column=JOURNAL_COL_DELETED).value:
+                return redirect(url_for('journal'))
+
+            # Legacy rows without a voucher: guess the product from keterangan
+
+            row = ws[row_id]
+            ensure_period_open(row[0].value)
             keterangan = row[1].value
-            akun = row[2].value
             debit = row[3].value if row[3].value else 0
             kredit = row[4].value if row[4].value else 0
 
@@ -608,28 +1996,51 @@ def delete_journal(row_id):
                     qty_to_increase = 0
                     # Determine qty based on debit or kredit fields (reverse of sale)
                     # Assumption: kredit field has amount for sales
+                    selling_price = inventory_repository().find_by_name(product_name_found)['selling_price'] or 1
                     if kredit and kredit > 0:
-                        qty_to_increase = int(kredit / next((item['selling_price'] for item in inventory_data if item['name'] == product_name_found), 1))
+                        qty_to_increase = int(to_sen(kredit) / selling_price)
                     elif debit and debit > 0:
-                        qty_to_increase = int(debit / next((item['selling_price'] for item in inventory_data if item['name'] == product_name_found), 1))
+                        qty_to_increase = int(to_sen(debit) / selling_price)
                     if qty_to_increase > 0:
                         update_inventory_stock(product_name_found, qty_to_increase)
 
-        # Delete the journal row
-        ws.delete_rows(row_id)
-        wb.save(jurnal_path)
-        logger.info(f"Deleted journal entry at row {row_id}")
+            # Tombstone instead of ws.delete_rows: later rows keep their position
+            # and IDs held by open browser tabs stay valid.
+            ws.cell(row=row_id, column=JOURNAL_COL_DELETED, value=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            tombstones = _count_tombstones(ws)
+            save_workbook(wb, tenant.journal_file)
+        logger.info(f"Deleted journal entry {entry_id} (row {row_id})")
+        _maybe_schedule_compaction(tombstones)
+    except PeriodLockedError as e:
+        flash(str(e))
     except Exception as e:
-        logger.error(f"Error deleting journal entry at row {row_id}: {e}")
+        logger.error(f"Error deleting journal entry {entry_id}: {e}")
     return redirect(url_for('journal'))
 
-def update_inventory_stock(item_name, qty_change):
+INVENTORY_AVG_COST_HEADER = 'Harga Rata-rata'
+INVENTORY_REORDER_HEADER = 'Titik Pesan Ulang'
+
+
+def _inventory_column(ws, header):
+    """Return the column index of header in the Inventory sheet, adding it if missing."""
+    for cell in ws[1]:
+        if cell.value and str(cell.value).strip() == header:
+            return cell.column
+    column = ws.max_column + 1
+    ws.cell(row=1, column=column, value=header)
+    return column
+
+
+def update_inventory_stock(item_name, qty_change, avg_cost=None, reserved=False):
     """
     Update the stock quantity of the item with item_name in the Inventory sheet
     by adding qty_change (positive to increase stock, negative to decrease stock).
+    When avg_cost is given, the running average unit cost is stored as well.
+    reserved=True means a stock reservation already took the change.
     """
+    tenant = current_tenant()
     try:
-        inventory_path = INVENTORY_FILE
+        inventory_path = tenant.inventory_file
         wb = openpyxl.load_workbook(inventory_path)
         if 'Inventory' not in wb.sheetnames:
             logger.error("Inventory sheet not found in databasesia.xlsx")
@@ -637,9 +2048,18 @@ def update_inventory_stock(item_name, qty_change):
         ws = wb['Inventory']
         item_found = False
 
-        for row in range(2, ws.max_row + 1):  # Assuming first row is header
+        # Go straight to the indexed row; scan only if the sheet moved under us.
+        target = _normalize_product_name(item_name)
+        indexed = inventory_repository().find_by_name(item_name)
+        candidate_rows = range(2, ws.max_row + 1)  # Assuming first row is header
+        if indexed and indexed.get('sheet_row') and \
+                _normalize_product_name(ws.cell(row=indexed['sheet_row'], column=2).value) == target:
+            candidate_rows = [indexed['sheet_row']]
+
+        for row in candidate_rows:
             cell_value = ws.cell(row=row, column=2).value  # Column 2: 'name'
-            if cell_value and cell_value.strip().lower() == item_name.strip().lower():
+            if cell_value and _normalize_product_name(cell_value) == target:
+                item_code = str(ws.cell(row=row, column=1).value or '').strip().upper()
                 current_stock = ws.cell(row=row, column=3).value  # Column 3: 'stock'
                 if current_stock is None:
                     current_stock = 0
@@ -647,12 +2067,31 @@ def update_inventory_stock(item_name, qty_change):
                 if new_stock < 0:
                     new_stock = 0  # Prevent negative stock
                 ws.cell(row=row, column=3, value=new_stock)
+                if avg_cost is not None:
+                    ws.cell(row=row, column=_inventory_column(ws, INVENTORY_AVG_COST_HEADER), value=avg_cost)
                 item_found = True
                 logger.info(f"Updated stock for '{item_name}': from {current_stock} to {new_stock}")
                 break
 
         if item_found:
-            wb.save(inventory_path)
+            previous_signature = _file_signature(inventory_path)
+            save_workbook(wb, inventory_path)
+            if avg_cost is not None:
+                # The caller already applied this movement to the cost engine.
+                tenant.cost_engine.mark_synced()
+            tenant.events.publish('stock', {
+                'item_name': item_name,
+                'stock': new_stock,
+                'avg_cost': avg_cost,
+            })
+            if not reserved:
+                tenant.stock.adjust(item_code, new_stock - int(current_stock), previous_signature)
+            alert = tenant.low_stock.apply(item_code, int(current_stock), new_stock, qty_change, previous_signature)
+            if alert:
+                logger.warning(f"Stok {alert['name']} tinggal {alert['stock']} (titik pesan ulang {alert['reorder_point']})")
+                tenant.events.publish('low_stock', alert)
+                if has_request_context():
+                    flash(f"Stok {alert['name']} tinggal {alert['stock']}, segera pesan ulang.")
             return True
         else:
             logger.warning(f"Item '{item_name}' not found in Inventory to update stock.")
@@ -663,43 +2102,493 @@ def update_inventory_stock(item_name, qty_change):
         return False
 
 
+# Items below their reorder point ('Titik Pesan Ulang' column, default
+# LOW_STOCK_THRESHOLD) are kept in a heap ordered by days of cover, i.e. stock
+# divided by the average daily sales over STOCK_USAGE_WINDOW_DAYS. Every stock
+# mutation updates it in O(log n); like the cost engine it is only rebuilt
+# when databasesia.xlsx changes outside update_inventory_stock.
+STOCK_USAGE_WINDOW_DAYS = 30
+
+
+class LowStockIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._items = {}
+        self._heap = []
+        self._signature = None
+
+    @staticmethod
+    def _days_of_cover(item):
+        if item['daily_usage'] <= 0:
+            return float('inf')
+        return item['stock'] / item['daily_usage']
+
+    def _push(self, item_code):
+        item = self._items[item_code]
+        item['version'] += 1
+        if item['stock'] < item['reorder_point']:
+            heapq.heappush(self._heap, (self._days_of_cover(item), item['stock'], item_code, item['version']))
+
+    def _is_current(self, entry):
+        item = self._items.get(entry[2])
+        return item is not None and item['version'] == entry[3] and item['stock'] < item['reorder_point']
+
+    def _ensure_loaded(self):
+        signature = _file_signature(current_tenant().inventory_file)
+        if signature is not None and signature == self._signature:
+            return
+        cutoff = (datetime.today() - timedelta(days=STOCK_USAGE_WINDOW_DAYS)).strftime('%Y-%m-%d')
+        sold = {}
+        for movement in load_stock_movements():
+            if movement['qty'] < 0 and movement['tanggal'] >= cutoff:
+                sold[movement['item_code']] = sold.get(movement['item_code'], 0) - movement['qty']
+        self._items = {
+            item['item_code']: {
+                'item_code': item['item_code'],
+                'name': item['name'],
+                'stock': item['stock'],
+                'reorder_point': item.get('reorder_point', LOW_STOCK_THRESHOLD),
+                'daily_usage': sold.get(item['item_code'], 0) / STOCK_USAGE_WINDOW_DAYS,
+                'version': 0,
+            }
+            for item in load_inventory()
+        }
+        self._heap = []
+        for item_code in self._items:
+            self._push(item_code)
+        self._signature = signature
+
+    def apply(self, item_code, previous_stock, new_stock, qty_change, previous_signature):
+        """Record a saved stock mutation; returns an alert dict when it crossed the reorder point.
+
+        previous_signature is the inventory file's signature before the save:
+        if the index did not match it, it is rebuilt from the saved file.
+        """
+        with self._lock:
+            if self._signature is None or self._signature != previous_signature:
+                self._ensure_loaded()
+            item = self._items.get(item_code)
+            if item is None:
+                return None
+            item['stock'] = new_stock
+            if qty_change < 0:
+                item['daily_usage'] += -qty_change / STOCK_USAGE_WINDOW_DAYS
+            self._push(item_code)
+            # Our own write: the file now matches the index.
+            self._signature = _file_signature(current_tenant().inventory_file)
+            if previous_stock >= item['reorder_point'] > new_stock:
+                return self._public(item)
+            return None
+
+    def resync_items(self, items, previous_signature, signature):
+        """Patch externally edited inventory rows in place if the index matched the file before the edit."""
+        with self._lock:
+            if self._signature is None or self._signature != previous_signature:
+                return
+            for record in items:
+                item = self._items.get(record['item_code'])
+                if item is None:
+                    self._signature = None
+                    return
+                item['stock'] = record['stock']
+                item['reorder_point'] = record.get('reorder_point', LOW_STOCK_THRESHOLD)
+                item['name'] = record['name']
+                self._push(record['item_code'])
+            self._signature = signature
+
+    def _public(self, item):
+        days = self._days_of_cover(item)
+        return {
+            'item_code': item['item_code'],
+            'name': item['name'],
+            'stock': item['stock'],
+            'reorder_point': item['reorder_point'],
+            'daily_usage': round(item['daily_usage'], 2),
+            'days_of_cover': None if days == float('inf') else round(days, 1),
+        }
+
+    def count(self):
+        with self._lock:
+            self._ensure_loaded()
+            return sum(1 for item in self._items.values() if item['stock'] < item['reorder_point'])
+
+    def top(self, k=None):
+        """The k most urgent low-stock items (fewest days of cover first)."""
+        with self._lock:
+            self._ensure_loaded()
+            result = []
+            popped = []
+            while self._heap and (k is None or len(result) < k):
+                entry = heapq.heappop(self._heap)
+                if self._is_current(entry):
+                    popped.append(entry)
+                    result.append(self._public(self._items[entry[2]]))
+            # Stale entries stay dropped; live ones go back.
+            for entry in popped:
+                heapq.heappush(self._heap, entry)
+            return result
+
+
+# Sales reserve stock before they post. Each item has an [available, version]
+# slot changed only by compare-and-swap under one of a few striped locks, so
+# checkouts of different products never wait on each other and two checkouts
+# racing for the last jar cannot both succeed: the loser sees the new version,
+# retries, and finds the stock gone.
+RESERVATION_STRIPES = 16
+RESERVATION_RETRIES = 5
+
+
+class InsufficientStockError(Exception):
+    def __init__(self, item_code, requested, available):
+        super().__init__(f"{item_code}: diminta {requested}, tersedia {available}")
+        self.item_code = item_code
+        self.requested = requested
+        self.available = available
+
+
+class StockConflictError(Exception):
+    """Raised when a reservation kept losing compare-and-swap races."""
+
+
+class StockReservations:
+    def __init__(self):
+        self._stripes = [threading.Lock() for _ in range(RESERVATION_STRIPES)]
+        self._seed_lock = threading.Lock()
+        self._slots = {}
+        self._open = 0
+        self._signature = None
+
+    def _ensure_seeded(self):
+        signature = _file_signature(current_tenant().inventory_file)
+        with self._seed_lock:
+            # Reseed only from a quiet state; open reservations are already
+            # subtracted from the slots but not yet from the file.
+            if self._open or (signature is not None and signature == self._signature):
+                return
+            self._slots = {item['item_code']: [item['stock'], 0] for item in load_inventory()}
+            self._signature = signature
+
+    def _compare_and_swap(self, item_code, slot, version, new_available):
+        with self._stripes[hash(item_code) % RESERVATION_STRIPES]:
+            if slot[1] != version:
+                return False
+            slot[0] = new_available
+            slot[1] = version + 1
+            return True
+
+    def _change(self, item_code, delta, check=True):
+        for _ in range(RESERVATION_RETRIES):
+            slot = self._slots.setdefault(item_code, [0, 0])
+            available, version = slot
+            if check and available + delta < 0:
+                raise InsufficientStockError(item_code, -delta, available)
+            if self._compare_and_swap(item_code, slot, version, max(available + delta, 0)):
+                return
+        raise StockConflictError(item_code)
+
+    def available(self, item_code):
+        self._ensure_seeded()
+        slot = self._slots.get(item_code)
+        return slot[0] if slot else 0
+
+    def reserve(self, lines):
+        """Take (item_code, qty) lines atomically: all succeed or none are held."""
+        self._ensure_seeded()
+        wanted = {}
+        for item_code, qty in lines:
+            wanted[item_code] = wanted.get(item_code, 0) + qty
+        with self._seed_lock:
+            self._open += 1
+        taken = {}
+        try:
+            for item_code, qty in sorted(wanted.items()):
+                self._change(item_code, -qty)
+                taken[item_code] = qty
+        except Exception:
+            for item_code, qty in taken.items():
+                self._change(item_code, qty, check=False)
+            with self._seed_lock:
+                self._open -= 1
+            raise
+        return {'lines': taken, 'open': True}
+
+    def release(self, reservation):
+        """Give back a reservation whose sale did not post; a no-op once settled."""
+        if not reservation['open']:
+            return
+        reservation['open'] = False
+        for item_code, qty in reservation['lines'].items():
+            self._change(item_code, qty, check=False)
+        with self._seed_lock:
+            self._open -= 1
+
+    def commit(self, reservation):
+        """The sale posted and databasesia.xlsx now reflects it."""
+        reservation['open'] = False
+        with self._seed_lock:
+            self._open -= 1
+            self._signature = _file_signature(current_tenant().inventory_file)
+
+    def resync_items(self, items, previous_signature, signature):
+        """Take externally edited stock counts, unless a sale is mid-flight."""
+        with self._seed_lock:
+            if self._open or self._signature is None or self._signature != previous_signature:
+                return
+            for item in items:
+                slot = self._slots.setdefault(item['item_code'], [0, 0])
+                with self._stripes[hash(item['item_code']) % RESERVATION_STRIPES]:
+                    slot[0] = item['stock']
+                    slot[1] += 1
+            self._signature = signature
+
+    def adjust(self, item_code, delta, previous_signature):
+        """Apply a stock change the app just saved outside a reservation (purchases, voids).
+
+        previous_signature is databasesia.xlsx's signature before that save. If
+        the slots did not match it they are reseeded from the saved file, which
+        already holds the change, so the delta is not applied a second time.
+        """
+        with self._seed_lock:
+            in_sync = self._open or (self._signature is not None and self._signature == previous_signature)
+        if not in_sync:
+            self._ensure_seeded()
+            return
+        self._change(item_code, delta, check=False)
+        with self._seed_lock:
+            if not self._open:
+                self._signature = _file_signature(current_tenant().inventory_file)
+
+
+# A posting is deduplicated by the idempotency key its form (or POS device)
+# sends, not by comparing journal rows: two identical sales on the same day are
+# two sales, while a double-clicked or retried submit is one. Keys are kept for
+# a day, at most IDEMPOTENCY_MAX_KEYS per store, oldest dropped first.
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_MAX_KEYS = 10000
+IDEMPOTENCY_KEY_RE = re.compile(r'^[A-Za-z0-9_.:-]{8,128}$')
+
+
+class IdempotencyStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [expires_at, voucher_id]; voucher_id is None while posting.
+        self._entries = OrderedDict()
+
+    def _expire(self, now):
+        # Every entry gets the same TTL, so insertion order is expiry order.
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry[0] > now and len(self._entries) < IDEMPOTENCY_MAX_KEYS:
+                break
+            self._entries.popitem(last=False)
+
+    def claim(self, key):
+        """Return ('new', None), ('pending', None) or ('done', voucher_id) for a key."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [now + IDEMPOTENCY_TTL_SECONDS, None]
+                return 'new', None
+            if entry[1] is None:
+                return 'pending', None
+            return 'done', entry[1]
+
+    def complete(self, key, voucher_id):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = voucher_id
+
+    def forget(self, key):
+        """Drop a key whose posting failed so the same submit can be retried."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is None:
+                del self._entries[key]
+
+
+def _request_idempotency_key():
+    """Client-sent key from the form field or Idempotency-Key header, if well formed."""
+    key = (request.form.get('idempotency_key') or request.headers.get('Idempotency-Key') or '').strip()
+    if key and not IDEMPOTENCY_KEY_RE.match(key):
+        logger.warning(f"Ignoring malformed idempotency key: {key[:32]}")
+        return None
+    return key or None
+
+
+COSTING_METHOD = os.environ.get('SIA_COSTING_METHOD', 'average').lower()
+
+
+class CostEngine:
+    """Perpetual inventory costing: running quantity and unit cost per product.
+
+    'average' keeps a weighted-average unit cost, 'fifo' keeps cost layers.
+    State is seeded once from the Inventory sheet (stock and Harga Rata-rata)
+    and then updated in O(1) per movement; it is only reseeded when
+    databasesia.xlsx is changed by something other than update_inventory_stock.
+    FIFO layers are not persisted, so after a restart they start from a single
+    layer at the stored average cost.
+    """
+
+    def __init__(self, method='average'):
+        self.method = method
+        self._lock = threading.RLock()
+        self._positions = {}
+        self._signature = None
+
+    def _ensure_loaded(self):
+        signature = _file_signature(current_tenant().inventory_file)
+        if signature is not None and signature == self._signature:
+            return
+        positions = {}
+        for item in load_inventory():
+            qty = safe_int(item.get('stock', 0))
+            unit_cost = safe_float(item.get('avg_cost', item.get('cost_price', 0)))
+            positions[item['item_code']] = {
+                'qty': qty,
+                'avg_cost': unit_cost,
+                'layers': deque([[qty, unit_cost]]) if qty > 0 else deque(),
+            }
+        self._positions = positions
+        self._signature = signature
+
+    def load(self):
+        """Seed the positions now (used by the startup prewarm)."""
+        with self._lock:
+            self._ensure_loaded()
+
+    def resync_items(self, items, previous_signature, signature):
+        """Reset the positions of externally edited inventory rows, keeping every other item's layers."""
+        with self._lock:
+            if self._signature is None or self._signature != previous_signature:
+                return
+            for item in items:
+                qty = safe_int(item.get('stock', 0))
+                unit_cost = safe_float(item.get('avg_cost', item.get('cost_price', 0)))
+                self._positions[item['item_code']] = {
+                    'qty': qty,
+                    'avg_cost': unit_cost,
+                    'layers': deque([[qty, unit_cost]]) if qty > 0 else deque(),
+                }
+            self._signature = signature
+
+    def mark_synced(self):
+        """Accept the current databasesia.xlsx as matching our in-memory state."""
+        with self._lock:
+            if self._positions:
+                self._signature = _file_signature(current_tenant().inventory_file)
+
+    def _position(self, item_code):
+        return self._positions.setdefault(item_code, {'qty': 0, 'avg_cost': 0.0, 'layers': deque()})
+
+    @staticmethod
+    def _snapshot(pos):
+        return {'qty': pos['qty'], 'avg_cost': pos['avg_cost']}
+
+    def position(self, item_code):
+        with self._lock:
+            self._ensure_loaded()
+            pos = self._positions.get(item_code)
+            return self._snapshot(pos) if pos else {'qty': 0, 'avg_cost': 0.0}
+
+    def receive(self, item_code, qty, unit_cost):
+        """Book qty units in at unit_cost (Pembelian). Returns the new position."""
+        with self._lock:
+            self._ensure_loaded()
+            pos = self._position(item_code)
+            total_value = pos['qty'] * pos['avg_cost'] + qty * unit_cost
+            pos['qty'] += qty
+            pos['avg_cost'] = total_value / pos['qty'] if pos['qty'] > 0 else unit_cost
+            if self.method == 'fifo':
+                pos['layers'].append([qty, unit_cost])
+            return self._snapshot(pos)
+
+    def issue(self, item_code, qty):
+        """Book qty units out (Penjualan). Returns (cost of goods sold, new position)."""
+        with self._lock:
+            self._ensure_loaded()
+            pos = self._position(item_code)
+            if self.method == 'fifo':
+                cogs = self._consume_layers(pos, qty)
+            else:
+                cogs = qty * pos['avg_cost']
+            remaining_value = pos['qty'] * pos['avg_cost'] - cogs
+            pos['qty'] -= qty
+            if self.method == 'fifo':
+                pos['avg_cost'] = remaining_value / pos['qty'] if pos['qty'] > 0 else pos['avg_cost']
+            return cogs, self._snapshot(pos)
+
+    def reverse(self, item_code, qty, unit_cost):
+        """Undo a recorded movement of signed qty at unit_cost (used when voiding)."""
+        with self._lock:
+            self._ensure_loaded()
+            pos = self._position(item_code)
+            if qty < 0:
+                pos['qty'] -= qty
+                total_value = (pos['qty'] + qty) * pos['avg_cost'] - qty * unit_cost
+                pos['avg_cost'] = total_value / pos['qty'] if pos['qty'] > 0 else unit_cost
+                if self.method == 'fifo':
+                    pos['layers'].appendleft([-qty, unit_cost])
+            else:
+                total_value = pos['qty'] * pos['avg_cost'] - qty * unit_cost
+                pos['qty'] -= qty
+                pos['avg_cost'] = total_value / pos['qty'] if pos['qty'] > 0 else pos['avg_cost']
+                if self.method == 'fifo':
+                    self._consume_layers(pos, qty, newest_first=True)
+            return self._snapshot(pos)
+
+    @staticmethod
+    def _consume_layers(pos, qty, newest_first=False):
+        layers = pos['layers']
+        remaining = qty
+        cost = 0.0
+        while remaining > 0 and layers:
+            layer = layers[-1] if newest_first else layers[0]
+            take = min(remaining, layer[0])
+            cost += take * layer[1]
+            layer[0] -= take
+            remaining -= take
+            if layer[0] <= 0:
+                if newest_first:
+                    layers.pop()
+                else:
+                    layers.popleft()
+        # Selling beyond the recorded layers falls back to the running average.
+        return cost + remaining * pos['avg_cost']
+
+
+
+
 from flask import redirect
 
 @app.route('/input_transaksi', methods=['GET', 'POST'])
 @login_required
 def input_transaksi():
-    accounts = [
-        ('1-1100', 'Kas'),
-        ('1-1200', 'Piutang usaha'),
-        ('1-1300', 'Persediaan barang dagang'),
-        ('1-1310', 'Persediaan stok madu gudang'),
-        ('1-1400', 'Perlengkapan toko'),
-        ('1-1500', 'Tanah'),
-        ('1-1510', 'Bangunan'),
-        ('1-1511', 'Akumulasi penyusutan bangunan'),
-        ('1-1600', 'Kendaraan'),
-        ('1-1610', 'Akumulasi penyusutan kendaraan'),
-        ('1-1700', 'Peralatan'),
-        ('1-1710', 'Akumulasi penyusutan peralatan'),
-        ('2-2100', 'Hutang dagang'),
-        ('3-3000', 'Modal'),
-        ('4-4000', 'Penjualan barang dagang'),
-        ('4-4100', 'Retur penjualan'),
-        ('5-5000', 'Harga pokok penjualan'),
-        ('6-6100', 'Beban telepon, air, dan listrik'),
-        ('6-6200', 'Beban perlengkapan'),
-        ('6-6300', 'Beban pemeliharaan'),
-        ('6-6400', 'Beban gaji produksi'),
-        ('6-6500', 'Beban gaji pemeliharaan lebah'),
-        ('6-6600', 'Beban transportasi pemeliharaan lebah'),
-        ('6-6700', 'Beban transportasi penjualan lebah'),
-        ('6-6800', 'Beban depresiasi aktiva tetap'),
-    ]
-    akun_options = [f"{code} - {name}" for code, name in accounts]
+    tenant = current_tenant()
+    akun_options = chart_of_accounts().options()
 
-    inventory_data = load_inventory()
+    # The form still lists every product: input_transaksi.html has no
+    # typeahead yet, so /api/products cannot stand in for the dropdown.
+    repository = inventory_repository()
+    inventory_data = repository.items
 
     if request.method == 'POST':
+        idempotency_key = _request_idempotency_key()
+        # An error page is resubmitted, so it must carry a key too: the
+        # original one (forgotten again on failure) or a fresh one.
+        form_key = idempotency_key or secrets.token_urlsafe(16)
+        if idempotency_key:
+            state, voucher_id = tenant.idempotency.claim(idempotency_key)
+            if state == 'done':
+                logger.info(f"Replayed submission {idempotency_key} -> voucher {voucher_id}")
+                flash(f"Transaksi sudah disimpan sebelumnya. No. voucher: {voucher_id}")
+                return redirect(url_for('journal'))
+            if state == 'pending':
+                error_msg = "Transaksi ini sedang diproses. Silakan tunggu sebentar."
+                return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data,
+                                       error=error_msg, idempotency_key=idempotency_key)
         try:
             # Extract form data from POST
             jenis_transaksi = request.form.get('jenis_transaksi')
@@ -748,185 +2637,226 @@ def input_transaksi():
             # Validation: there must be at least one debit and kredit entry
             if not debit_entries or not kredit_entries:
                 error_msg = "Transaksi harus memiliki minimal satu akun debit dan satu akun kredit dengan jumlah > 0."
-                return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg)
+                return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=form_key)
 
             # Validation: total debit must equal total kredit
             total_debit = sum(item['amount'] for item in debit_entries)
             total_kredit = sum(item['amount'] for item in kredit_entries)
-            if abs(total_debit - total_kredit) > 0.01:  # small epsilon for float comparison
-                error_msg = f"Total debit ({total_debit}) dan total kredit ({total_kredit}) harus sama."
-                return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg)
-
-            # Use absolute path for jurnal.xlsx
-            jurnal_path = JOURNAL_FILE
-            try:
-                if not os.path.exists(jurnal_path):
-                    wb = openpyxl.Workbook()
-                    ws = wb.active
-                    ws.title = 'Journal'
-                    ws.append(['Tanggal', 'Keterangan', 'Akun', 'Debit', 'Kredit'])
-                    wb.save(jurnal_path)
-
-                wb = openpyxl.load_workbook(jurnal_path)
-                if 'Journal' in wb.sheetnames:
-                    ws = wb['Journal']
-                else:
-                    ws = wb.create_sheet('Journal')
-                    ws.append(['Tanggal', 'Keterangan', 'Akun', 'Debit', 'Kredit'])
-
-                # Append debit entries (avoid duplicates)
-                for entry in debit_entries:
-                    row_data = [tanggal, keterangan, entry['akun'], entry['amount'], 0]
-                    if journal_row_exists(ws, *row_data):
-                        logger.info(f"Skipping duplicate debit journal row: {row_data}")
-                        continue
-                    ws.append(row_data)
-
-                # Append kredit entries (avoid duplicates)
-                for entry in kredit_entries:
-                    row_data = [tanggal, keterangan, entry['akun'], 0, entry['amount']]
-                    if journal_row_exists(ws, *row_data):
-                        logger.info(f"Skipping duplicate kredit journal row: {row_data}")
-                        continue
-                    ws.append(row_data)
-
-                logger.info(f"Journal entries prepared for saving to {jurnal_path}")
-
-            except Exception as e:
-                logger.error(f"Error saving journal entries: {e}")
-                error_msg = f"Terjadi kesalahan saat menyimpan transaksi: {str(e)}"
-                return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg)
-
-            # Update stock based on explicit sales rows (Penjualan)
-            # Also create automatic journal entries for COGS (Harga Pokok Penjualan)
+            if total_debit != total_kredit:  # int sen, exact comparison
+                error_msg = f"Total debit ({from_sen(total_debit)}) dan total kredit ({from_sen(total_kredit)}) harus sama."
+                return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=form_key)
+
+            # Reserve the sold stock up front against live availability, not
+            # the inventory snapshot this request started with.
+            sales_items = []
+            reservation = None
             if jenis_transaksi == 'Penjualan':
-                logger.debug(f"Processing Penjualan stock updates for keterangan: {keterangan}")
+                sales_items = _parse_sales_lines(request.form, repository)
+                if not sales_items:
+                    error_msg = "Penjualan harus memiliki minimal satu produk."
+                    return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=form_key)
+                try:
+                    reservation = tenant.stock.reserve([(sale['product_code'], sale['qty']) for sale in sales_items])
+                except InsufficientStockError as e:
+                    item = repository.get(e.item_code)
+                    error_msg = f"Stok untuk {item['name'] if item else e.item_code} tidak mencukupi. Stok tersedia: {e.available}"
+                    return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=form_key)
+                except StockConflictError:
+                    error_msg = "Stok sedang diperbarui oleh transaksi lain. Silakan coba lagi."
+                    return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=form_key)
 
-                sales_items = []
-                index = 1
-                while True:
-                    product_key = f"product_{index}"
-                    qty_key = f"quantity_{index}"
-                    if product_key not in request.form:
-                        break
-                    product_code = request.form.get(product_key)
-                    qty_val = request.form.get(qty_key)
-                    index += 1
+            try:
+                return _post_transaksi(tenant, jenis_transaksi, tanggal, keterangan, debit_entries, kredit_entries,
+                                       sales_items, reservation, idempotency_key, akun_options, inventory_data, repository)
+            finally:
+                # Anything that did not reach commit (error page, exception) gives the stock back.
+                if reservation is not None:
+                    tenant.stock.release(reservation)
 
-                    if not product_code or not qty_val:
-                        continue
+        except Exception as e:
+            error_msg = f"Terjadi kesalahan saat menyimpan transaksi: {str(e)}"
+            return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=form_key)
+        finally:
+            # Only a completed posting keeps its key; validation errors may be resubmitted.
+            if idempotency_key:
+                tenant.idempotency.forget(idempotency_key)
+
+    # Each rendered form carries a fresh key for its single submission.
+    return render_template('input_transaksi.html', 
+                           akun_options=akun_options, 
+                           inventory_data=inventory_data,
+                           idempotency_key=secrets.token_urlsafe(16))
+
+
+def _parse_sales_lines(form, repository):
+    """Sold products from the product_N/quantity_N form rows, resolved by item code."""
+    sales_items = []
+    index = 1
+    while True:
+        product_key = f"product_{index}"
+        qty_key = f"quantity_{index}"
+        if product_key not in form:
+            break
+        product_code = form.get(product_key)
+        qty_val = form.get(qty_key)
+        index += 1
+
+        if not product_code or not qty_val:
+            continue
 
-                    try:
-                        qty = int(float(qty_val))
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid quantity value for {product_key}: {qty_val}")
-                        continue
-
-                    if qty <= 0:
-                        continue
-
-                    item = next((item for item in inventory_data if item['item_code'] == product_code), None)
-                    if not item:
-                        logger.warning(f"Product code {product_code} not found in inventory for sales stock update")
-                        continue
-
-                    if qty > safe_int(item.get('stock', 0)):
-                        error_msg = f"Stok untuk {item['name']} tidak mencukupi. Stok tersedia: {item['stock']}"
-                        return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg)
-
-                    sales_items.append({
-                        'product_code': product_code,
-                        'product_name': item['name'],
-                        'qty': qty,
-                        'cost_price': safe_float(item.get('cost_price', 0)),
-                        'selling_price': safe_float(item.get('selling_price', 0))
-                    })
+        try:
+            qty = int(float(qty_val))
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid quantity value for {product_key}: {qty_val}")
+            continue
 
-                if not sales_items:
-                    error_msg = "Penjualan harus memiliki minimal satu produk."
-                    return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg)
+        if qty <= 0:
+            continue
 
-                for sale in sales_items:
-                    cogs_amount = sale['qty'] * sale['cost_price']
-                    auto_keterangan = f"{keterangan} - {sale['product_name']} [AUTO]"
+        item = repository.get(product_code)
+        if not item:
+            logger.warning(f"Product code {product_code} not found in inventory for sales stock update")
+            continue
 
-                    debit_row = [tanggal, auto_keterangan, '5-5000 - Harga pokok penjualan', cogs_amount, 0]
-                    credit_row = [tanggal, auto_keterangan, '1-1300 - Persediaan barang dagang', 0, cogs_amount]
+        sales_items.append({
+            'product_code': item['item_code'],
+            'product_name': item['name'],
+            'qty': qty,
+            'cost_price': item.get('cost_price', 0),
+            'selling_price': item.get('selling_price', 0)
+        })
+    return sales_items
+
+
+def _post_transaksi(tenant, jenis_transaksi, tanggal, keterangan, debit_entries, kredit_entries,
+                    sales_items, reservation, idempotency_key, akun_options, inventory_data, repository):
+    """Write a validated transaction (and its stock effects) and redirect to the journal."""
+    with tenant.journal_write_lock:
+        # Closed months are locked; reject instead of silently changing reported
+        # figures. Checked under the journal lock, which close_period holds from
+        # its snapshot until the lock is written.
+        if is_period_locked(_date_period(tanggal)):
+            error_msg = f"Periode {_date_period(tanggal)} sudah ditutup. Buka kembali periode untuk mencatat transaksi."
+            return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                                   idempotency_key=idempotency_key or secrets.token_urlsafe(16))
+
+        # Use absolute path for jurnal.xlsx
+        jurnal_path = tenant.journal_file
+        try:
+            wb, ws = _open_journal_workbook(jurnal_path)
+            # One voucher per posting links the manual lines, the [AUTO]
+            # HPP/Persediaan pairs and the stock movements.
+            voucher_id = _new_voucher_id()
 
-                    if journal_row_exists(ws, *debit_row) or journal_row_exists(ws, *credit_row):
-                        logger.info(f"Auto journal entries already exist for {auto_keterangan}, skipping stock update.")
-                        continue
+            # Duplicate submits are caught by the idempotency key before this point.
+            for entry in debit_entries:
+                _append_journal_row(ws, tanggal, keterangan, entry['akun'], entry['amount'], 0, voucher_id=voucher_id)
 
-                    ws.append(debit_row)
-                    ws.append(credit_row)
+            for entry in kredit_entries:
+                _append_journal_row(ws, tanggal, keterangan, entry['akun'], 0, entry['amount'], voucher_id=voucher_id)
 
-                    success = update_inventory_stock(sale['product_name'], -sale['qty'])
-                    if success:
-                        logger.info(f"Stock updated (Penjualan): {sale['product_name']} decreased by {sale['qty']}")
-                    else:
-                        logger.error(f"Failed to update stock (Penjualan) for: {sale['product_name']}")
+            logger.info(f"Journal entries prepared for saving to {jurnal_path}")
 
-                wb.save(jurnal_path)
+        except Exception as e:
+            logger.error(f"Error saving journal entries: {e}")
+            error_msg = f"Terjadi kesalahan saat menyimpan transaksi: {str(e)}"
+            return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg,
+                               idempotency_key=idempotency_key or secrets.token_urlsafe(16))
+
+        # Update stock based on explicit sales rows (Penjualan)
+        # Also create automatic journal entries for COGS (Harga Pokok Penjualan)
+        if jenis_transaksi == 'Penjualan':
+            logger.debug(f"Processing Penjualan stock updates for keterangan: {keterangan}")
+
+            for sale in sales_items:
+                auto_keterangan = f"{keterangan} - {sale['product_name']} [AUTO]"
+
+                # HPP comes from the running cost position, not the static Price column.
+                cogs_amount, position = tenant.cost_engine.issue(sale['product_code'], sale['qty'])
+                cogs_amount = to_sen(cogs_amount)
+                _append_journal_row(ws, tanggal, auto_keterangan, '5-5000 - Harga pokok penjualan', cogs_amount, 0, voucher_id=voucher_id)
+                _append_journal_row(ws, tanggal, auto_keterangan, '1-1300 - Persediaan barang dagang', 0, cogs_amount, voucher_id=voucher_id)
+                _append_stock_movement(wb, tanggal, voucher_id, sale['product_code'], sale['product_name'],
+                                       -sale['qty'], cogs_amount / 100 / sale['qty'], position)
+
+                success = update_inventory_stock(sale['product_name'], -sale['qty'], avg_cost=position['avg_cost'], reserved=True)
+                if success:
+                    logger.info(f"Stock updated (Penjualan): {sale['product_name']} decreased by {sale['qty']}")
+                else:
+                    logger.error(f"Failed to update stock (Penjualan) for: {sale['product_name']}")
 
-            # Update stock based on explicit purchase rows (Pembelian)
-            elif jenis_transaksi == 'Pembelian':
-                logger.debug(f"Processing Pembelian stock updates for keterangan: {keterangan}")
-                index = 1
-                while True:
-                    product_key = f"purchase_product_{index}"
-                    qty_key = f"purchase_quantity_{index}"
-                    if product_key not in request.form:
-                        break
-                    product_code = request.form.get(product_key)
-                    qty_val = request.form.get(qty_key)
-                    index += 1
+            save_workbook(wb, jurnal_path)
+            tenant.stock.commit(reservation)
+            _journal_committed(tenant, jurnal_path)
 
-                    if not product_code or not qty_val:
-                        continue
+        # Update stock based on explicit purchase rows (Pembelian)
+        elif jenis_transaksi == 'Pembelian':
+            logger.debug(f"Processing Pembelian stock updates for keterangan: {keterangan}")
+            index = 1
+            while True:
+                product_key = f"purchase_product_{index}"
+                qty_key = f"purchase_quantity_{index}"
+                price_key = f"purchase_price_{index}"
+                if product_key not in request.form:
+                    break
+                product_code = request.form.get(product_key)
+                qty_val = request.form.get(qty_key)
+                index += 1
 
-                    try:
-                        qty = int(float(qty_val))
-                    except (ValueError, TypeError):
-                        logger.warning(f"Invalid purchase quantity value for {product_key}: {qty_val}")
-                        continue
+                if not product_code or not qty_val:
+                    continue
 
-                    if qty <= 0:
-                        continue
+                try:
+                    qty = int(float(qty_val))
+                except (ValueError, TypeError):
+                    logger.warning(f"Invalid purchase quantity value for {product_key}: {qty_val}")
+                    continue
 
-                    item = next((item for item in inventory_data if item['item_code'] == product_code), None)
-                    if not item:
-                        logger.warning(f"Product code {product_code} not found in inventory for purchase stock update")
-                        continue
+                if qty <= 0:
+                    continue
 
-                    product_name = item['name']
-                    success = update_inventory_stock(product_name, qty)
-                    if success:
-                        logger.info(f"Stock updated (Pembelian): {product_name} increased by {qty}")
-                    else:
-                        logger.error(f"Failed to update stock (Pembelian) for: {product_name}")
+                item = repository.get(product_code)
+                if not item:
+                    logger.warning(f"Product code {product_code} not found in inventory for purchase stock update")
+                    continue
 
-                wb.save(jurnal_path)
+                product_name = item['name']
+                # The cost engine works in Rupiah per unit; prices are stored in sen.
+                unit_cost = (parse_amount(request.form.get(price_key)) or item.get('cost_price', 0)) / 100
+                position = tenant.cost_engine.receive(product_code, qty, unit_cost)
+                _append_stock_movement(wb, tanggal, voucher_id, product_code, product_name, qty, unit_cost, position)
+                success = update_inventory_stock(product_name, qty, avg_cost=position['avg_cost'])
+                if success:
+                    logger.info(f"Stock updated (Pembelian): {product_name} increased by {qty}")
+                else:
+                    logger.error(f"Failed to update stock (Pembelian) for: {product_name}")
 
-            else:
-                wb.save(jurnal_path)
+            save_workbook(wb, jurnal_path)
+            _journal_committed(tenant, jurnal_path)
 
-            # Redirect to journal page after successful save
-            flash("Transaksi berhasil disimpan.")
-            return redirect(url_for('journal'))
+        else:
+            save_workbook(wb, jurnal_path)
+            _journal_committed(tenant, jurnal_path)
 
-        except Exception as e:
-            error_msg = f"Terjadi kesalahan saat menyimpan transaksi: {str(e)}"
-            return render_template('input_transaksi.html', akun_options=akun_options, inventory_data=inventory_data, error=error_msg)
+    if idempotency_key:
+        tenant.idempotency.complete(idempotency_key, voucher_id)
 
-    return render_template('input_transaksi.html', 
-                           akun_options=akun_options, 
-                           inventory_data=inventory_data)
+    # Redirect to journal page after successful save
+    flash(f"Transaksi berhasil disimpan. No. voucher: {voucher_id}")
+    return redirect(url_for('journal'))
 
 def create_dummy_daftarsaldo():
+    tenant = current_tenant()
     try:
         base_dir = os.path.dirname(os.path.abspath(__file__))
-        bee_the_one_dir = DATA_DIR
-        file_path = SALDO_FILE
+        bee_the_one_dir = tenant.data_dir
+        file_path = tenant.saldo_file
 
         wb = openpyxl.Workbook()
         ws = wb.active
@@ -952,7 +2882,7 @@ def create_dummy_daftarsaldo():
             ws.append(akun)
 
         os.makedirs(bee_the_one_dir, exist_ok=True)
-        wb.save(file_path)
+        save_workbook(wb, file_path)
         logger.info(f"Dummy daftarsaldo.xlsx created at: {file_path}")
         return True
 
@@ -963,6 +2893,7 @@ def create_dummy_daftarsaldo():
 @app.route('/logout')
 def logout():
     session.pop('user', None)
+    session.pop('tenant', None)
     return redirect(url_for('login'))
 
 @app.route('/menu_madu')
@@ -1012,53 +2943,16 @@ def saldo_awal():
                 if (selected_year, selected_month) < (min_year, min_month):
                     return render_template('saldo_awal.html', saldo_data=saldo_data, tahun=tahun, bulan=bulan)
 
-        file_path = SALDO_FILE
-        wb = openpyxl.load_workbook(file_path)
-        ws = wb['daftar saldo awal'] if 'daftar saldo awal' in wb.sheetnames else wb.active
-        
-        for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-            if not row or all(cell is None for cell in row):
-                continue
-            if len(row) >= 2 and row[0] and row[1]:
-                no_akun = str(row[0]).strip()
-                nama_akun = str(row[1]).strip()
-                if (no_akun.startswith('=') or 'total' in no_akun.lower() or 
-                    'sum' in no_akun.lower() or no_akun == ''):
-                    continue
-                
-                side = str(row[2]).strip() if len(row) > 2 and row[2] else ''
-                debit_amount = 0
-                kredit_amount = 0
-                
-                if len(row) > 3 and row[3] is not None and row[3] != '':
-                    try:
-                        debit_amount = float(row[3])
-                    except (ValueError, TypeError):
-                        debit_amount = 0
-                if len(row) > 4 and row[4] is not None and row[4] != '':
-                    try:
-                        kredit_amount = float(row[4])
-                    except (ValueError, TypeError):
-                        kredit_amount = 0
-                        
-                final_side = side
-                if not final_side:
-                    if debit_amount > 0:
-                        final_side = 'Debit'
-                    elif kredit_amount > 0:
-                        final_side = 'Kredit'
-                    else:
-                        final_side = 'Debit'
-                        
-                saldo_data.append({
-                    'no_akun': no_akun,
-                    'nama_akun': nama_akun,
-                    'side': final_side,
-                    'debit': format_rupiah(debit_amount),
-                    'kredit': format_rupiah(kredit_amount)
-                })
-                total_debit += debit_amount
-                total_kredit += kredit_amount
+        opening = opening_balance_service()
+        for account in opening.records:
+            saldo_data.append({
+                'no_akun': account['no_akun'],
+                'nama_akun': account['nama_akun'],
+                'side': account['side'],
+                'debit': format_rupiah(account['debit']),
+                'kredit': format_rupiah(account['kredit'])
+            })
+        total_debit, total_kredit = opening.totals()
     except Exception as e:
         return render_template('saldo_awal.html', saldo_data=saldo_data, tahun=tahun, bulan=bulan, error=f"Error memuat data: {str(e)}")
     
@@ -1091,78 +2985,416 @@ def _parse_account_code_name(akun_raw):
     return akun_str, akun_str
 
 
-def _load_opening_balances():
+# Closing a period writes each account's closing balance into this sheet of
+# daftarsaldo.xlsx, tagged with the period it opens (YYYY-MM). Reports for a
+# period start from that snapshot instead of the static 'daftar saldo awal'.
+PERIOD_SNAPSHOT_SHEET = 'Saldo Periode'
+PERIOD_SNAPSHOT_HEADERS = ['Periode', 'No Akun', 'Nama Akun', 'Debit', 'Kredit']
+RETAINED_EARNINGS_ACCOUNT = ('3-3000', 'Modal')
+
+
+def _period_key(tahun, bulan):
+    """Return 'YYYY-MM' for a tahun/bulan-name pair, or None."""
+    month_code = MONTH_NAME_TO_NUM.get(bulan, None) if bulan else None
+    if not tahun or not month_code:
+        return None
+    return f"{tahun}-{month_code}"
+
+
+def _period_end(tahun, bulan):
+    """Last day (a date) of the tahun/bulan period."""
+    next_tahun, next_bulan = _next_period(tahun, bulan)
+    return datetime(int(next_tahun), int(MONTH_NAME_TO_NUM[next_bulan]), 1).date() - timedelta(days=1)
+
+
+def _next_period(tahun, bulan):
+    year, month = int(tahun), int(MONTH_NAME_TO_NUM[bulan])
+    if month == 12:
+        return str(year + 1), MONTH_NUM_TO_NAME[1]
+    return str(year), MONTH_NUM_TO_NAME[month + 1]
+
+
+def _load_opening_balances(tahun=None, bulan=None):
+    """Opening balances for a period: its close snapshot if one exists, else daftar saldo awal."""
+    period = _period_key(tahun, bulan)
+    if period:
+        snapshot = _load_period_snapshots().get(period)
+        if snapshot is not None:
+            return snapshot
+    return opening_balance_service().accounts
+
+
+class OpeningBalances:
+    """daftar saldo awal parsed once: one typed record per account, indexed by code and account type.
+
+    Records are {'no_akun', 'nama_akun', 'side', 'debit', 'kredit'} with int
+    sen amounts, in sheet order. Shared through the tenant cache, so read-only.
+    """
+
+    def __init__(self, records):
+        coa = chart_of_accounts()
+        self.records = list(records)
+        self.accounts = {record['no_akun']: record for record in self.records}
+        self._position = {record['no_akun']: index for index, record in enumerate(self.records)}
+        self.by_type = {}
+        for record in self.records:
+            self.by_type.setdefault(coa.get(record['no_akun'], record['nama_akun'])['tipe'], []).append(record)
+
+    def get(self, no_akun):
+        return self.accounts.get(no_akun)
+
+    def of_types(self, *types):
+        """Records of the given account types, in sheet order."""
+        found = [record for tipe in types for record in self.by_type.get(tipe, [])]
+        return sorted(found, key=lambda record: self._position[record['no_akun']])
+
+    def totals(self):
+        return sum(record['debit'] for record in self.records), sum(record['kredit'] for record in self.records)
+
+
+def opening_balance_service():
+    """The cached OpeningBalances of the current store; rebuilt when daftarsaldo.xlsx or the chart changes."""
+    tenant = current_tenant()
+    return _cached('opening_balances', [tenant.saldo_file, tenant.chart_of_accounts_file],
+                   lambda: OpeningBalances(_sidecar_table(tenant.saldo_file, 'opening', OPENING_BALANCE_SCHEMA,
+                                                          lambda: list(_read_opening_balances().values()))))
+
+
+def _load_period_snapshots():
+    return _cached('period_snapshots', [current_tenant().saldo_file], _read_period_snapshots)
+
+
+def _read_period_snapshots():
+    tenant = current_tenant()
+    snapshots = {}
+    if not os.path.exists(tenant.saldo_file):
+        return snapshots
+    try:
+        wb = openpyxl.load_workbook(tenant.saldo_file)
+        if PERIOD_SNAPSHOT_SHEET not in wb.sheetnames:
+            return snapshots
+        snapshots = _period_snapshots_from_rows(wb[PERIOD_SNAPSHOT_SHEET].iter_rows(min_row=2, values_only=True))
+    except Exception as e:
+        logger.error(f"Error loading period snapshots from {tenant.saldo_file}: {e}")
+    return snapshots
+
+
+def _period_snapshots_from_rows(rows):
+    snapshots = {}
+    for row in rows:
+        if not row or len(row) < 5 or not row[0] or not row[1]:
+            continue
+        period = str(row[0]).strip()
+        no_akun = str(row[1]).strip()
+        snapshots.setdefault(period, {})[no_akun] = {
+            'no_akun': no_akun,
+            'nama_akun': str(row[2] or no_akun).strip(),
+            'debit': to_sen(row[3]),
+            'kredit': to_sen(row[4]),
+        }
+    return snapshots
+
+
+# Locked (closed) periods reject postings and deletes. Locks and every
+# lock/reopen action are stored in daftarsaldo.xlsx; the audit sheet is
+# append-only.
+PERIOD_LOCK_SHEET = 'Periode Terkunci'
+PERIOD_LOCK_HEADERS = ['Periode', 'Dikunci Oleh', 'Waktu', 'ID Kunci']
+PERIOD_AUDIT_SHEET = 'Audit Periode'
+PERIOD_AUDIT_HEADERS = ['Waktu', 'Periode', 'Aksi', 'User', 'Alasan']
+
+class PeriodLockedError(Exception):
+    """Raised when a write targets a locked (closed) period."""
+
+
+def _locked_periods():
+    """Locked periods mapped to their lock generation ('ID Kunci', or 'Waktu' for older rows)."""
+    tenant = current_tenant()
+    def read():
+        locked = {}
+        if not os.path.exists(tenant.saldo_file):
+            return locked
+        try:
+            wb = openpyxl.load_workbook(tenant.saldo_file)
+            if PERIOD_LOCK_SHEET in wb.sheetnames:
+                locked = _locked_periods_from_rows(wb[PERIOD_LOCK_SHEET].iter_rows(min_row=2, values_only=True))
+        except Exception as e:
+            logger.error(f"Error loading period locks from {tenant.saldo_file}: {e}")
+        return locked
+    return _cached('locked_periods', [tenant.saldo_file], read)
+
+
+def _locked_periods_from_rows(rows):
+    locked = {}
+    for row in rows:
+        if row and row[0]:
+            locked[str(row[0]).strip()] = next((str(cell) for cell in reversed(row[2:4]) if cell), '')
+    return locked
+
+
+def _lock_generation(period):
+    """Identify the current lock of period, or None when it is open.
+
+    Immutable cache entries are keyed by it, so after a reopen and re-lock no
+    worker can serve figures it computed under an earlier lock.
+    """
+    if not period:
+        return None
+    locked = _locked_periods()
+    if period in locked:
+        return locked[period]
+    if period[:4] in archived_journal_years():
+        return 'arsip'
+    return None
+
+
+def is_period_locked(period):
+    if not period:
+        return False
+    return period in _locked_periods() or period[:4] in archived_journal_years()
+
+
+def _date_period(tanggal):
+    """Return 'YYYY-MM' for a date, datetime or 'YYYY-MM-DD' string, or None."""
+    if tanggal is None:
+        return None
+    if hasattr(tanggal, 'strftime'):
+        return tanggal.strftime('%Y-%m')
+    text = str(tanggal).strip()
+    return text[:7] if len(text) >= 7 and text[4] == '-' else None
+
+
+def ensure_period_open(tanggal):
+    period = _date_period(tanggal)
+    if is_period_locked(period):
+        raise PeriodLockedError(f"Periode {period} sudah ditutup dan dikunci.")
+
+
+# Sentinel so a cached None still counts as a hit.
+_MISSING = object()
+
+
+def _period_cached(key, tahun, bulan, paths, loader):
+    """Like _cached, but results for a locked period are computed once and kept for good."""
+    # Aggregates of locked periods can never change, so they are kept without a
+    # file signature. They are keyed by the lock generation: a reopen in another
+    # worker only clears its own cache, but the re-lock writes a new generation.
+    period = _period_key(tahun, bulan)
+    generation = _lock_generation(period)
+    if generation is None:
+        return _cached(key, paths, loader)
+    tenant = current_tenant()
+    value = tenant.immutable_get((period, generation, key), _MISSING)
+    if value is _MISSING:
+        value = loader()
+        tenant.immutable_put((period, generation, key), value)
+    return value
+
+
+def _invalidate_immutable(period):
+    tenant = current_tenant()
+    with tenant.cache_lock:
+        for key in [k for k in tenant.immutable if k[0] == period]:
+            del tenant.immutable[key]
+
+
+def _audit_period(wb, period, aksi, user, alasan=''):
+    if PERIOD_AUDIT_SHEET not in wb.sheetnames:
+        wb.create_sheet(PERIOD_AUDIT_SHEET).append(PERIOD_AUDIT_HEADERS)
+    wb[PERIOD_AUDIT_SHEET].append([datetime.now().strftime('%Y-%m-%d %H:%M:%S'), period, aksi, user, alasan])
+
+
+def lock_period(period, user):
+    tenant = current_tenant()
+    with tenant.saldo_write_lock:
+        wb = openpyxl.load_workbook(tenant.saldo_file) if os.path.exists(tenant.saldo_file) else openpyxl.Workbook()
+        if PERIOD_LOCK_SHEET not in wb.sheetnames:
+            wb.create_sheet(PERIOD_LOCK_SHEET).append(PERIOD_LOCK_HEADERS)
+        ws = wb[PERIOD_LOCK_SHEET]
+        if any(row and str(row[0]).strip() == period for row in ws.iter_rows(min_row=2, values_only=True)):
+            return False
+        ws.cell(row=1, column=len(PERIOD_LOCK_HEADERS), value=PERIOD_LOCK_HEADERS[-1])
+        ws.append([period, user, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), secrets.token_hex(8)])
+        _audit_period(wb, period, 'KUNCI', user)
+        save_workbook(wb, tenant.saldo_file)
+    logger.info(f"Period {period} locked by {user}")
+    return True
+
+
+def reopen_period(period, user, alasan):
+    """Unlock a period. A reason is mandatory and recorded in the audit sheet."""
+    tenant = current_tenant()
+    if not (alasan or '').strip():
+        raise ValueError("Alasan membuka kembali periode wajib diisi.")
+    with tenant.saldo_write_lock:
+        if not os.path.exists(tenant.saldo_file):
+            return False
+        wb = openpyxl.load_workbook(tenant.saldo_file)
+        if PERIOD_LOCK_SHEET not in wb.sheetnames:
+            return False
+        ws = wb[PERIOD_LOCK_SHEET]
+        rows = list(ws.iter_rows(min_row=2, values_only=True))
+        kept = [row for row in rows if row and str(row[0]).strip() != period]
+        if len(kept) == len(rows):
+            return False
+        ws.delete_rows(2, ws.max_row)
+        for row in kept:
+            ws.append(list(row))
+        _audit_period(wb, period, 'BUKA', user, alasan.strip())
+        save_workbook(wb, tenant.saldo_file)
+    _invalidate_immutable(period)
+    logger.warning(f"Period {period} reopened by {user}: {alasan}")
+    return True
+
+
+def close_period(tahun, bulan, user=None):
+    """Roll the closing balances of tahun/bulan forward as the next period's opening balances.
+
+    A December close is a year close: nominal balances (revenue, HPP, expense
+    and the Ikhtisar Laba Rugi clearing account) are folded into Modal so the
+    new year opens with them at zero. Returns the snapshot period.
+    """
+    tenant = current_tenant()
+    next_tahun, next_bulan = _next_period(tahun, bulan)
+    next_key = _period_key(next_tahun, next_bulan)
+    year_close = bulan == 'Desember'
+    if is_period_locked(next_key):
+        raise PeriodLockedError(f"Periode {next_key} sudah dikunci; saldo awalnya tidak dapat diubah.")
+
+    # Postings check the lock under the journal lock; holding it from the
+    # snapshot until the period is locked keeps late lines out of a closed month.
+    with tenant.journal_write_lock:
+        coa = chart_of_accounts()
+        closing = {}
+        for item in _compute_neraca_saldo_data(tahun, bulan):
+            no_akun = item['no_akun']
+            net = (item['debit'] or 0) - (item['kredit'] or 0)
+            if year_close and coa.get(no_akun, item['nama_akun'])['nominal']:
+                no_akun, nama_akun = RETAINED_EARNINGS_ACCOUNT
+            else:
+                nama_akun = item['nama_akun']
+            closing.setdefault(no_akun, {'nama_akun': nama_akun, 'net': 0})['net'] += net
+
+        with tenant.saldo_write_lock:
+            wb = openpyxl.load_workbook(tenant.saldo_file) if os.path.exists(tenant.saldo_file) else openpyxl.Workbook()
+            if PERIOD_SNAPSHOT_SHEET in wb.sheetnames:
+                ws = wb[PERIOD_SNAPSHOT_SHEET]
+                kept = [row for row in ws.iter_rows(min_row=2, values_only=True) if row and str(row[0]).strip() != next_key]
+                ws.delete_rows(2, ws.max_row)
+                for row in kept:
+                    ws.append(list(row))
+            else:
+                ws = wb.create_sheet(PERIOD_SNAPSHOT_SHEET)
+                ws.append(PERIOD_SNAPSHOT_HEADERS)
+            for no_akun, acc in sorted(closing.items()):
+                net = acc['net']
+                ws.append([next_key, no_akun, acc['nama_akun'], from_sen(net if net > 0 else 0), from_sen(-net if net < 0 else 0)])
+            save_workbook(wb, tenant.saldo_file)
+
+        logger.info(f"Closed period {_period_key(tahun, bulan)}: {len(closing)} account balances rolled to {next_key}")
+        lock_period(_period_key(tahun, bulan), user or 'system')
+    return next_key
+
+
+def _read_opening_balances():
+    tenant = current_tenant()
     opening = {}
-    if not os.path.exists(SALDO_FILE):
-        logger.warning(f"Opening balance file not found: {SALDO_FILE}")
+    if not os.path.exists(tenant.saldo_file):
+        logger.warning(f"Opening balance file not found: {tenant.saldo_file}")
         return opening
     try:
-        wb = openpyxl.load_workbook(SALDO_FILE)
+        wb = openpyxl.load_workbook(tenant.saldo_file)
         ws = wb['daftar saldo awal'] if 'daftar saldo awal' in wb.sheetnames else wb.active
+        opening = _opening_balances_from_rows(ws.iter_rows(min_row=2, values_only=True))
+    except Exception as e:
+        logger.error(f"Error loading opening balances from {tenant.saldo_file}: {e}")
 
-        for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-            if not row or all(cell is None for cell in row):
-                logger.debug(f"Skipping empty or None row {idx}")
-                continue
-            if len(row) >= 2 and row[0] and row[1]:
-                no_akun = str(row[0]).strip()
-                nama_akun = str(row[1]).strip()
-                if (no_akun.startswith('=') or 'total' in no_akun.lower() or
-                    'sum' in no_akun.lower() or no_akun == ''):
-                    logger.debug(f"Skipping row {idx} due to no_akun filter: {no_akun}")
-                    continue
+    return opening
 
-                debit_amount = 0.0
-                kredit_amount = 0.0
 
-                if len(row) > 3 and row[3] is not None and row[3] != '':
-                    try:
-                        debit_amount = float(row[3])
-                    except (ValueError, TypeError) as err:
-                        logger.error(f"Row {idx} debit_amount conversion error: {err}, value: {row[3]}")
-                        debit_amount = 0.0
-                if len(row) > 4 and row[4] is not None and row[4] != '':
-                    try:
-                        kredit_amount = float(row[4])
-                    except (ValueError, TypeError) as err:
-                        logger.error(f"Row {idx} kredit_amount conversion error: {err}, value: {row[4]}")
-                        kredit_amount = 0.0
-
-                if no_akun not in opening:
-                    opening[no_akun] = {
-                        'no_akun': no_akun,
-                        'nama_akun': nama_akun,
-                        'debit': 0.0,
-                        'kredit': 0.0,
-                    }
-                opening[no_akun]['debit'] += debit_amount
-                opening[no_akun]['kredit'] += kredit_amount
-            else:
-                logger.debug(f"Row {idx} skipped due to insufficient length or missing values")
-    except Exception as e:
-        logger.error(f"Error loading opening balances from {SALDO_FILE}: {e}")
+def _opening_balances_from_rows(rows):
+    """Opening balances keyed by no_akun from the data rows (below the header) of daftar saldo awal."""
+    opening = {}
+    for idx, row in enumerate(rows, start=2):
+        if not row or all(cell is None for cell in row):
+            logger.debug(f"Skipping empty or None row {idx}")
+            continue
+        if len(row) >= 2 and row[0] and row[1]:
+            no_akun = str(row[0]).strip()
+            nama_akun = str(row[1]).strip()
+            if (no_akun.startswith('=') or 'total' in no_akun.lower() or
+                'sum' in no_akun.lower() or no_akun == ''):
+                logger.debug(f"Skipping row {idx} due to no_akun filter: {no_akun}")
+                continue
+
+            side = str(row[2]).strip() if len(row) > 2 and row[2] else ''
+            debit_amount = to_sen(row[3]) if len(row) > 3 else 0
+            kredit_amount = to_sen(row[4]) if len(row) > 4 else 0
 
+            if no_akun not in opening:
+                opening[no_akun] = {
+                    'no_akun': no_akun,
+                    'nama_akun': nama_akun,
+                    'side': side,
+                    'debit': 0,
+                    'kredit': 0,
+                }
+            opening[no_akun]['side'] = opening[no_akun]['side'] or side
+            opening[no_akun]['debit'] += debit_amount
+            opening[no_akun]['kredit'] += kredit_amount
+        else:
+            logger.debug(f"Row {idx} skipped due to insufficient length or missing values")
+    for account in opening.values():
+        if not account['side']:
+            # No explicit Posisi column: the side follows the balance, Debit when empty.
+            account['side'] = 'Kredit' if account['kredit'] > 0 and account['debit'] <= 0 else 'Debit'
     return opening
 
 
 def load_journal_entries(tahun=None, bulan=None):
+    period = _period_key(tahun, bulan)
+    if period is None:
+        paths = journal_paths()
+        if len(paths) == 1:
+            return _load_journal_file(paths[0])
+        return _cached('journal_entries_all', paths,
+                       lambda: [entry for path in paths for entry in _load_journal_file(path)])
+    # A period only ever needs the file its year is routed to.
+    by_period = _journal_by_period(journal_file_for(tahun))
+    # Undated rows have always been included in every period.
+    return by_period.get(None, []) + by_period.get(period, [])
+
+
+def _load_journal_file(path):
+    return _cached(('journal_entries', path), [path],
+                   lambda: _sidecar_table(path, 'journal', JOURNAL_SCHEMA, lambda: _read_journal_entries(path)))
+
+
+def _journal_by_period(path):
+    """Journal entries of one file bucketed by 'YYYY-MM' (None for undated rows)."""
+    def build():
+        buckets = {}
+        for entry in _load_journal_file(path):
+            key = entry['tanggal'].strftime('%Y-%m') if entry['tanggal'] else None
+            buckets.setdefault(key, []).append(entry)
+        return buckets
+    return _cached(('journal_by_period', path), [path], build)
+
+
+def _read_journal_entries(path):
     entries = []
-    if not os.path.exists(JOURNAL_FILE):
-        logger.warning(f"Journal file not found: {JOURNAL_FILE}")
+    if not os.path.exists(path):
+        logger.warning(f"Journal file not found: {path}")
         return entries
     try:
-        wb = openpyxl.load_workbook(JOURNAL_FILE)
+        wb = openpyxl.load_workbook(path)
         if 'Journal' not in wb.sheetnames:
             logger.warning("'Journal' sheet not found in jurnal.xlsx")
             return entries
         ws = wb['Journal']
 
-        month_num = None
-        if bulan:
-            month_num = MONTH_NAME_TO_NUM.get(bulan, None)
-
         for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-            if not row or len(row) < 3:
+            if not row or len(row) < 3 or _is_tombstoned(row):
                 continue
             raw_date = row[0]
             keterangan = row[1]
@@ -1179,42 +3411,66 @@ def load_journal_entries(tahun=None, bulan=None):
                 except ValueError:
                     logger.warning(f"Unable to parse date in journal row {idx}: {raw_date}")
 
-            if tahun and bulan and date_obj is not None and month_num is not None:
-                if str(date_obj.year) != str(tahun) or f"{date_obj.month:02d}" != month_num:
-                    continue
-
             no_akun, nama_akun = _parse_account_code_name(akun_raw)
 
             debit_val = row[3] if len(row) > 3 else 0
             kredit_val = row[4] if len(row) > 4 else 0
-            try:
-                debit = float(debit_val) if debit_val else 0.0
-            except (ValueError, TypeError):
-                debit = 0.0
-            try:
-                kredit = float(kredit_val) if kredit_val else 0.0
-            except (ValueError, TypeError):
-                kredit = 0.0
+            debit = to_sen(debit_val)
+            kredit = to_sen(kredit_val)
+
+            entry_id = row[JOURNAL_COL_ID - 1] if len(row) >= JOURNAL_COL_ID else None
+            voucher_id = row[JOURNAL_COL_VOUCHER - 1] if len(row) >= JOURNAL_COL_VOUCHER else None
 
             entries.append({
                 'row_index': idx,
+                'entry_id': str(entry_id) if entry_id else f"R{idx}",
+                'voucher': str(voucher_id) if voucher_id else None,
                 'tanggal': date_obj,
                 'keterangan': keterangan,
+                'akun': str(akun_raw).strip(),
                 'no_akun': no_akun,
                 'nama_akun': nama_akun,
                 'debit': debit,
                 'kredit': kredit,
             })
     except Exception as e:
-        logger.error(f"Error loading journal entries from {JOURNAL_FILE}: {e}")
+        logger.error(f"Error loading journal entries from {path}: {e}")
 
     return entries
 
 
+def _sum_by_account(entries):
+    """Exact per-account debit/kredit totals as (no_akun, nama_akun, debit, kredit).
+
+    Sums run on int64 arrays, so there is no float drift; accounts keep the
+    order in which they first appear in the journal.
+    """
+    if not entries:
+        return []
+    codes = np.array([entry['no_akun'] for entry in entries], dtype=object)
+    debit = np.fromiter((entry['debit'] for entry in entries), dtype=np.int64, count=len(entries))
+    kredit = np.fromiter((entry['kredit'] for entry in entries), dtype=np.int64, count=len(entries))
+    keys, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    debit_sum = np.zeros(len(keys), dtype=np.int64)
+    kredit_sum = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(debit_sum, inverse, debit)
+    np.add.at(kredit_sum, inverse, kredit)
+    return [(keys[i], entries[first[i]]['nama_akun'], int(debit_sum[i]), int(kredit_sum[i]))
+            for i in np.argsort(first, kind='stable')]
+
+
 def load_neraca_saldo_data(tahun=None, bulan=None):
-    opening = _load_opening_balances()
-    journal_entries = load_journal_entries(tahun, bulan)
+    return _period_cached(('neraca_saldo', tahun, bulan), tahun, bulan, [current_tenant().saldo_file, journal_file_for(tahun)],
+                          lambda: _compute_neraca_saldo_data(tahun, bulan))
+
 
+def _compute_neraca_saldo_data(tahun=None, bulan=None):
+    opening = _load_opening_balances(tahun, bulan)
+    return _trial_balance_rows(opening, _sum_by_account(load_journal_entries(tahun, bulan)))
+
+
+def _trial_balance_rows(opening, movements):
+    """Trial-balance rows from opening balances plus (no_akun, nama_akun, debit, kredit) movements."""
     saldo_per_akun = {}
 
     for no_akun, acc in opening.items():
@@ -1225,28 +3481,24 @@ def load_neraca_saldo_data(tahun=None, bulan=None):
             'kredit': acc['kredit'],
         }
 
-    for entry in journal_entries:
-        no_akun = entry['no_akun']
-        nama_akun = entry['nama_akun']
-        debit = entry['debit']
-        kredit = entry['kredit']
+    for no_akun, nama_akun, debit, kredit in movements:
         if no_akun not in saldo_per_akun:
             saldo_per_akun[no_akun] = {
                 'no_akun': no_akun,
                 'nama_akun': nama_akun,
-                'debit': 0.0,
-                'kredit': 0.0,
+                'debit': 0,
+                'kredit': 0,
             }
         saldo_per_akun[no_akun]['debit'] += debit
         saldo_per_akun[no_akun]['kredit'] += kredit
 
     saldo_data = []
-    total_debit = 0.0
-    total_kredit = 0.0
+    total_debit = 0
+    total_kredit = 0
 
     for acc in saldo_per_akun.values():
-        debit_amount = acc['debit'] or 0.0
-        kredit_amount = acc['kredit'] or 0.0
+        debit_amount = acc['debit'] or 0
+        kredit_amount = acc['kredit'] or 0
         if debit_amount == 0 and kredit_amount == 0:
             continue
         if debit_amount > kredit_amount:
@@ -1284,14 +3536,15 @@ def _get_min_journal_period():
     return min_date.year, min_date.month
 
 
-@app.route('/buku_besar')
-@login_required
-def buku_besar():
-    search_query = request.args.get('search', '').strip().lower()
-    tahun = request.args.get('tahun')
-    bulan = request.args.get('bulan')
+def build_ledgers(tahun=None, bulan=None):
+    """All account ledgers (opening row plus running balance per line) for a period."""
+    return _period_cached(('ledgers', tahun, bulan), tahun, bulan, [current_tenant().saldo_file, journal_file_for(tahun)],
+                          lambda: _compute_ledgers(tahun, bulan))
+
 
-    opening_balances = _load_opening_balances()
+def _compute_ledgers(tahun=None, bulan=None):
+    coa = chart_of_accounts()
+    opening_balances = _load_opening_balances(tahun, bulan)
     journal_entries = load_journal_entries(tahun, bulan)
 
     ledger_map = {}
@@ -1300,9 +3553,7 @@ def buku_besar():
     # This ensures accounts like "Penjualan" appear even with zero balance
     for no_akun, acc in opening_balances.items():
         nama_akun = acc['nama_akun']
-        if search_query and search_query not in no_akun.lower() and search_query not in nama_akun.lower():
-            continue
-        saldo_awal = (acc['debit'] or 0.0) - (acc['kredit'] or 0.0)
+        saldo_awal = (acc['debit'] or 0) - (acc['kredit'] or 0)
         ledger_map[no_akun] = {
             'no_akun': no_akun,
             'nama_akun': nama_akun,
@@ -1310,13 +3561,13 @@ def buku_besar():
             'saldo_running': saldo_awal,
         }
         # Always show opening balance entry, even if zero (for revenue/expense accounts)
-        if saldo_awal != 0 or no_akun.startswith('4') or no_akun.startswith('5') or no_akun.startswith('6'):
+        if saldo_awal != 0 or coa.get(no_akun, nama_akun)['tipe'] in NOMINAL_ACCOUNT_TYPES:
             ledger_map[no_akun]['entries'].append({
                 'no': 1,
                 'tanggal': '-',
                 'keterangan': 'Saldo Awal',
-                'debet': acc['debit'] or 0.0,
-                'kredit': acc['kredit'] or 0.0,
+                'debet': acc['debit'] or 0,
+                'kredit': acc['kredit'] or 0,
                 'saldo': saldo_awal,
             })
 
@@ -1331,20 +3582,18 @@ def buku_besar():
     for entry in sorted_journal:
         no_akun = entry['no_akun']
         nama_akun = entry['nama_akun']
-        if search_query and search_query not in no_akun.lower() and search_query not in nama_akun.lower():
-            continue
 
         if no_akun not in ledger_map:
             ledger_map[no_akun] = {
                 'no_akun': no_akun,
                 'nama_akun': nama_akun,
                 'entries': [],
-                'saldo_running': 0.0,
+                'saldo_running': 0,
             }
 
         ledger = ledger_map[no_akun]
-        debit = entry['debit'] or 0.0
-        kredit = entry['kredit'] or 0.0
+        debit = entry['debit'] or 0
+        kredit = entry['kredit'] or 0
         ledger['saldo_running'] += debit - kredit
 
         tanggal_str = ''
@@ -1365,12 +3614,216 @@ def buku_besar():
 
     ledgers = list(ledger_map.values())
     ledgers.sort(key=lambda x: x['no_akun'])
+    return ledgers
+
+
+# Arbitrary date ranges (?dari=&sampai=) are answered from per-account daily
+# prefix sums: the movement of an account between two dates is two lookups.
+# The index is rebuilt with the other journal caches whenever a journal file
+# changes, so back-dated postings are covered without an updatable tree.
+class DailyBalanceIndex:
+    """Cumulative debit/kredit per account over the sorted posting days (undated lines are left out)."""
+
+    def __init__(self, entries):
+        dated = [entry for entry in entries if entry['tanggal'] is not None]
+        self.days = sorted({entry['tanggal'] for entry in dated})
+        day_pos = {day: pos for pos, day in enumerate(self.days)}
+        self.accounts = []
+        account_pos = {}
+        for entry in dated:
+            if entry['no_akun'] not in account_pos:
+                account_pos[entry['no_akun']] = len(self.accounts)
+                self.accounts.append((entry['no_akun'], entry['nama_akun']))
+
+        shape = (len(self.accounts), len(self.days) + 1)
+        self.debit = np.zeros(shape, dtype=np.int64)
+        self.kredit = np.zeros(shape, dtype=np.int64)
+        if dated:
+            rows = np.fromiter((account_pos[e['no_akun']] for e in dated), dtype=np.intp, count=len(dated))
+            cols = np.fromiter((day_pos[e['tanggal']] + 1 for e in dated), dtype=np.intp, count=len(dated))
+            np.add.at(self.debit, (rows, cols), np.fromiter((e['debit'] for e in dated), dtype=np.int64, count=len(dated)))
+            np.add.at(self.kredit, (rows, cols), np.fromiter((e['kredit'] for e in dated), dtype=np.int64, count=len(dated)))
+            np.cumsum(self.debit, axis=1, out=self.debit)
+            np.cumsum(self.kredit, axis=1, out=self.kredit)
+
+    def totals(self, dari, sampai):
+        """Per-account (no_akun, nama_akun, debit, kredit) moved in the inclusive range dari..sampai."""
+        if dari > sampai:
+            return []
+        lo = bisect_left(self.days, dari)
+        hi = bisect_right(self.days, sampai)
+        debit = self.debit[:, hi] - self.debit[:, lo]
+        kredit = self.kredit[:, hi] - self.kredit[:, lo]
+        return [(code, name, int(debit[i]), int(kredit[i]))
+                for i, (code, name) in enumerate(self.accounts) if debit[i] or kredit[i]]
+
+
+def daily_balance_index():
+    return _cached('daily_balance_index', journal_paths(), lambda: DailyBalanceIndex(load_journal_entries()))
+
+
+def _range_opening(dari):
+    """Opening balances of dari's month plus the movements from the 1st up to the day before dari."""
+    opening = {no_akun: dict(acc) for no_akun, acc in _load_opening_balances(str(dari.year), MONTH_NUM_TO_NAME[dari.month]).items()}
+    for no_akun, nama_akun, debit, kredit in daily_balance_index().totals(dari.replace(day=1), dari - timedelta(days=1)):
+        acc = opening.setdefault(no_akun, {'no_akun': no_akun, 'nama_akun': nama_akun, 'debit': 0, 'kredit': 0})
+        acc['debit'] += debit
+        acc['kredit'] += kredit
+    return opening
+
+
+def load_neraca_saldo_range(dari, sampai):
+    """Trial balance as of sampai, for a report covering dari..sampai (dates)."""
+    return _cached(('neraca_saldo_range', dari, sampai), [current_tenant().saldo_file] + journal_paths(),
+                   lambda: _trial_balance_rows(_range_opening(dari), daily_balance_index().totals(dari, sampai)))
+
+
+def build_ledgers_range(dari, sampai):
+    """Account ledgers for dari..sampai: one opening row, then the lines in the range."""
+    opening = _range_opening(dari)
+    index = _journal_sort_index()
+    keys = index['keys']
+    lo = bisect_left(keys, (dari.isoformat(), ''))
+    hi = bisect_right(keys, (sampai.isoformat(), '\uffff'))
+
+    ledgers = []
+    for no_akun in sorted(set(opening) | set(index['by_account'])):
+        positions = index['by_account'].get(no_akun, [])
+        in_range = [index['entries'][pos] for pos in positions[bisect_left(positions, lo):bisect_left(positions, hi)]]
+        acc = opening.get(no_akun)
+        saldo = (acc['debit'] - acc['kredit']) if acc else 0
+        if not in_range and saldo == 0:
+            continue
+        nama_akun = acc['nama_akun'] if acc else in_range[0]['nama_akun']
+        entries = [{
+            'no': 1,
+            'tanggal': '-',
+            'keterangan': 'Saldo Awal',
+            'debet': acc['debit'] if acc else 0,
+            'kredit': acc['kredit'] if acc else 0,
+            'saldo': saldo,
+        }]
+        for entry in in_range:
+            saldo += entry['debit'] - entry['kredit']
+            entries.append({
+                'no': len(entries) + 1,
+                'tanggal': entry['tanggal'].strftime('%Y-%m-%d'),
+                'keterangan': entry['keterangan'] or '',
+                'debet': entry['debit'],
+                'kredit': entry['kredit'],
+                'saldo': saldo,
+            })
+        ledgers.append({'no_akun': no_akun, 'nama_akun': nama_akun, 'entries': entries, 'saldo_running': saldo})
+    return ledgers
+
+
+def build_posisi_keuangan_range(dari, sampai):
+    return _compute_posisi_keuangan(load_neraca_saldo_range(dari, sampai), f"{dari.isoformat()}..{sampai.isoformat()}")
+
+
+def _requested_range():
+    """(dari, sampai) dates from ?dari=YYYY-MM-DD&sampai=YYYY-MM-DD, or None when absent or invalid."""
+    dari = request.args.get('dari', '').strip()
+    sampai = request.args.get('sampai', '').strip()
+    if not dari or not sampai:
+        return None
+    try:
+        dari_date = datetime.strptime(dari, '%Y-%m-%d').date()
+        sampai_date = datetime.strptime(sampai, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+    if dari_date > sampai_date:
+        return None
+    return dari_date, sampai_date
+
+
+# Report views are async (Flask runs them with asgiref, i.e. flask[async];
+# see login_required for the fallback without it).
+# Workbook parsing is blocking, so it runs on a small bounded thread pool and
+# the journal, opening balance and inventory workbooks of a cold report are
+# loaded side by side instead of one after another. Everything lands in the
+# tenant caches, so the report builders that follow are cache hits.
+IO_WORKERS = int(os.environ.get('SIA_IO_WORKERS', '4'))
+_io_pool = None
+_io_pool_lock = threading.Lock()
+
+
+def _get_io_pool():
+    global _io_pool
+    with _io_pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='sia-io')
+        return _io_pool
+
+
+def _reset_io_pool_after_fork():
+    global _io_pool, _io_pool_lock
+    # The parent's pool threads do not exist in a forked child.
+    _io_pool = None
+    _io_pool_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_io_pool_after_fork)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Await fn(*args, **kwargs) on the I/O pool, in the caller's store."""
+    tenant = current_tenant()
+
+    def call():
+        with tenant_context(tenant):
+            return fn(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_get_io_pool(), call)
+
+
+async def load_journal_entries_async(tahun=None, bulan=None):
+    return await run_blocking(load_journal_entries, tahun, bulan)
+
+
+async def load_opening_balances_async(tahun=None, bulan=None):
+    return await run_blocking(_load_opening_balances, tahun, bulan)
+
+
+async def load_inventory_async():
+    return await run_blocking(load_inventory)
+
+
+async def load_report_inputs(tahun=None, bulan=None, date_range=None):
+    """Load the three workbooks a report depends on concurrently.
+
+    A dari/sampai range spans periods, so it warms the whole journal and
+    daftar saldo awal rather than one period's slice.
+    """
+    if date_range:
+        tahun = bulan = None
+    return await asyncio.gather(load_journal_entries_async(tahun, bulan),
+                                load_opening_balances_async(tahun, bulan),
+                                load_inventory_async())
+
+
+@app.route('/buku_besar')
+@login_required
+async def buku_besar():
+    search_query = request.args.get('search', '').strip().lower()
+    tahun = request.args.get('tahun')
+    bulan = request.args.get('bulan')
+    date_range = _requested_range()
+
+    await load_report_inputs(tahun, bulan, date_range)
+    ledgers = build_ledgers_range(*date_range) if date_range else build_ledgers(tahun, bulan)
+    if search_query:
+        ledgers = [
+            ledger for ledger in ledgers
+            if search_query in ledger['no_akun'].lower() or search_query in ledger['nama_akun'].lower()
+        ]
 
-    return render_template('buku_besar.html', ledgers=ledgers, search_query=search_query, tahun=tahun, bulan=bulan)
+    return render_template('buku_besar.html', ledgers=ledgers, search_query=search_query, tahun=tahun, bulan=bulan,
+                           dari=request.args.get('dari'), sampai=request.args.get('sampai'))
 
 @app.route('/financial_reports')
 @login_required
-def financial_reports():
+async def financial_reports():
     tahun = request.args.get('tahun', '2025')
     bulan = request.args.get('bulan', 'November')
 
@@ -1383,6 +3836,8 @@ def financial_reports():
                                tahun=tahun,
                                bulan=bulan)
 
+    await load_report_inputs(tahun, bulan)
+
     # Also hide periods before the first journal month
     min_year, min_month = _get_min_journal_period()
     if min_year is not None and min_month is not None:
@@ -1425,163 +3880,165 @@ from flask import flash
 @app.route('/jurnal_penutup', methods=['GET', 'POST'])
 @login_required
 def jurnal_penutup():
+    tenant = current_tenant()
     saldo_closing_accounts = []
     closing_entries = []
     error = None
     message = None
 
+    today = datetime.today()
+    tahun = request.values.get('tahun') or str(today.year)
+    bulan = request.values.get('bulan') or MONTH_NUM_TO_NAME[today.month]
+    period = _period_key(tahun, bulan)
+
     def load_closing_balances():
-        saldo_data = []
-        file_path = SALDO_FILE
+        nonlocal error
         try:
-            wb = openpyxl.load_workbook(file_path)
-            ws = wb['daftar saldo awal'] if 'daftar saldo awal' in wb.sheetnames else wb.active
-
-            for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-                if not row or all(cell is None for cell in row):
-                    continue
-                if len(row) >= 2 and row[0] and row[1]:
-                    no_akun = str(row[0]).strip()
-                    nama_akun = str(row[1]).strip()
-                    if (no_akun.startswith('=') or 'total' in no_akun.lower() or
-                        'sum' in no_akun.lower() or no_akun == ''):
-                        continue
-
-                    side = str(row[2]).strip() if len(row) > 2 and row[2] else ''
-                    debit_amount = 0
-                    kredit_amount = 0
-
-                    if len(row) > 3 and row[3] is not None and row[3] != '':
-                        try:
-                            debit_amount = float(row[3])
-                        except (ValueError, TypeError):
-                            debit_amount = 0
-                    if len(row) > 4 and row[4] is not None and row[4] != '':
-                        try:
-                            kredit_amount = float(row[4])
-                        except (ValueError, TypeError):
-                            kredit_amount = 0
-
-                    final_side = side
-                    if not final_side:
-                        if debit_amount > 0:
-                            final_side = 'Debit'
-                        elif kredit_amount > 0:
-                            final_side = 'Kredit'
-                        else:
-                            final_side = 'Debit'
-
-                    # We consider only Pendapatan (income) and Beban (expenses) account types
-                    # From the account number prefix, e.g., 4xxxx for Pendapatan, 5xxxx or 6xxxx for Beban
-                    if no_akun.startswith('4') or no_akun.startswith('5') or no_akun.startswith('6'):
-                        saldo_data.append({
-                            'no_akun': no_akun,
-                            'nama_akun': nama_akun,
-                            'side': final_side,
-                            'debit': debit_amount,
-                            'kredit': kredit_amount
-                        })
-            return saldo_data
+            # Only Pendapatan (income), HPP and Beban (expenses) accounts are closed,
+            # at their actual balance for the period being closed.
+            coa = chart_of_accounts()
+            return [dict(account) for account in _compute_neraca_saldo_data(tahun, bulan)
+                    if coa.get(account['no_akun'], account['nama_akun'])['tipe'] in NOMINAL_ACCOUNT_TYPES]
         except Exception as e:
-            # nonlocal error
             error = f"Error loading saldo data: {str(e)}"
             return []
 
-    if request.method == 'POST':
-        saldo_closing_accounts = load_closing_balances()
-        if not saldo_closing_accounts:
-            error = error or "No closing accounts found to create jurnal penutup."
-        else:
-            try:
-                jurnal_path = JOURNAL_FILE
-                if not os.path.exists(jurnal_path):
-                    wb = openpyxl.Workbook()
-                    ws = wb.active
-                    ws.title = 'Journal'
-                    ws.append(['Tanggal', 'Keterangan', 'Akun', 'Debit', 'Kredit'])
-                    wb.save(jurnal_path)
-
-                wb = openpyxl.load_workbook(jurnal_path)
-                if 'Journal' in wb.sheetnames:
-                    ws = wb['Journal']
+    if not period:
+        error = "Periode tidak valid."
+    elif request.method == 'POST':
+        try:
+            jurnal_path = tenant.journal_file
+            # One journal lock from the balances through close_period, so no
+            # posting lands between the closing entries and the lock.
+            with tenant.journal_write_lock:
+                saldo_closing_accounts = load_closing_balances()
+                if is_period_locked(period):
+                    error = f"Periode {period} sudah ditutup dan dikunci."
+                elif not saldo_closing_accounts:
+                    error = error or "No closing accounts found to create jurnal penutup."
                 else:
-                    ws = wb.create_sheet('Journal')
-                    ws.append(['Tanggal', 'Keterangan', 'Akun', 'Debit', 'Kredit'])
-
-                today_str = pd.Timestamp.today().strftime('%Y-%m-%d')
-                closing_entries = []
-                for account in saldo_closing_accounts:
-                    no_akun = account['no_akun']
-                    nama_akun = account['nama_akun']
-                    debit = account['debit']
-                    kredit = account['kredit']
-                    saldo = debit - kredit
-
-                    if saldo == 0:
-                        continue
-
-                    akun_penutup = ''
-                    debit_entry = 0
-                    kredit_entry = 0
-
-                    # Logic: Pendapatan (Income) accounts (4xxx) saldo normal kredit,
-                    # so their saldo is kredit > debit -> nilai saldo positif artinya kredit,
-                    # harus didebitkan ke akun penutup.
-                    # Beban (Expense) accounts (5xxx,6xxx) saldo normal debit,
-                    # jadi saldo > 0 artinya debit harus dikreditkan ke akun penutup.
-                    if no_akun.startswith('4'):
-                        akun_penutup = '3101 - Ikhtisar Laba Rugi'  # contoh akun penutup laba rugi
-                        if saldo > 0:
-                            debit_entry = saldo
-                        else:
-                            kredit_entry = abs(saldo)
-                    elif no_akun.startswith('5') or no_akun.startswith('6'):
-                        akun_penutup = '3101 - Ikhtisar Laba Rugi'
-                        if saldo > 0:
-                            kredit_entry = saldo
-                        else:
-                            debit_entry = abs(saldo)
-
-                    if debit_entry > 0:
-                        ws.append([today_str, f'Penutupan akun {no_akun} {nama_akun}', no_akun, debit_entry, 0])
-                        ws.append([today_str, f'Penutupan ke akun penutup', akun_penutup, 0, debit_entry])
-                        closing_entries.append({'akun': no_akun, 'debit': debit_entry, 'kredit': 0})
-                        closing_entries.append({'akun': akun_penutup, 'debit': 0, 'kredit': debit_entry})
-                    elif kredit_entry > 0:
-                        ws.append([today_str, f'Penutupan akun {no_akun} {nama_akun}', no_akun, 0, kredit_entry])
-                        ws.append([today_str, f'Penutupan ke akun penutup', akun_penutup, kredit_entry, 0])
-                        closing_entries.append({'akun': no_akun, 'debit': 0, 'kredit': kredit_entry})
-                        closing_entries.append({'akun': akun_penutup, 'debit': kredit_entry, 'kredit': 0})
-                wb.save(jurnal_path)
-                message = "Jurnal penutup berhasil dibuat."
-            except Exception as e:
-                error = f"Error creating jurnal penutup: {str(e)}"
+                    wb, ws = _open_journal_workbook(jurnal_path)
+
+                    # Closing entries belong to the closed period, dated on its last day.
+                    closing_date = _period_end(tahun, bulan).strftime('%Y-%m-%d')
+                    closing_entries = []
+                    for account in saldo_closing_accounts:
+                        no_akun = account['no_akun']
+                        nama_akun = account['nama_akun']
+                        debit = account['debit']
+                        kredit = account['kredit']
+                        saldo = debit - kredit
+
+                        if saldo == 0:
+                            continue
+
+                        akun_penutup = ''
+                        debit_entry = 0
+                        kredit_entry = 0
+
+                        # Every nominal account is brought to zero against the clearing
+                        # account: Pendapatan (saldo normal kredit, saldo < 0) is debited,
+                        # HPP and Beban (saldo normal debit, saldo > 0) are credited.
+                        tipe = chart_of_accounts().get(no_akun, nama_akun)['tipe']
+                        if tipe in ('Pendapatan', 'HPP', 'Beban'):
+                            akun_penutup = '3101 - Ikhtisar Laba Rugi'  # contoh akun penutup laba rugi
+                            if saldo > 0:
+                                kredit_entry = saldo
+                            else:
+                                debit_entry = abs(saldo)
+
+                        if debit_entry > 0:
+                            _append_journal_row(ws, closing_date, f'Penutupan akun {no_akun} {nama_akun}', no_akun, debit_entry, 0)
+                            _append_journal_row(ws, closing_date, f'Penutupan ke akun penutup', akun_penutup, 0, debit_entry)
+                            closing_entries.append({'akun': no_akun, 'debit': debit_entry, 'kredit': 0})
+                            closing_entries.append({'akun': akun_penutup, 'debit': 0, 'kredit': debit_entry})
+                        elif kredit_entry > 0:
+                            _append_journal_row(ws, closing_date, f'Penutupan akun {no_akun} {nama_akun}', no_akun, 0, kredit_entry)
+                            _append_journal_row(ws, closing_date, f'Penutupan ke akun penutup', akun_penutup, kredit_entry, 0)
+                            closing_entries.append({'akun': no_akun, 'debit': 0, 'kredit': kredit_entry})
+                            closing_entries.append({'akun': akun_penutup, 'debit': kredit_entry, 'kredit': 0})
+                    save_workbook(wb, jurnal_path)
+                    _journal_committed(tenant, jurnal_path)
+                    message = "Jurnal penutup berhasil dibuat."
+
+                    # Roll the closed period's balances forward as next period's opening.
+                    next_period = close_period(tahun, bulan, session.get('user'))
+                    message += f" Saldo awal periode {next_period} telah dibuat."
+        except Exception as e:
+            error = f"Error creating jurnal penutup: {str(e)}"
 
     if request.method == 'GET' or saldo_closing_accounts == []:
-        saldo_closing_accounts = load_closing_balances()
+        saldo_closing_accounts = load_closing_balances() if period else []
 
     return render_template('jurnal_penutup.html',
                            saldo_closing_accounts=saldo_closing_accounts,
                            closing_entries=closing_entries,
                            error=error,
-                           message=message)
+                           message=message,
+                           tahun=tahun,
+                           bulan=bulan)
+
+@app.route('/tutup_periode', methods=['POST'])
+@login_required
+def tutup_periode():
+    tahun = request.form.get('tahun', '').strip()
+    bulan = request.form.get('bulan', '').strip()
+    if not _period_key(tahun, bulan):
+        flash("Periode tidak valid.")
+        return redirect(url_for('neraca_saldo'))
+    try:
+        next_period = close_period(tahun, bulan, session.get('user'))
+        flash(f"Periode {bulan} {tahun} ditutup. Saldo awal {next_period} telah dibuat.")
+        next_tahun, next_bulan = _next_period(tahun, bulan)
+        return redirect(url_for('neraca_saldo', tahun=next_tahun, bulan=next_bulan))
+    except Exception as e:
+        logger.error(f"Error closing period {bulan} {tahun}: {e}")
+        flash(f"Gagal menutup periode: {str(e)}")
+        return redirect(url_for('neraca_saldo', tahun=tahun, bulan=bulan))
+
+
+@app.route('/buka_periode', methods=['POST'])
+@login_required
+def buka_periode():
+    tahun = request.form.get('tahun', '').strip()
+    bulan = request.form.get('bulan', '').strip()
+    alasan = request.form.get('alasan', '').strip()
+    period = _period_key(tahun, bulan)
+    if not period:
+        flash("Periode tidak valid.")
+        return redirect(url_for('neraca_saldo'))
+    try:
+        if reopen_period(period, session.get('user'), alasan):
+            flash(f"Periode {bulan} {tahun} dibuka kembali.")
+        else:
+            flash(f"Periode {bulan} {tahun} tidak sedang dikunci.")
+    except ValueError as e:
+        flash(str(e))
+    except Exception as e:
+        logger.error(f"Error reopening period {period}: {e}")
+        flash(f"Gagal membuka periode: {str(e)}")
+    return redirect(url_for('neraca_saldo', tahun=tahun, bulan=bulan))
+
 
 @app.route('/neraca_saldo')
 @login_required
-def neraca_saldo():
+async def neraca_saldo():
     tahun = request.args.get('tahun', '2025')
     bulan = request.args.get('bulan', 'November')
+    date_range = _requested_range()
 
     # Do not show Neraca Saldo for future periods
-    if _is_future_period(tahun, bulan):
+    if date_range is None and _is_future_period(tahun, bulan):
         return render_template('neraca_saldo.html',
                                saldo_data=[],
                                tahun=tahun,
                                bulan=bulan)
 
+    await load_report_inputs(tahun, bulan, date_range)
+
     # Also hide periods before the first journal month
     min_year, min_month = _get_min_journal_period()
-    if min_year is not None and min_month is not None:
+    if date_range is None and min_year is not None and min_month is not None:
         month_code = MONTH_NAME_TO_NUM.get(bulan, None)
         if month_code:
             selected_year = int(tahun)
@@ -1592,7 +4049,7 @@ def neraca_saldo():
                                        tahun=tahun,
                                        bulan=bulan)
 
-    saldo_data = load_neraca_saldo_data(tahun, bulan)
+    saldo_data = load_neraca_saldo_range(*date_range) if date_range else load_neraca_saldo_data(tahun, bulan)
 
     # Format debit and kredit in saldo_data for display
     saldo_data_fmt = []
@@ -1630,10 +4087,12 @@ def neraca_saldo():
 
 @app.route('/laba_rugi')
 @login_required
-def laba_rugi():
+async def laba_rugi():
     tahun = request.args.get('tahun', '2025')
     bulan = request.args.get('bulan', 'November')
-    saldo_data = load_neraca_saldo_data(tahun, bulan)
+    date_range = _requested_range()
+    await load_report_inputs(tahun, bulan, date_range)
+    saldo_data = load_neraca_saldo_range(*date_range) if date_range else load_neraca_saldo_data(tahun, bulan)
 
     # Segregate accounts into categories based on account number prefix
     revenues = {}
@@ -1646,6 +4105,7 @@ def laba_rugi():
     total_cogs = 0
     total_expenses = 0
 
+    coa = chart_of_accounts()
     for item in saldo_data:
         no_akun = item.get('no_akun', '')
         nama_akun = item.get('nama_akun', '')
@@ -1653,10 +4113,11 @@ def laba_rugi():
         kredit = item.get('kredit', 0) or 0
         saldo_normal = kredit - debit  # Revenues and sales returns normal balance Kredit
         saldo_debet = debit - kredit   # Expenses and COGS normal balance Debet
+        account = coa.get(no_akun, nama_akun)
 
-        if no_akun.startswith('4'):  # Pendapatan (Revenues)
-            # Special case for Retur Penjualan (Sales Returns), account starting with 4-4100 or name containing 'Retur Penjualan'
-            if 'retur' in nama_akun.lower() or 'retur penjualan' in nama_akun.lower() or no_akun.startswith('4-4100'):
+        if account['tipe'] == 'Pendapatan':  # Pendapatan (Revenues)
+            # Retur Penjualan (Sales Returns) is a contra-revenue account
+            if account['seksi'] == 'Retur Penjualan':
                 amount = abs(saldo_normal)
                 sales_returns[nama_akun] = format_rupiah(amount)
                 total_sales_returns += amount
@@ -1665,12 +4126,12 @@ def laba_rugi():
                 revenues[nama_akun] = format_rupiah(amount if amount > 0 else 0)
                 total_revenue += amount if amount > 0 else 0
 
-        elif no_akun.startswith('5'):  # Harga Pokok Penjualan (COGS)
+        elif account['tipe'] == 'HPP':  # Harga Pokok Penjualan (COGS)
             amount = saldo_debet
             cogs[nama_akun] = format_rupiah(amount if amount > 0 else 0)
             total_cogs += amount if amount > 0 else 0
 
-        elif no_akun.startswith('6'):  # Biaya (Expenses)
+        elif account['tipe'] == 'Beban':  # Biaya (Expenses)
             amount = saldo_debet
             expenses[nama_akun] = format_rupiah(amount if amount > 0 else 0)
             total_expenses += amount if amount > 0 else 0
@@ -1700,209 +4161,108 @@ def laba_rugi():
                            total_expenses=total_expenses_fmt,
                            net_profit=net_profit_fmt)
 
-@app.route('/laporan_posisi_keuangan_detail')
-@login_required
-def laporan_posisi_keuangan_detail():
-    tahun = request.args.get('tahun', '2025')
-    bulan = request.args.get('bulan', 'November')
-    saldo_data = load_neraca_saldo_data(tahun, bulan)
-
-    # Classification of accounts into categories & subcategories for Balance Sheet (Posisi Keuangan)
-    categories = {
-        'Aktiva': {
-            'name': 'AKTIVA',
-            'subcategories': {
-                'Aset Lancar': [],
-                'Aset Tetap': [],
-            }
-        },
-        'Kewajiban': {
-            'name': 'KEWAJIBAN',
-            'subcategories': {
-                'Kewajiban': [],
-            }
-        },
-        'Ekuitas': {
-            'name': 'EKUITAS',
-            'subcategories': {
-                'Modal Awal': [],
-                'Laba Bersih': [],
-            }
-        }
-    }
+# Balance sheet layout: group -> (category key, heading, subcategories).
+POSISI_KEUANGAN_LAYOUT = [
+    ('AKTIVA', [('Aktiva', 'AKTIVA', ['Aset Lancar', 'Aset Tetap'])]),
+    ('KEWAJIBAN DAN EKUITAS', [('Kewajiban', 'KEWAJIBAN', ['Kewajiban']),
+                               ('Ekuitas', 'EKUITAS', ['Modal Awal', 'Laba Bersih'])]),
+]
 
-    # Aggregate into top-level groups
-    groups = [
-        {
-            'name': 'AKTIVA',
-            'categories': [categories['Aktiva']],
-            'total': ''
-        },
-        {
-            'name': 'KEWAJIBAN DAN EKUITAS',
-            'categories': [categories['Kewajiban'], categories['Ekuitas']],
-            'total': ''
-        }
-    ]
 
-    def classify_account(no_akun, nama_akun):
-        aset_lancar_akun = ['101', '102', '103', '1310', '1400']
-        aset_tetap_akun = ['104', '1500', '1510', '1511', '1600', '1610', '1700', '1710']
-        kewajiban_akun = ['201']
-        ekuitas_modal_akun = ['301']
-        # For laba bersih, could match 'Laba Bersih' or derived later
-        
-        if no_akun in aset_lancar_akun or nama_akun.lower() in ['kas', 'piutang usaha', 'persediaan barang dagang', 'persediaan stok madu gudang', 'perlengkapan toko']:
-            return 'Aktiva', 'Aset Lancar'
-        elif no_akun in aset_tetap_akun or nama_akun.lower() in ['tanah', 'bangunan', 'akumulasi penyusutan bangunan', 'kendaraan', 'akumulasi penyusutan kendaraan', 'peralatan', 'akumulasi penyusutan peralatan']:
-            return 'Aktiva', 'Aset Tetap'
-        elif no_akun in kewajiban_akun or nama_akun.lower() == 'hutang dagang':
-            return 'Kewajiban', 'Kewajiban'
-        elif no_akun in ekuitas_modal_akun or nama_akun.lower() == 'modal awal':
-            return 'Ekuitas', 'Modal Awal'
-        elif 'laba bersih' in nama_akun.lower():
-            # Assuming laba bersih is in equity but that might be summarized and not in neraca saldo
-            return 'Ekuitas', 'Laba Bersih'
-        else:
-            # Skip other accounts (income/expense etc.)
-            return None, None
+POSISI_KEUANGAN_MONEY_KEYS = ('amount', 'total', 'total_aktiva', 'total_kewajiban_dan_ekuitas', 'laba_bersih')
 
-    # Calculate modal_awal from neraca saldo accounts starting with '3'
-    modal_awal = 0
-    for item in saldo_data:
-        if item.get('no_akun', '').startswith('3'):
-            debit = item.get('debit', 0) or 0
-            kredit = item.get('kredit', 0) or 0
-            saldo = kredit - debit  # Assuming modal normal balance credit
-            modal_awal += saldo
 
-    # Calculate laba_bersih similar to laba_rugi()
-    total_revenue = 0
-    total_returns = 0
-    total_cogs = 0
-    total_expenses = 0
+def build_posisi_keuangan(tahun=None, bulan=None):
+    """Numeric balance-sheet model for a period; amounts are int sen, never formatted strings."""
+    return _period_cached(('posisi_keuangan', tahun, bulan), tahun, bulan, [current_tenant().saldo_file, journal_file_for(tahun)],
+                          lambda: _compute_posisi_keuangan(load_neraca_saldo_data(tahun, bulan), _period_key(tahun, bulan)))
 
-    for item in saldo_data:
-        no_akun = item.get('no_akun', '')
-        nama_akun = item.get('nama_akun', '')
-        debit = item.get('debit', 0) or 0
-        kredit = item.get('kredit', 0) or 0
-        saldo_normal = kredit - debit  # Revenues and sales returns normal balance Kredit
-        saldo_debet = debit - kredit   # Expenses and COGS normal balance Debet
 
-        if no_akun.startswith('4'):  # Pendapatan (Revenues)
-            if 'retur' in nama_akun.lower() or 'retur penjualan' in nama_akun.lower() or no_akun.startswith('4-4100'):
-                amount = abs(saldo_normal)
-                total_returns += amount
+def _compute_posisi_keuangan(saldo_data, periode):
+    coa = chart_of_accounts()
+    items = {}
+    modal_awal = 0
+    laba_bersih = 0
+
+    # One pass: balance-sheet lines, equity and the period's profit together.
+    for acc in saldo_data:
+        no_akun = acc.get('no_akun', '')
+        nama_akun = acc.get('nama_akun', '')
+        saldo_debet = (acc.get('debit', 0) or 0) - (acc.get('kredit', 0) or 0)
+        account = coa.get(no_akun, nama_akun)
+
+        if account['tipe'] == 'Aset' and account['seksi'] in ('Aset Lancar', 'Aset Tetap'):
+            # Accumulated depreciation is shown as a deduction
+            saldo = -abs(saldo_debet) if account['kontra'] else saldo_debet
+            items.setdefault(account['seksi'], []).append({'no_akun': no_akun, 'name': nama_akun, 'amount': saldo})
+        elif account['tipe'] == 'Kewajiban':
+            items.setdefault('Kewajiban', []).append({'no_akun': no_akun, 'name': nama_akun, 'amount': -saldo_debet})
+        elif account['tipe'] == 'Ekuitas':
+            modal_awal -= saldo_debet
+        elif account['tipe'] == 'Pendapatan':
+            if account['seksi'] == 'Retur Penjualan':
+                laba_bersih -= abs(saldo_debet)
             else:
-                amount = saldo_normal
-                total_revenue += amount if amount > 0 else 0
-        elif no_akun.startswith('5'):  # Harga Pokok Penjualan (COGS)
-            amount = saldo_debet
-            total_cogs += amount if amount > 0 else 0
-        elif no_akun.startswith('6'):  # Biaya (Expenses)
-            amount = saldo_debet
-            total_expenses += amount if amount > 0 else 0
-
-    laba_bersih = total_revenue - total_returns - total_cogs - total_expenses
-
-    # Assign items to categories & subcategories
-    for item in saldo_data:
-        no_akun = item.get('no_akun', '')
-        nama_akun = item.get('nama_akun', '')
-        debit = item.get('debit', 0) or 0
-        kredit = item.get('kredit', 0) or 0
-
-        kategori, subkategori = classify_account(no_akun, nama_akun)
-
-        if kategori is None or subkategori is None:
-            logger.warning(f"Unclassified account in laporan_posisi_keuangan_detail: no_akun={no_akun}, nama_akun={nama_akun}")
-            continue
-
-        # For kewajiban (liabilities), saldo normal is kredit - debit, so invert calculation to have saldo adding when kredit > debit
-        if kategori == 'Kewajiban' or (kategori == 'Ekuitas' and subkategori == 'Modal Awal'):
-            saldo = kredit - debit
+                laba_bersih += max(-saldo_debet, 0)
+        elif account['tipe'] in ('HPP', 'Beban'):
+            laba_bersih -= max(saldo_debet, 0)
         else:
-            saldo = debit - kredit
-
-        # Negate saldo for accumulated depreciation accounts to show deduction
-        if kategori == 'Aktiva' and subkategori == 'Aset Tetap' and 'akumulasi penyusutan' in nama_akun.lower():
-            saldo = -abs(saldo)
+            logger.warning(f"Unclassified account in laporan_posisi_keuangan_detail: no_akun={no_akun}, nama_akun={nama_akun}")
 
-        categories[kategori]['subcategories'][subkategori].append({
-            'name': nama_akun,
-            'amount': format_rupiah_for_report(abs(saldo)) if saldo >= 0 else '-' + format_rupiah_for_report(abs(saldo))
+    items['Modal Awal'] = [{'no_akun': RETAINED_EARNINGS_ACCOUNT[0], 'name': 'Modal Awal', 'amount': modal_awal}]
+    items['Laba Bersih'] = [{'no_akun': None, 'name': 'Laba Bersih', 'amount': laba_bersih}]
+
+    groups = []
+    for group_name, categories in POSISI_KEUANGAN_LAYOUT:
+        category_list = []
+        for key, heading, subcategories in categories:
+            subcategory_list = [{
+                'name': name,
+                'item_list': items.get(name, []),
+                'total': sum(item['amount'] for item in items.get(name, [])),
+            } for name in subcategories]
+            category_list.append({
+                'key': key,
+                'name': heading,
+                'subcategories': subcategory_list,
+                'total': sum(sub['total'] for sub in subcategory_list),
+            })
+        groups.append({
+            'name': group_name,
+            'categories': category_list,
+            'total': sum(cat['total'] for cat in category_list),
         })
 
-    # Insert modal_awal and laba_bersih explicitly into Ekuitas subcategories
-    categories['Ekuitas']['subcategories']['Modal Awal'] = [{
-        'name': 'Modal Awal',
-        'amount': format_rupiah_for_report(abs(modal_awal)) if modal_awal >= 0 else '-' + format_rupiah_for_report(abs(modal_awal))
-    }]
-    categories['Ekuitas']['subcategories']['Laba Bersih'] = [{
-        'name': 'Laba Bersih',
-        'amount': format_rupiah_for_report(abs(laba_bersih)) if laba_bersih >= 0 else '-' + format_rupiah_for_report(abs(laba_bersih))
-    }]
-
-    # Calculate totals for subcategories and categories
-    total_aktiva = 0
-    total_kewajiban = 0
-    total_ekuitas = 0
+    return {
+        'periode': periode,
+        'groups': groups,
+        'total_aktiva': groups[0]['total'],
+        'total_kewajiban_dan_ekuitas': groups[1]['total'],
+        'laba_bersih': laba_bersih,
+    }
 
-    for kategori_key, kategori_val in categories.items():
-        cat_total = 0
-        subcategory_list = []
-        for subcat_key, items in kategori_val['subcategories'].items():
-            subcat_total = 0
-            for item in items:
-                # Remove "Rp " and dots to convert back to int for sum
-                amount_str = item['amount'].replace('Rp ', '').replace('.', '').replace('-', '')
-                amount_int = int(amount_str) if amount_str.isdigit() else 0
 
-                # Subtract amount if it has '-' prefix (i.e. accumulated depreciation)
-                if item['amount'].startswith('-'):
-                    subcat_total -= amount_int
-                else:
-                    subcat_total += amount_int
+@app.route('/laporan_posisi_keuangan_detail')
+@login_required
+async def laporan_posisi_keuangan_detail():
+    tahun = request.args.get('tahun', '2025')
+    bulan = request.args.get('bulan', 'November')
+    date_range = _requested_range()
+    await load_report_inputs(tahun, bulan, date_range)
+    report = build_posisi_keuangan_range(*date_range) if date_range else build_posisi_keuangan(tahun, bulan)
 
-            subcategory_list.append({
-                'name': subcat_key,
-                'item_list': items,
-                'total': format_rupiah_for_report(subcat_total)
-            })
-            cat_total += subcat_total
-        categories[kategori_key]['subcategories'] = subcategory_list
-        categories[kategori_key]['total'] = format_rupiah_for_report(cat_total)
-        if kategori_key == 'Aktiva':
-            total_aktiva = cat_total
-        elif kategori_key == 'Kewajiban':
-            total_kewajiban = cat_total
-        elif kategori_key == 'Ekuitas':
-            total_ekuitas = cat_total
-
-    total_kewajiban_dan_ekuitas = total_kewajiban + total_ekuitas
-
-    # Aggregate into top-level groups
-    groups = [
-        {
-            'name': 'AKTIVA',
-            'categories': [categories['Aktiva']],
-            'total': format_rupiah_for_report(total_aktiva)
-        },
-        {
-            'name': 'KEWAJIBAN DAN EKUITAS',
-            'categories': [categories['Kewajiban'], categories['Ekuitas']],
-            'total': format_rupiah_for_report(total_kewajiban_dan_ekuitas)
-        }
-    ]
+    if request.args.get('format') == 'json':
+        return jsonify(money_json(report, POSISI_KEUANGAN_MONEY_KEYS))
 
-    financial_data = groups + [{
+    # Amounts stay numeric; the template formats them with the `rupiah` filter.
+    financial_data = report['groups'] + [{
         'name': 'TOTALS',
-        'total_aktiva': format_rupiah_for_report(total_aktiva),
-        'total_kewajiban_dan_ekuitas': format_rupiah_for_report(total_kewajiban_dan_ekuitas)
+        'total_aktiva': report['total_aktiva'],
+        'total_kewajiban_dan_ekuitas': report['total_kewajiban_dan_ekuitas'],
     }]
 
-    return render_template('laporan_posisi_keuangan_detail.html', financial_data=financial_data)
+    return render_template('laporan_posisi_keuangan_detail.html', financial_data=financial_data,
+                           tahun=tahun, bulan=bulan)
 
 import openpyxl
 import logging
@@ -1914,16 +4274,19 @@ import logging
 
 @app.route('/laporan_perubahan_ekuitas')
 @login_required
-def laporan_perubahan_ekuitas():
+async def laporan_perubahan_ekuitas():
     try:
         tahun = request.args.get('tahun', '2025')
         bulan = request.args.get('bulan', 'November')
-        saldo_data = load_neraca_saldo_data(tahun, bulan)
+        date_range = _requested_range()
+        await load_report_inputs(tahun, bulan, date_range)
+        saldo_data = load_neraca_saldo_range(*date_range) if date_range else load_neraca_saldo_data(tahun, bulan)
 
+        coa = chart_of_accounts()
         modal_awal = 0
         for item in saldo_data:
             no_akun = item.get('no_akun', '')
-            if no_akun.startswith('3'):
+            if coa.get(no_akun, item.get('nama_akun', ''))['tipe'] == 'Ekuitas':
                 debit = item.get('debit', 0) or 0
                 kredit = item.get('kredit', 0) or 0
                 modal_awal += (kredit - debit)
@@ -1943,15 +4306,16 @@ def laporan_perubahan_ekuitas():
 
             saldo_normal = kredit - debit
             saldo_debet = debit - kredit
+            account = coa.get(no_akun, nama_akun)
 
-            if no_akun.startswith('4'):
-                if 'retur' in nama_akun.lower():
+            if account['tipe'] == 'Pendapatan':
+                if account['seksi'] == 'Retur Penjualan':
                     total_returns += abs(saldo_normal)
                 else:
                     total_revenue += max(saldo_normal, 0)
-            elif no_akun.startswith('5'):
+            elif account['tipe'] == 'HPP':
                 total_cogs += max(saldo_debet, 0)
-            elif no_akun.startswith('6'):
+            elif account['tipe'] == 'Beban':
                 total_expenses += max(saldo_debet, 0)
 
         laba_bersih = total_revenue - total_returns - total_cogs - total_expenses
@@ -1975,6 +4339,737 @@ def laporan_perubahan_ekuitas():
 
 # ...existing code...
 
+
+# Comparative (multi-period) reports. Each period's trial balance is
+# independent, so they are computed on a process pool that uses every core
+# of the reporting box; locked periods come from the immutable cache.
+COMPARATIVE_MAX_PERIODS = 36
+REPORT_WORKERS = int(os.environ.get('SIA_REPORT_WORKERS', '0')) or os.cpu_count() or 1
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+
+def summarize_laba_rugi(saldo_data):
+    """Income-statement totals (int sen) from trial-balance rows."""
+    coa = chart_of_accounts()
+    pendapatan = retur = hpp = beban = 0
+    for item in saldo_data:
+        saldo_debet = (item.get('debit', 0) or 0) - (item.get('kredit', 0) or 0)
+        account = coa.get(item.get('no_akun', ''), item.get('nama_akun', ''))
+        if account['tipe'] == 'Pendapatan':
+            if account['seksi'] == 'Retur Penjualan':
+                retur += abs(saldo_debet)
+            else:
+                pendapatan += max(-saldo_debet, 0)
+        elif account['tipe'] == 'HPP':
+            hpp += max(saldo_debet, 0)
+        elif account['tipe'] == 'Beban':
+            beban += max(saldo_debet, 0)
+    penjualan_bersih = pendapatan - retur
+    laba_kotor = penjualan_bersih - hpp
+    return {
+        'pendapatan': pendapatan,
+        'retur_penjualan': retur,
+        'penjualan_bersih': penjualan_bersih,
+        'hpp': hpp,
+        'laba_kotor': laba_kotor,
+        'beban': beban,
+        'laba_bersih': laba_kotor - beban,
+    }
+
+
+def _period_summary_worker(tenant_name, tahun, bulan):
+    """Runs in a pool process: trial balance and laba rugi totals of one period."""
+    with tenant_context(tenant_name):
+        saldo_data = load_neraca_saldo_data(tahun, bulan)
+        return {
+            'periode': _period_key(tahun, bulan),
+            'neraca': saldo_data,
+            'laba_rugi': summarize_laba_rugi(saldo_data),
+        }
+
+
+def _get_report_pool():
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is None:
+            _report_pool = ProcessPoolExecutor(max_workers=REPORT_WORKERS)
+        return _report_pool
+
+
+def _reset_report_pool():
+    global _report_pool
+    with _report_pool_lock:
+        pool, _report_pool = _report_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _compute_period_summaries(tenant, periods):
+    if len(periods) > 1 and REPORT_WORKERS > 1:
+        try:
+            futures = [_get_report_pool().submit(_period_summary_worker, tenant.name, tahun, bulan)
+                       for tahun, bulan in periods]
+            return [future.result() for future in futures]
+        except (BrokenProcessPool, OSError) as e:
+            logger.error(f"Report pool failed, computing {len(periods)} periods inline: {e}")
+            _reset_report_pool()
+    return [_period_summary_worker(tenant.name, tahun, bulan) for tahun, bulan in periods]
+
+
+def _periods_ending(tahun, bulan, count):
+    """The count periods up to and including tahun/bulan, oldest first, as (tahun, bulan name)."""
+    year, month = int(tahun), int(MONTH_NAME_TO_NUM[bulan])
+    periods = []
+    for _ in range(count):
+        periods.append((str(year), MONTH_NUM_TO_NAME[month]))
+        year, month = _previous_period(year, month)
+    return periods[::-1]
+
+
+def comparative_report(tahun, bulan, count=12):
+    """Month-by-month laba rugi and neraca saldo tables for the count periods ending at tahun/bulan."""
+    tenant = current_tenant()
+    periods = _periods_ending(tahun, bulan, count)
+    summaries = {}
+    pending = []
+    for period_tahun, period_bulan in periods:
+        period = _period_key(period_tahun, period_bulan)
+        generation = _lock_generation(period)
+        hit = tenant.immutable_get((period, generation, 'period_summary')) if generation is not None else None
+        if hit is not None:
+            summaries[period] = hit
+        else:
+            pending.append((period_tahun, period_bulan))
+
+    for summary in _compute_period_summaries(tenant, pending):
+        summaries[summary['periode']] = summary
+        generation = _lock_generation(summary['periode'])
+        if generation is not None:
+            tenant.immutable_put((summary['periode'], generation, 'period_summary'), summary)
+
+    columns = [_period_key(period_tahun, period_bulan) for period_tahun, period_bulan in periods]
+    laba_rugi_rows = [{
+        'label': label,
+        'values': [summaries[period]['laba_rugi'][key] for period in columns],
+    } for key, label in (('pendapatan', 'Pendapatan'), ('retur_penjualan', 'Retur Penjualan'),
+                         ('penjualan_bersih', 'Penjualan Bersih'), ('hpp', 'Harga Pokok Penjualan'),
+                         ('laba_kotor', 'Laba Kotor'), ('beban', 'Beban'), ('laba_bersih', 'Laba Bersih'))]
+
+    neraca_rows = {}
+    for index, period in enumerate(columns):
+        for item in summaries[period]['neraca']:
+            row = neraca_rows.setdefault(item['no_akun'], {
+                'no_akun': item['no_akun'],
+                'nama_akun': item['nama_akun'],
+                'saldo': [0] * len(columns),
+            })
+            row['saldo'][index] = (item['debit'] or 0) - (item['kredit'] or 0)
+
+    return {
+        'periode': columns,
+        'laba_rugi': laba_rugi_rows,
+        'neraca_saldo': sorted(neraca_rows.values(), key=lambda row: row['no_akun']),
+    }
+
+
+@app.route('/laporan_komparatif')
+@login_required
+async def laporan_komparatif():
+    tahun = request.args.get('tahun', str(datetime.today().year))
+    bulan = request.args.get('bulan', MONTH_NUM_TO_NAME[datetime.today().month])
+    count = min(max(safe_int(request.args.get('periode', 12)), 1), COMPARATIVE_MAX_PERIODS)
+    if bulan not in MONTH_NAME_TO_NUM or not str(tahun).isdigit():
+        return jsonify({'error': 'Periode tidak valid.'}), 400
+
+    # Waiting on the process pool would otherwise hold this request's thread.
+    report = await run_blocking(comparative_report, tahun, bulan, count)
+    if request.args.get('format') == 'json':
+        return jsonify(money_json(report, ('values', 'saldo')))
+    return render_template('laporan_komparatif.html', report=report, tahun=tahun, bulan=bulan, periode=count)
+
+
+# Excel export. Each report is written with openpyxl's write-only workbook,
+# which streams appended rows to a temporary file instead of holding cells in
+# memory, from generators over the cached report models. The finished file is
+# sent back in chunks and deleted, so a full-year buku besar export keeps the
+# worker's memory flat.
+EXPORT_CHUNK_SIZE = 64 * 1024
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _export_journal(params):
+    yield ['No. Entri', 'Voucher', 'Tanggal', 'Keterangan', 'Akun', 'Debit', 'Kredit']
+    after = None
+    while True:
+        page, after, _ = query_journal(dari=params['dari'], sampai=params['sampai'], akun=params['akun'],
+                                       q=params['q'], after=after, limit=JOURNAL_MAX_PAGE_SIZE)
+        for entry in page:
+            yield [entry['entry_id'], entry['voucher'], entry['tanggal'], entry['keterangan'],
+                   entry['akun'], from_sen(entry['debit']), from_sen(entry['kredit'])]
+        if not after:
+            return
+
+
+def _export_buku_besar(params):
+    date_range = params['range']
+    ledgers = build_ledgers_range(*date_range) if date_range else build_ledgers(params['tahun'], params['bulan'])
+    for ledger in ledgers:
+        yield [f"{ledger['no_akun']} - {ledger['nama_akun']}"]
+        yield ['No', 'Tanggal', 'Keterangan', 'Debet', 'Kredit', 'Saldo']
+        for entry in ledger['entries']:
+            yield [entry['no'], entry['tanggal'], entry['keterangan'],
+                   from_sen(entry['debet']), from_sen(entry['kredit']), from_sen(entry['saldo'])]
+        yield []
+
+
+def _report_saldo_data(params):
+    date_range = params['range']
+    return load_neraca_saldo_range(*date_range) if date_range else load_neraca_saldo_data(params['tahun'], params['bulan'])
+
+
+def _export_neraca_saldo(params):
+    yield ['No Akun', 'Nama Akun', 'Posisi', 'Debit', 'Kredit']
+    total_debit = total_kredit = 0
+    for item in _report_saldo_data(params):
+        debit = item.get('debit', 0) or 0
+        kredit = item.get('kredit', 0) or 0
+        total_debit += debit
+        total_kredit += kredit
+        yield [item.get('no_akun', ''), item.get('nama_akun', ''), item.get('side', ''), from_sen(debit), from_sen(kredit)]
+    yield ['Total', '', '', from_sen(total_debit), from_sen(total_kredit)]
+
+
+def _export_laba_rugi(params):
+    saldo_data = _report_saldo_data(params)
+    coa = chart_of_accounts()
+    sections = {'Pendapatan': [], 'Retur Penjualan': [], 'Harga Pokok Penjualan': [], 'Beban': []}
+    for item in saldo_data:
+        saldo_debet = (item.get('debit', 0) or 0) - (item.get('kredit', 0) or 0)
+        account = coa.get(item.get('no_akun', ''), item.get('nama_akun', ''))
+        # Same amounts summarize_laba_rugi adds up, per account.
+        if account['tipe'] == 'Pendapatan':
+            if account['seksi'] == 'Retur Penjualan':
+                sections['Retur Penjualan'].append((item, abs(saldo_debet)))
+            else:
+                sections['Pendapatan'].append((item, max(-saldo_debet, 0)))
+        elif account['tipe'] == 'HPP':
+            sections['Harga Pokok Penjualan'].append((item, max(saldo_debet, 0)))
+        elif account['tipe'] == 'Beban':
+            sections['Beban'].append((item, max(saldo_debet, 0)))
+
+    yield ['No Akun', 'Nama Akun', 'Jumlah']
+    for section, lines in sections.items():
+        yield [section]
+        for item, amount in lines:
+            yield [item.get('no_akun', ''), item.get('nama_akun', ''), from_sen(amount)]
+        yield ['', f'Total {section}', from_sen(sum(amount for _, amount in lines))]
+    summary = summarize_laba_rugi(saldo_data)
+    yield []
+    yield ['', 'Penjualan Bersih', from_sen(summary['penjualan_bersih'])]
+    yield ['', 'Laba Kotor', from_sen(summary['laba_kotor'])]
+    yield ['', 'Laba Bersih', from_sen(summary['laba_bersih'])]
+
+
+def _export_posisi_keuangan(params):
+    date_range = params['range']
+    report = build_posisi_keuangan_range(*date_range) if date_range else build_posisi_keuangan(params['tahun'], params['bulan'])
+    yield ['No Akun', 'Keterangan', 'Jumlah']
+    for group in report['groups']:
+        yield [group['name']]
+        for category in group['categories']:
+            yield ['', category['name']]
+            for subcategory in category['subcategories']:
+                yield ['', subcategory['name']]
+                for item in subcategory['item_list']:
+                    yield [item['no_akun'] or '', item['name'], from_sen(item['amount'])]
+                yield ['', f"Total {subcategory['name']}", from_sen(subcategory['total'])]
+            yield ['', f"Total {category['name']}", from_sen(category['total'])]
+        yield ['', f"Total {group['name']}", from_sen(group['total'])]
+
+
+def _export_kartu_stok(params):
+    yield ['Tanggal', 'Keterangan', 'Masuk Qty', 'Masuk Harga', 'Masuk Total', 'Keluar Qty', 'Keluar Harga',
+           'Keluar Total', 'Saldo Qty', 'Saldo Harga', 'Saldo Total']
+    repository = inventory_repository()
+    item = repository.get(params['product']) or repository.find_by_name(params['product'])
+    month_code = MONTH_NAME_TO_NUM.get(params['bulan'])
+    if not item or not month_code:
+        return
+    for line in _stock_card_lines(item['item_code'], f"{params['tahun']}-{month_code}"):
+        money = {field: from_sen(line[field]) if line[field] is not None else None for field in STOCK_CARD_MONEY_FIELDS}
+        yield [line['date'], line['description'], line['in_qty'], money['in_price'], money['in_total'],
+               line['out_qty'], money['out_price'], money['out_total'],
+               line['balance_qty'], money['balance_price'], money['balance_total']]
+
+
+EXPORTS = {
+    'jurnal': ('Jurnal Umum', _export_journal),
+    'buku_besar': ('Buku Besar', _export_buku_besar),
+    'neraca_saldo': ('Neraca Saldo', _export_neraca_saldo),
+    'laba_rugi': ('Laba Rugi', _export_laba_rugi),
+    'posisi_keuangan': ('Posisi Keuangan', _export_posisi_keuangan),
+    'kartu_stok': ('Kartu Stok', _export_kartu_stok),
+}
+
+
+def write_xlsx(path, sheet_title, rows):
+    """Write rows (an iterable of lists) to path as a single-sheet, write-only workbook."""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title=sheet_title[:31])
+    count = 0
+    for row in rows:
+        ws.append(row)
+        count += 1
+    wb.save(path)
+    return count
+
+
+def _stream_file(path):
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(EXPORT_CHUNK_SIZE), b''):
+            yield chunk
+
+
+def _remove_export_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+@app.route('/export/<laporan>')
+@login_required
+async def export_laporan(laporan):
+    if laporan not in EXPORTS:
+        return jsonify({'error': f"Laporan tidak dikenal: {laporan}"}), 404
+    title, rows = EXPORTS[laporan]
+    date_range = _requested_range()
+    params = {
+        'tahun': request.args.get('tahun', '2025'),
+        'bulan': request.args.get('bulan', 'November'),
+        'range': date_range,
+        'dari': request.args.get('dari', '').strip() or None,
+        'sampai': request.args.get('sampai', '').strip() or None,
+        'akun': request.args.get('akun', '').strip() or None,
+        'q': request.args.get('q', '').strip() or None,
+        'product': request.args.get('product', '').strip(),
+    }
+    await load_report_inputs(params['tahun'], params['bulan'], date_range)
+
+    fd, path = tempfile.mkstemp(prefix='sia-export-', suffix='.xlsx')
+    os.close(fd)
+    try:
+        count = await run_blocking(write_xlsx, path, title, rows(params))
+    except Exception as e:
+        os.remove(path)
+        logger.error(f"Error exporting {laporan}: {e}")
+        return jsonify({'error': f"Gagal membuat file export: {str(e)}"}), 500
+
+    if date_range:
+        periode = f"{date_range[0].isoformat()}_{date_range[1].isoformat()}"
+    else:
+        periode = f"{params['tahun']}_{params['bulan']}"
+    filename = f"{laporan}_{periode}.xlsx"
+    logger.info(f"Exported {count} rows of {laporan} to {filename}")
+    response = Response(_stream_file(path), mimetype=XLSX_MIMETYPE, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Content-Length': str(os.path.getsize(path)),
+    })
+    # Runs when the server closes the response, also if the client went away
+    # before the body was iterated (a generator's finally would never run then).
+    response.call_on_close(lambda: _remove_export_file(path))
+    return response
+
+
+# External edits. The accountant edits databasesia.xlsx and daftarsaldo.xlsx
+# in Excel while the app runs. A background thread notices a changed file
+# within WATCH_INTERVAL_SECONDS (or at once when watchdog's inotify events are
+# available). It reads the workbook once in read-only mode and diffs per-row
+# digests against the previous read to learn which sheets and rows changed.
+# Then it refreshes only what those sheets feed:
+#   - edited Inventory rows are patched into the cached inventory and into the
+#     cost engine, low-stock index and reservation slots;
+#   - daftar saldo awal, period snapshots and locks are rebuilt from the rows
+#     already read;
+#   - cache entries built only from unchanged sheets are re-stamped with the
+#     new file signature instead of being thrown away.
+# Journal sheets and aggregates that depend on changed sheets are rebuilt in
+# the watcher thread, so the next request finds them warm.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # mtime polling only
+    Observer = None
+
+WATCH_INTERVAL_SECONDS = 0.5
+
+# Which cache entries (by key name) each sheet of a data file feeds.
+_REPORT_AGGREGATES = ('neraca_saldo', 'ledgers', 'posisi_keuangan', 'neraca_saldo_range')
+WATCHED_SHEETS = {
+    'inventory_file': {
+        'Inventory': ('inventory', 'inventory_repository', 'movements_by_item', 'stock_card'),
+    },
+    'saldo_file': {
+        'daftar saldo awal': ('opening_balances',) + _REPORT_AGGREGATES,
+        PERIOD_SNAPSHOT_SHEET: ('period_snapshots',) + _REPORT_AGGREGATES,
+        PERIOD_LOCK_SHEET: ('locked_periods',),
+        PERIOD_AUDIT_SHEET: (),
+    },
+    'journal_file': {
+        'Journal': ('journal_entries', 'journal_by_period', 'journal_entries_all', 'journal_sort_index',
+                    'journal_id_index', 'voucher_index', 'daily_balance_index', 'movements_by_item',
+                    'stock_card') + _REPORT_AGGREGATES,
+        STOCK_MOVEMENT_SHEET: ('stock_movements', 'movements_by_item', 'voucher_index', 'stock_card'),
+    },
+}
+
+
+def _row_digest(row):
+    return hashlib.blake2b(repr(row).encode('utf-8'), digest_size=8).digest()
+
+
+def _read_sheet_rows(path):
+    """{sheet title: [row tuples]} from one read-only pass over path.
+
+    Cells are read like the loaders read them (formulas, not cached values),
+    so patched rows match what a full reparse would produce.
+    """
+    wb = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return {ws.title: [tuple(row) for row in ws.iter_rows(values_only=True)] for ws in wb.worksheets}
+    finally:
+        wb.close()
+
+
+def _changed_rows(previous, current):
+    """{sheet: sorted 1-based changed row numbers}; None for a sheet added, removed or resized."""
+    changes = {}
+    for title in set(previous) | set(current):
+        old, new = previous.get(title), current.get(title)
+        if old is None or new is None or len(old) != len(new):
+            changes[title] = None
+            continue
+        rows = [index + 1 for index, (a, b) in enumerate(zip(old, new)) if a != b]
+        if rows:
+            changes[title] = rows
+    return changes
+
+
+def _cache_key_name(key):
+    return key[0] if isinstance(key, tuple) else key
+
+
+def _restamp_unaffected(tenant, previous_signature, signature, affected):
+    """Move cache entries not fed by a changed sheet onto the new file signature."""
+    restamped = 0
+    with tenant.cache_lock:
+        for key, (stamp, value) in list(tenant.cache.items()):
+            if previous_signature not in stamp or _cache_key_name(key) in affected:
+                continue
+            tenant.cache[key] = (tuple(signature if part == previous_signature else part for part in stamp), value)
+            restamped += 1
+    return restamped
+
+
+class DataFileWatcher:
+    def __init__(self):
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # (tenant name, file attribute) -> (signature, {sheet: [row digests]} or
+        # None after the app's own save)
+        self._seen = {}
+        self._observer = None
+        self._observed_dirs = set()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def run(self):
+        self._start_observer()
+        while not self._stop.is_set():
+            with _tenants_lock:
+                tenants = list(_tenants.values())
+            for tenant in tenants:
+                self._observe(tenant.data_dir)
+                for attr in WATCHED_SHEETS:
+                    try:
+                        with tenant_context(tenant):
+                            self._check(tenant, attr)
+                    except Exception as e:
+                        logger.error(f"File watcher failed on {getattr(tenant, attr)}: {e}")
+            self._wake.wait(WATCH_INTERVAL_SECONDS)
+            self._wake.clear()
+
+    def _start_observer(self):
+        if Observer is None:
+            logger.info("watchdog not installed; watching data files by mtime polling")
+            return
+        watcher = self
+        watched_names = {INVENTORY_FILENAME, JOURNAL_FILENAME, SALDO_FILENAME}
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                paths = (getattr(event, 'src_path', ''), getattr(event, 'dest_path', ''))
+                if any(os.path.basename(path or '') in watched_names for path in paths):
+                    watcher.wake()
+
+        self._handler = _Handler()
+        self._observer = Observer()
+        self._observer.daemon = True
+        self._observer.start()
+
+    def _observe(self, directory):
+        if self._observer is None or directory in self._observed_dirs:
+            return
+        self._observer.schedule(self._handler, directory, recursive=False)
+        self._observed_dirs.add(directory)
+
+    def _check(self, tenant, attr):
+        path = getattr(tenant, attr)
+        signature = _file_signature(path)
+        key = (tenant.name, attr)
+        seen = self._seen.get(key)
+        if signature is None or (seen is not None and seen[0] == signature):
+            return
+        if tenant.own_writes.get(path) == signature:
+            # Saved by the app itself: its caches follow the new signature on
+            # their own, so skip the reparse. The row digests are now stale.
+            self._seen[key] = (signature, None)
+            return
+        try:
+            sheets = _read_sheet_rows(path)
+        except Exception as e:
+            # Usually Excel still writing the file; try again on the next tick.
+            logger.debug(f"File watcher could not read {path} yet: {e}")
+            return
+        if _file_signature(path) != signature:
+            return
+        digests = {title: [_row_digest(row) for row in rows] for title, rows in sheets.items()}
+        self._seen[key] = (signature, digests)
+        if seen is None:
+            return  # first sight: baseline only
+        if seen[1] is None:
+            # Edited after one of our own saves: no row baseline to diff against.
+            changes = {title: None for title in sheets}
+        else:
+            changes = _changed_rows(seen[1], digests)
+        if not changes:
+            # Saved without edits: every cached structure is still valid.
+            _restamp_unaffected(tenant, seen[0], signature, ())
+            if attr == 'inventory_file':
+                self._resync_stock_structures(tenant, [], seen[0], signature)
+            return
+        summary = ', '.join(f"{title}: {'all' if rows is None else len(rows)} row(s)" for title, rows in sorted(changes.items()))
+        logger.info(f"Detected change in {os.path.basename(path)} ({summary})")
+        self._refresh(tenant, attr, seen[0], signature, sheets, changes)
+        tenant.events.publish('data_changed', {'file': os.path.basename(path), 'sheets': sorted(changes)})
+
+    def _refresh(self, tenant, attr, previous_signature, signature, sheets, changes):
+        known = WATCHED_SHEETS[attr]
+        if any(title not in known for title in changes):
+            affected = None  # a sheet we do not map: rebuild everything from this file
+        else:
+            affected = set()
+            for title in changes:
+                affected.update(known[title])
+            _restamp_unaffected(tenant, previous_signature, signature, affected)
+
+        if attr == 'inventory_file':
+            self._refresh_inventory(tenant, previous_signature, signature, sheets, changes.get('Inventory', []))
+        elif attr == 'saldo_file':
+            self._refresh_saldo(tenant, signature, sheets, changes)
+        else:
+            # Journal rows feed many indexes; rebuild them here rather than on a request.
+            load_journal_entries()
+            load_stock_movements()
+            tenant.activity.snapshot()
+        if affected is None or set(_REPORT_AGGREGATES) & affected:
+            _warm_current_periods()
+
+    def _refresh_inventory(self, tenant, previous_signature, signature, sheets, rows):
+        cached = tenant.cache_get('inventory')
+        rows_in_sheet = sheets.get('Inventory')
+        patched = None
+        if cached is not None and cached[0] == (previous_signature,) and rows is not None and rows_in_sheet:
+            patched = self._patch_inventory(cached[1], rows_in_sheet, rows)
+        if patched is None:
+            # Rows inserted, deleted or re-keyed: reparse the sheet (here, not on a request).
+            load_inventory()
+            return
+        items, edited = patched
+        tenant.cache_put('inventory', ((signature,), items))
+        self._resync_stock_structures(tenant, edited, previous_signature, signature)
+        logger.info(f"Patched {len(edited)} inventory row(s) in place")
+
+    @staticmethod
+    def _resync_stock_structures(tenant, edited, previous_signature, signature):
+        tenant.cost_engine.resync_items(edited, previous_signature, signature)
+        tenant.low_stock.resync_items(edited, previous_signature, signature)
+        tenant.stock.resync_items(edited, previous_signature, signature)
+
+    @staticmethod
+    def _patch_inventory(items, sheet_rows, changed):
+        if 1 in changed:
+            return None  # header edited: column positions may have moved
+        header = list(sheet_rows[0])
+        by_row = {item.get('sheet_row'): index for index, item in enumerate(items)}
+        patched = list(items)
+        edited = []
+        for row_number in changed:
+            index = by_row.get(row_number)
+            record = _inventory_record_from_cells(header, sheet_rows[row_number - 1], row_number)
+            if index is None or record is None or record['item_code'] != items[index]['item_code']:
+                return None
+            patched[index] = record
+            edited.append(record)
+        return patched, edited
+
+    @staticmethod
+    def _refresh_saldo(tenant, signature, sheets, changes):
+        stamp = (signature,)
+        opening_sheet = 'daftar saldo awal' if 'daftar saldo awal' in sheets else next(iter(sheets), None)
+        if opening_sheet in changes:
+            opening = _opening_balances_from_rows(sheets[opening_sheet][1:])
+            coa_stamp = _file_signature(tenant.chart_of_accounts_file)
+            tenant.cache_put('opening_balances', ((signature, coa_stamp), OpeningBalances(opening.values())))
+        if PERIOD_SNAPSHOT_SHEET in changes:
+            tenant.cache_put('period_snapshots', (stamp, _period_snapshots_from_rows(sheets.get(PERIOD_SNAPSHOT_SHEET, [])[1:])))
+        if PERIOD_LOCK_SHEET in changes:
+            tenant.cache_put('locked_periods', (stamp, _locked_periods_from_rows(sheets.get(PERIOD_LOCK_SHEET, [])[1:])))
+
+
+def _warm_current_periods():
+    today = datetime.today()
+    current = (today.year, today.month)
+    for year, month in (current, _previous_period(*current)):
+        load_neraca_saldo_data(str(year), MONTH_NUM_TO_NAME[month])
+
+
+_file_watcher = None
+
+
+def start_file_watcher():
+    global _file_watcher
+    _file_watcher = DataFileWatcher()
+    thread = threading.Thread(target=_file_watcher.run, name='sia-file-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+# Cache prewarming: parse the workbooks and precompute the reports users open
+# first, so the first request after a deploy or worker recycle is not cold.
+_prewarm_ready = threading.Event()
+
+
+def _previous_period(year, month):
+    if month == 1:
+        return year - 1, 12
+    return year, month - 1
+
+
+def _active_tenant_names():
+    """The default store plus every store that has a data directory."""
+    names = [DEFAULT_TENANT]
+    if os.path.isdir(TENANTS_DIR):
+        names += sorted(name for name in os.listdir(TENANTS_DIR)
+                        if name != DEFAULT_TENANT and TENANT_NAME_RE.fullmatch(name)
+                        and os.path.isdir(os.path.join(TENANTS_DIR, name)))
+    return names
+
+
+def _prewarm_tenant():
+    migrate_journal_ids()
+    load_journal_entries()
+    load_inventory()
+    _load_opening_balances()
+    current_tenant().cost_engine.load()
+    current_tenant().activity.snapshot()
+    _warm_current_periods()
+
+
+def prewarm_caches():
+    """Per store: load journal, inventory and opening balances, then the current and previous trial balance."""
+    started = time.monotonic()
+    try:
+        for name in _active_tenant_names():
+            try:
+                with tenant_context(name):
+                    _prewarm_tenant()
+            except Exception as e:
+                logger.error(f"Cache prewarm failed for tenant '{name}', serving it cold: {e}")
+        logger.info(f"Cache prewarm finished in {time.monotonic() - started:.2f}s")
+    finally:
+        # A failed prewarm must not keep the worker out of rotation forever.
+        _prewarm_ready.set()
+
+
+def start_prewarm():
+    thread = threading.Thread(target=prewarm_caches, name='sia-prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+# Background threads are started per worker process on its first request
+# (the /ready probe counts): threads started at import would also run for
+# every flask CLI command, and with gunicorn --preload they do not survive
+# the fork into the workers.
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def _reset_background_after_fork():
+    global _background_started, _background_lock, _prewarm_ready
+    _background_started = False
+    _background_lock = threading.Lock()
+    _prewarm_ready = threading.Event()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_background_after_fork)
+
+
+@app.before_request
+def _start_background_threads():
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+        if os.environ.get('SIA_PREWARM', '1') != '0':
+            start_prewarm()
+        else:
+            _prewarm_ready.set()
+        if os.environ.get('SIA_WATCH', '1') != '0':
+            start_file_watcher()
+
+
+@app.cli.command('migrasi-jurnal')
+@click.option('--toko', default=None, help='Tenant (toko); default semua toko.')
+def migrasi_jurnal_command(toko):
+    """Beri ID permanen pada baris jurnal lama (sekali saat deploy)."""
+    for name in [toko] if toko else _active_tenant_names():
+        with tenant_context(name):
+            migrate_journal_ids()
+        click.echo(f"Jurnal toko '{name}' sudah memakai ID permanen.")
+
+
+@app.route('/ready')
+def ready():
+    """Readiness probe for the load balancer: 503 until the caches are warm."""
+    if _prewarm_ready.is_set():
+        return jsonify({'status': 'ready'}), 200
+    return jsonify({'status': 'warming'}), 503
+
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()  # Create database tables if they do not exist
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+for module in ('flask', 'flask_sqlalchemy', 'openpyxl', 'pandas', 'numpy'):
+    pytest.importorskip(module)
+
+os.environ.setdefault('SIA_PREWARM', '0')
+os.environ.setdefault('SIA_WATCH', '0')
+
+import sia  # noqa: E402
+
+
+def test_sen_amounts_survive_parsing():
+    assert sia.to_sen(108333333.34) == 10833333334
+    assert sia.to_sen('4573343333.33') == 457334333333
+    assert sia.parse_amount('1.000.000,50') == 100000050
+
+
+def test_sums_in_sen_do_not_drift():
+    amounts = [108333333.34, 4573343333.33, 63666666.67]
+    assert sum(sia.to_sen(amount) for amount in amounts) == 474534333334
+
+
+def test_sen_back_to_rupiah():
+    assert sia.from_sen(8400000) == 84000
+    assert sia.from_sen(10833333334) == 108333333.34
+    assert sia.rupiah_filter(-150) == '-Rp 2'
+    assert sia.format_rupiah(497196316767) == 'Rp 4.971.963.168'
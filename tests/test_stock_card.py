@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+for module in ('flask', 'flask_sqlalchemy', 'openpyxl', 'pandas', 'numpy'):
+    pytest.importorskip(module)
+
+os.environ.setdefault('SIA_PREWARM', '0')
+os.environ.setdefault('SIA_WATCH', '0')
+
+import openpyxl  # noqa: E402
+
+import sia  # noqa: E402
+
+
+def _movement_sheet(*rows):
+    wb = openpyxl.Workbook()
+    ws = sia._stock_movement_sheet(wb)
+    for row in rows:
+        ws.append(row)
+    return ws
+
+
+def test_voiding_a_sale_shifts_later_positions():
+    # Sale of 2 from 18, then a purchase of 10: stored positions 16 and 26.
+    ws = _movement_sheet(
+        ['2025-11-03', 'V1', 'ITEM-001', 'Madu', -2, None, 50000, 16, 50000],
+        ['2025-11-05', 'V2', 'ITEM-001', 'Madu', 10, None, 62000, 26, 54615.38],
+        ['2025-11-05', 'V3', 'ITEM-002', 'Lain', 4, None, 1000, 4, 1000],
+    )
+    ws.cell(row=2, column=6, value='2025-11-06 10:00:00')
+    voided = {'tanggal': '2025-11-03', 'row_index': 2, 'item_code': 'ITEM-001', 'qty': -2, 'unit_cost': 50000}
+
+    sia._shift_later_positions(ws, [voided])
+
+    assert ws.cell(row=3, column=8).value == 28
+    assert ws.cell(row=3, column=9).value == pytest.approx((26 * 54615.38 + 2 * 50000) / 28)
+    assert ws.cell(row=4, column=8).value == 4
+
+
+def test_relocked_period_does_not_serve_the_old_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(sia, 'TENANTS_DIR', str(tmp_path))
+    with sia.tenant_context('kunci') as tenant:
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        sia.lock_period('2025-11', 'uji')
+        assert sia._period_cached('laporan', '2025', 'November', [], compute) == 1
+        # Another worker reopened: this process never cleared its entry.
+        wb = sia.openpyxl.load_workbook(tenant.saldo_file)
+        wb[sia.PERIOD_LOCK_SHEET].delete_rows(2)
+        wb.save(tenant.saldo_file)
+        sia.lock_period('2025-11', 'uji')
+        assert sia._period_cached('laporan', '2025', 'November', [], compute) == 2
+
+
+def test_immutable_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(sia, 'TENANTS_DIR', str(tmp_path))
+    monkeypatch.setattr(sia, 'TENANT_CACHE_MAX_ENTRIES', 2)
+    with sia.tenant_context('batas') as tenant:
+        for key in ('a', 'b', 'c'):
+            tenant.immutable_put(('2025-11', 'g', key), key)
+        assert tenant.immutable_get(('2025-11', 'g', 'a')) is None
+        assert len(tenant.immutable) == 2
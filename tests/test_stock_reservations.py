@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+for module in ('flask', 'flask_sqlalchemy', 'openpyxl', 'pandas', 'numpy'):
+    pytest.importorskip(module)
+
+os.environ.setdefault('SIA_PREWARM', '0')
+os.environ.setdefault('SIA_WATCH', '0')
+
+import openpyxl  # noqa: E402
+
+import sia  # noqa: E402
+
+
+@pytest.fixture
+def tenant(tmp_path, monkeypatch):
+    monkeypatch.setattr(sia, 'TENANTS_DIR', str(tmp_path))
+    tenant = sia.get_tenant('uji')
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'Inventory'
+    ws.append(['No Item', 'Nama Barang', 'Stock Remaining', 'Price'])
+    ws.append(['M1', 'Madu Multiflora', 18, 84000])
+    wb.save(tenant.inventory_file)
+    with sia.tenant_context(tenant):
+        yield tenant
+
+
+def test_purchase_then_reservation_counts_stock_once(tenant):
+    assert tenant.stock.available('M1') == 18
+
+    assert sia.update_inventory_stock('Madu Multiflora', 5)
+    assert tenant.stock.available('M1') == 23
+
+    reservation = tenant.stock.reserve([('M1', 23)])
+    with pytest.raises(sia.InsufficientStockError):
+        tenant.stock.reserve([('M1', 1)])
+    tenant.stock.release(reservation)
+
+
+def test_purchase_before_first_reservation_is_not_doubled(tenant):
+    # Slots seeded lazily after the save must not add the purchase again.
+    assert sia.update_inventory_stock('Madu Multiflora', 5)
+    assert tenant.stock.available('M1') == 23
+
+
+def test_void_after_purchase_restores_file_stock(tenant):
+    tenant.stock.available('M1')
+    assert sia.update_inventory_stock('Madu Multiflora', 5)
+    assert sia.update_inventory_stock('Madu Multiflora', -5)
+    assert tenant.stock.available('M1') == 18